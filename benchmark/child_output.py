@@ -0,0 +1,93 @@
+"""
+Output of many chatty multiprocessing workers captured with capture_children.
+
+Runs --workers processes which each print --lines lines, first without notifyemail and then with
+setup(capture_children=True). It reports the time the workers take and the number of tagged lines
+which reached Log_Cache.log.
+
+Usage:
+    python benchmark/child_output.py --workers 32 --lines 20000
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from smtp_sink import start_sink
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def chatty_worker(lines):
+    for i in range(lines):
+        print('step %d loss %.6f' % (i, 1.0 / (i + 1)))
+    sys.stdout.flush()
+
+
+def run_workers(args):
+    context = multiprocessing.get_context(args.start_method)
+    start = time.perf_counter()
+    workers = [context.Process(target=chatty_worker, args=(args.lines,)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def child(args):
+    if args.capture:
+        sys.path.insert(0, PACKAGE_ROOT)
+        import notifyemail as notify
+        sink = start_sink()
+        notify.setup(mail_host='127.0.0.1', mail_port=sink.port, mail_ssl=False, mail_user='bench@localhost',
+                     mail_pass='bench', log_root_path=args.log_root_path, mail_list=['bench@localhost'],
+                     capture_children=True, log_buffer_size=1 << 20, send_deadline=0)
+    seconds = run_workers(args)
+    sys.__stderr__.write('%.3f\n' % seconds)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {}
+        for capture in (False, True):
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--workers', str(args.workers),
+                       '--lines', str(args.lines), '--start_method', args.start_method, '--log_root_path', tmp_dir]
+            if capture:
+                command.append('--capture')
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            results[capture] = float(process.stderr.strip().splitlines()[-1])
+
+        captured = 0
+        for log_path in glob.glob(os.path.join(tmp_dir, '*', '*', 'Log_Cache.log')):
+            with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+                captured += sum(1 for line in f if line.startswith('[') and '] step ' in line)
+        expected = args.workers * args.lines
+        print('%d workers x %d lines (%s)' % (args.workers, args.lines, args.start_method))
+        print('  terminal only:      %.3f s' % results[False])
+        print('  capture_children:   %.3f s  (%d / %d lines in Log_Cache.log)' % (results[True], captured, expected))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Capture of the output of chatty workers')
+    parser.add_argument('--workers', default=32, type=int)
+    parser.add_argument('--lines', default=20000, type=int, help='lines printed by each worker')
+    parser.add_argument('--start_method', default='fork', choices=['fork', 'spawn', 'forkserver'])
+    parser.add_argument('--log_root_path', default=None, type=str)
+    parser.add_argument('--capture', action='store_true')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    if args.child:
+        child(args)
+    else:
+        main(args)
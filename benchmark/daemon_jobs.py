@@ -0,0 +1,90 @@
+"""
+Many concurrent jobs, with and without the notify daemon.
+
+Starts a local SMTP sink, then runs --jobs child interpreters at the same time. Each child calls
+notify.setup(), works for --duration seconds and ends. The run is measured twice: with every job
+monitoring and sending by itself, then with a notify daemon shared by the jobs. It reports the
+number of SMTP connections and logins seen by the sink, the number of system samplers, and the time
+until all emails have arrived.
+
+Usage:
+    python benchmark/daemon_jobs.py --jobs 16
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from smtp_sink import start_sink
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD_CODE = '''
+import sys, time
+sys.path.insert(0, {package_root!r})
+import notifyemail as notify
+notify.setup(mail_host='127.0.0.1', mail_port={port}, mail_ssl=False, mail_user='bench@localhost', mail_pass='bench',
+             log_root_path={log_root_path!r}, mail_list=['bench@localhost'], daemon_socket={daemon_socket!r})
+end = time.time() + {duration}
+while time.time() < end:
+    time.sleep(0.05)
+print('job done')
+'''
+
+
+def run_jobs(args, tmp_dir, daemon_socket):
+    sink = start_sink()
+    children = []
+    start = time.time()
+    for job in range(args.jobs):
+        code = CHILD_CODE.format(package_root=PACKAGE_ROOT, port=sink.port, duration=args.duration,
+                                 log_root_path=os.path.join(tmp_dir, 'job_%d' % job), daemon_socket=daemon_socket)
+        children.append(subprocess.Popen([sys.executable, '-c', code], cwd=tmp_dir,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for child in children:
+        child.wait(args.timeout)
+    deadline = time.time() + args.timeout
+    while len(sink.messages) < args.jobs and time.time() < deadline:
+        time.sleep(0.01)
+    result = {'messages': len(sink.messages), 'connections': sink.connections, 'logins': sink.logins,
+              'seconds': (sink.last_time or time.time()) - start}
+    sink.stop()
+    return result
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local = run_jobs(args, tmp_dir, None)
+        print('without daemon: %(messages)d emails, %(connections)d connections, %(logins)d logins, '
+              'all delivered after %(seconds).2f s' % local, '| %d system samplers' % args.jobs)
+
+        socket_path = os.path.join(tmp_dir, 'notify.sock')
+        daemon = subprocess.Popen([sys.executable, '-m', 'notifyemail', 'daemon', '--socket', socket_path,
+                                   '--pool_size', str(args.pool_size)], cwd=PACKAGE_ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+            shared = run_jobs(args, tmp_dir, socket_path)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        print('with daemon:    %(messages)d emails, %(connections)d connections, %(logins)d logins, '
+              'all delivered after %(seconds).2f s' % shared, '| 1 system sampler')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Concurrent jobs with and without the notify daemon')
+    parser.add_argument('--jobs', default=16, type=int, help='number of concurrent jobs')
+    parser.add_argument('--duration', default=2.0, type=float, help='running time (s) of each job')
+    parser.add_argument('--pool_size', default=2, type=int, help='SMTP connections of the daemon')
+    parser.add_argument('--timeout', default=120, type=float, help='give up after this many seconds')
+    return parser
+
+
+if __name__ == '__main__':
+    main(get_args_parser().parse_args())
@@ -0,0 +1,85 @@
+"""
+Exit-to-send latency benchmark.
+
+A child interpreter calls notify.setup() with mail_host pointing to a local TCP listener, waits half a
+second, prints a few lines and ends. The latency is the time between the last statement of the child and the moment the
+notifier connects to the listener to send the email. The listener then closes the connection, so the
+child gives up sending and exits.
+
+Usage:
+    python benchmark/exit_latency.py --runs 5
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+CHILD_CODE = '''
+import sys, time
+sys.path.insert(0, {package_root!r})
+import notifyemail as notify
+notify.setup(mail_host={mail_host!r}, mail_user='bench@localhost', mail_pass='bench',
+             log_root_path={log_root_path!r}, mail_list=['bench@localhost'], send_deadline=0)
+time.sleep(0.5)  # Like any program running longer than a blink, leave time to the background imports of the notifier
+for i in range(10):
+    print(i)
+with open({end_time_path!r}, 'w') as f:
+    f.write(repr(time.time()))
+'''
+
+
+def measure_once(tmp_dir, run_id, timeout):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.settimeout(timeout)
+    port = listener.getsockname()[1]
+
+    end_time_path = os.path.join(tmp_dir, 'end_time_%d' % run_id)
+    code = CHILD_CODE.format(package_root=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             mail_host='127.0.0.1:%d' % port,  # smtplib accepts host:port
+                             log_root_path=os.path.join(tmp_dir, 'notify_log'),
+                             end_time_path=end_time_path)
+    child = subprocess.Popen([sys.executable, '-c', code], cwd=tmp_dir,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        connection, _ = listener.accept()
+        connect_time = time.time()
+        connection.close()
+    finally:
+        listener.close()
+    child.wait(timeout)
+
+    with open(end_time_path) as f:
+        end_time = float(f.read())
+    return connect_time - end_time
+
+
+def main(args):
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for run_id in range(args.runs):
+            latencies.append(measure_once(tmp_dir, run_id, args.timeout))
+            print('run %d: %.1f ms' % (run_id, latencies[-1] * 1000))
+    print('median: %.1f ms | max: %.1f ms' % (statistics.median(latencies) * 1000, max(latencies) * 1000))
+    if args.max_latency is not None and max(latencies) > args.max_latency:
+        print('FAILED: exit-to-send latency above %.3f s' % args.max_latency)
+        sys.exit(1)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Latency between the end of the program and the email sending')
+    parser.add_argument('--runs', default=5, type=int, help='number of measured runs')
+    parser.add_argument('--timeout', default=60, type=float, help='give up a run after this many seconds')
+    parser.add_argument('--max_latency', default=None, type=float, help='exit with an error above this latency (s)')
+    return parser
+
+
+if __name__ == '__main__':
+    main(get_args_parser().parse_args())
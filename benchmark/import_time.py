@@ -0,0 +1,93 @@
+"""
+Import time of the package.
+
+Runs `python -X importtime -c "import notifyemail"` in fresh interpreters, reports the median
+cumulative import time of notifyemail and the slowest modules it pulls in, and checks that none of the
+heavy modules (psutil, smtplib, ssl, email, zipfile, ...) is loaded by the import alone. These must only
+be loaded by setup(), sending or zipping. The exit status is 1 if the check or the time budget fails.
+
+Usage:
+    python benchmark/import_time.py --runs 10 --budget_ms 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['psutil', 'smtplib', 'ssl', 'email', 'zipfile', 'socket', 'subprocess', 'json', 'csv', 'mmap',
+                 'notifyemail.notify_frontend', 'notifyemail.notify_backend', 'notifyemail.monitor']
+
+CHILD_CODE = '''
+import sys
+sys.path.insert(0, {package_root!r})
+import notifyemail
+print(' '.join(sorted(name for name in {heavy!r} if name in sys.modules)))
+'''
+
+
+def import_once():
+    """Return ({module: cumulative microseconds} of the modules loaded by the import, heavy modules loaded).
+    """
+    code = CHILD_CODE.format(package_root=PACKAGE_ROOT, heavy=HEAVY_MODULES)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                             cwd=PACKAGE_ROOT)
+    times = {}
+    collecting = False
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # Header line
+        name = fields[2].rstrip()
+        # Modules imported by the interpreter startup come first, keep the ones imported for notifyemail
+        if name.strip().startswith('notifyemail') or collecting:
+            collecting = True
+            times[name.strip()] = max(times.get(name.strip(), 0), cumulative)
+    loaded = process.stdout.split()
+    return times, loaded
+
+
+def main(args):
+    totals = []
+    loaded = []
+    times = {}
+    for _ in range(args.runs):
+        times, loaded = import_once()
+        totals.append(times.get('notifyemail', 0) / 1000)
+    median = statistics.median(totals)
+
+    print('import notifyemail: median %.2f ms, min %.2f ms, max %.2f ms over %d runs'
+          % (median, min(totals), max(totals), args.runs))
+    print('slowest modules of the last run (cumulative ms):')
+    for name, microseconds in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+        print('  %8.2f  %s' % (microseconds / 1000, name))
+
+    status = 0
+    if loaded:
+        print('FAIL: heavy modules loaded by the import:', ', '.join(loaded))
+        status = 1
+    if args.budget_ms is not None and median > args.budget_ms:
+        print('FAIL: median import time %.2f ms is over the budget of %.2f ms' % (median, args.budget_ms))
+        status = 1
+    if status == 0:
+        print('OK')
+    return status
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Import time of notifyemail')
+    parser.add_argument('--runs', default=10, type=int, help='number of fresh interpreters')
+    parser.add_argument('--top', default=10, type=int, help='number of slowest modules shown')
+    parser.add_argument('--budget_ms', default=5.0, type=float, help='maximum median import time (ms)')
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_args_parser().parse_args()))
@@ -0,0 +1,124 @@
+"""
+Print throughput benchmark for the Logger capture.
+
+Runs the same print loop in a fresh interpreter five times:
+ - plain:     without notify.setup()
+ - direct:    with notify.setup(), every print written straight to Log_Cache.log
+ - buffered:  with notify.setup(log_buffer_size=...), prints batched by the background writer
+ - fd:        with notify.setup(capture_mode='fd', log_buffer_size=...), file descriptors 1 and 2 captured
+ - collapse:  with notify.setup(log_collapse=True, log_buffer_size=...), progress bars and repeats collapsed
+
+With --native the lines are written with os.write(1, ...) like a C extension would, which only the fd
+mode captures. With --progress_bar every line is followed by a tqdm-like bar redrawn with '\r' and
+sampled lines are repeated, as in training loops. The number of lines found in Log_Cache.log and its
+size are reported for every mode.
+
+Usage:
+    python benchmark/logger_throughput.py --lines 200000
+    python benchmark/logger_throughput.py --lines 200000 --native
+    python benchmark/logger_throughput.py --lines 200000 --progress_bar
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def child(args):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if args.mode != 'plain':
+        import notifyemail as notify
+        options = {}
+        if args.mode in ['buffered', 'fd', 'collapse']:
+            options['log_buffer_size'] = args.buffer_size
+        if args.mode == 'collapse':
+            options['log_collapse'] = True
+        if args.mode == 'fd':
+            options['capture_mode'] = 'fd'
+        # Nothing listens on this address, the final email fails right away and stays in the outbox.
+        notify.setup(mail_host='127.0.0.1', mail_user='bench@localhost', mail_pass='bench',
+                     log_root_path=args.log_root_path, mail_list=['bench@localhost'], send_deadline=0, **options)
+
+    line = 'x' * args.line_length
+    start = time.perf_counter()
+    if args.progress_bar:
+        for i in range(args.lines):
+            print(i, line)
+            # Half of the lines are followed by the same status line, the bar is redrawn 10 times per line
+            if i % 2:
+                print('validation pending')
+            for step in range(10):
+                sys.stdout.write('\r%3d%%|%-10s| %d/%d' % (step * 10, '#' * step, step, 10))
+            sys.stdout.write('\r')
+        sys.stdout.flush()
+    elif args.native:
+        for i in range(args.lines):
+            os.write(1, b'%d %s\n' % (i, line.encode()))
+    else:
+        for i in range(args.lines):
+            print(i, line)
+        sys.stdout.flush()
+    elapsed = time.perf_counter() - start
+
+    with open(args.result_path, 'w') as f:
+        json.dump({'mode': args.mode, 'lines': args.lines, 'seconds': elapsed}, f)
+
+
+def main(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ['plain', 'direct', 'buffered', 'fd', 'collapse']:
+            result_path = os.path.join(tmp_dir, mode + '.json')
+            cmd = [sys.executable, os.path.abspath(__file__), '--child', '--mode', mode,
+                   '--lines', str(args.lines), '--line_length', str(args.line_length),
+                   '--buffer_size', str(args.buffer_size),
+                   '--log_root_path', os.path.join(tmp_dir, mode), '--result_path', result_path]
+            if args.native:
+                cmd.append('--native')
+            if args.progress_bar:
+                cmd.append('--progress_bar')
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=tmp_dir)
+            with open(result_path) as f:
+                result = json.load(f)
+            result['captured'] = 0
+            result['log_bytes'] = 0
+            for log_path in glob.glob(os.path.join(tmp_dir, mode, '*', '*', 'Log_Cache.log')):
+                result['log_bytes'] += os.path.getsize(log_path)
+                with open(log_path, 'rb') as f:
+                    result['captured'] += sum(1 for log_line in f if log_line.endswith(b'x\n'))
+            results.append(result)
+
+    base = results[0]['seconds']
+    print('%-10s %12s %14s %10s %10s %12s' % ('mode', 'seconds', 'lines/s', 'slowdown', 'captured', 'log bytes'))
+    for r in results:
+        print('%-10s %12.3f %14.0f %9.2fx %10d %12d' % (r['mode'], r['seconds'], r['lines'] / r['seconds'],
+                                                        r['seconds'] / base, r['captured'], r['log_bytes']))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Print throughput with and without notify.setup()')
+    parser.add_argument('--lines', default=200000, type=int, help='number of printed lines')
+    parser.add_argument('--line_length', default=80, type=int, help='characters per printed line')
+    parser.add_argument('--buffer_size', default=256 * 1024, type=int, help='log_buffer_size of the buffered and fd modes')
+    parser.add_argument('--native', action='store_true', help='write with os.write(1, ...) instead of print')
+    parser.add_argument('--progress_bar', action='store_true', help='redraw a progress bar with \\r after every line')
+
+    # Internal parameters of the child process
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', default='plain', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--log_root_path', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--result_path', default=None, type=str, help=argparse.SUPPRESS)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    if args.child:
+        child(args)
+    else:
+        main(args)
@@ -0,0 +1,115 @@
+"""
+Local stand-in SMTP server for the benchmarks.
+
+It accepts any login and any message, keeps the received messages in memory and counts the
+connections and logins. It speaks plain SMTP (no SSL and no STARTTLS), so the notifier under test
+should use mail_ssl=False and mail_port=<sink port>.
+
+Usage as a module:
+    from smtp_sink import start_sink
+    sink = start_sink()
+    ... notify.setup(mail_host='127.0.0.1', mail_port=sink.port, mail_ssl=False, ...)
+    sink.messages, sink.connections, sink.logins
+    sink.stop()
+
+Usage from the command line (prints a line for every message):
+    python benchmark/smtp_sink.py --port 2525
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 notifyemail sink ready')
+        data = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if data is not None:
+                if line == b'.\r\n':
+                    message = b''.join(data)
+                    with sink.lock:
+                        sink.messages.append(message)
+                        sink.bytes += len(message)
+                        sink.last_time = time.time()
+                    if sink.verbose:
+                        print('message %d: %d bytes' % (len(sink.messages), len(message)))
+                    data = None
+                    self.reply('250 OK')
+                else:
+                    data.append(line[1:] if line.startswith(b'..') else line)  # Undo the dot-stuffing
+                continue
+
+            command = line.strip().upper()
+            if command.startswith(b'EHLO'):
+                self.reply('250-notifyemail sink')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command.startswith(b'AUTH'):
+                with sink.lock:
+                    sink.logins += 1
+                self.reply('235 Authentication successful')
+            elif command == b'DATA':
+                data = []
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:  # HELO, MAIL, RCPT, NOOP, RSET
+                self.reply('250 OK')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, verbose=False):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), SinkHandler)
+        self.port = self.server_address[1]
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.messages = []
+        self.bytes = 0
+        self.connections = 0
+        self.logins = 0
+        self.last_time = None  # time.time() of the last received message
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def start_sink(host='127.0.0.1', port=0, verbose=False):
+    """Start a sink in a background thread and return it.
+    """
+    sink = SmtpSink(host, port, verbose)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    return sink
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Local SMTP sink accepting every message')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=2525, type=int)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    sink = SmtpSink(args.host, args.port, verbose=True)
+    print('SMTP sink listening on %s:%d' % (args.host, sink.port))
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,270 @@
+"""
+Benchmark suite of notifyemail, offline against the local SMTP sink.
+
+Every benchmark runs in a fresh interpreter, once for each workload size:
+ - logger_write:     Logger.write() throughput after notify.setup() (lines/s, MB/s)
+ - monitor_overhead: CPU time used by server_monitor_process while the program sleeps (% of one core)
+ - zip:              NotifyBackend.zipDir() on a folder of text and random files (MB/s)
+ - mime_memory:      peak Python memory while building and serializing an email with large attachments
+ - exit_latency:     time from the end of a program to the arrival of its email at the sink
+
+The results are printed as a table and written as JSON with --output. Two JSON files can be compared
+with --compare, which prints the ratio of every metric to the baseline.
+
+Usage:
+    python benchmark/suite.py --sizes small medium --output results.json
+    python benchmark/suite.py --benchmarks zip mime_memory --output new.json --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from smtp_sink import start_sink
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ['logger_write', 'monitor_overhead', 'zip', 'mime_memory', 'exit_latency']
+
+# Workload of every benchmark for each size
+WORKLOADS = {
+    'logger_write': {'small': {'lines': 50000}, 'medium': {'lines': 200000}, 'large': {'lines': 1000000}},
+    'monitor_overhead': {'small': {'seconds': 2}, 'medium': {'seconds': 5}, 'large': {'seconds': 15}},
+    'zip': {'small': {'mb': 8}, 'medium': {'mb': 64}, 'large': {'mb': 256}},
+    'mime_memory': {'small': {'mb': 8}, 'medium': {'mb': 64}, 'large': {'mb': 256}},
+    'exit_latency': {'small': {'lines': 1000, 'mb': 0}, 'medium': {'lines': 100000, 'mb': 16},
+                     'large': {'lines': 1000000, 'mb': 64}},
+}
+
+# Whether a higher value of the metric is better, for the comparison
+HIGHER_IS_BETTER = {'lines_per_s': True, 'mb_per_s': True, 'cpu_percent': False, 'peak_mb': False,
+                    'latency_s': False, 'seconds': False}
+
+EXIT_CHILD_CODE = '''
+import sys, time
+sys.path.insert(0, {package_root!r})
+import notifyemail as notify
+notify.setup(mail_host='127.0.0.1', mail_port={port}, mail_ssl=False, mail_user='bench@localhost',
+             mail_pass='bench', log_root_path={log_root_path!r}, mail_list=['bench@localhost'], log_buffer_size=1 << 16)
+if {data_path!r}:
+    notify.add_file({data_path!r})
+for i in range({lines}):
+    print('step', i, 'loss', 1.0 / (i + 1))
+with open({end_time_path!r}, 'w') as f:
+    f.write(repr(time.time()))
+'''
+
+
+def write_files(folder, mb):
+    """Fill folder with mb megabytes, half text (compressible) and half random bytes, in 4 MB files at most.
+    """
+    os.makedirs(folder, exist_ok=True)
+    line = b''.join(b'step %d loss %.6f lr 0.001\n' % (i, 1.0 / (i + 1)) for i in range(1000))
+    left = mb * 1024 * 1024
+    index = 0
+    while left > 0:
+        size = min(left, 4 * 1024 * 1024)
+        with open(os.path.join(folder, 'file_%03d.%s' % (index, 'log' if index % 2 == 0 else 'bin')), 'wb') as f:
+            if index % 2 == 0:
+                f.write((line * (size // len(line) + 1))[:size])
+            else:
+                f.write(os.urandom(size))
+        left -= size
+        index += 1
+
+
+def new_backend(tmp_dir, **kwargs):
+    """A NotifyBackend which is not started, with its log folder, to call its methods directly.
+    """
+    from notifyemail import NotifyBackend
+    backend = NotifyBackend(os.path.join(tmp_dir, 'notify_log'), 'bench', mail_host='127.0.0.1',
+                            mail_user='bench@localhost', mail_pass='bench', mail_list=['bench@localhost'], **kwargs)
+    os.makedirs(backend.log_folder_path, exist_ok=True)
+    return backend
+
+
+def bench_logger_write(tmp_dir, lines):
+    import notifyemail as notify
+    sink = start_sink()
+    notify.setup(mail_host='127.0.0.1', mail_port=sink.port, mail_ssl=False, mail_user='bench@localhost',
+                 mail_pass='bench', log_root_path=os.path.join(tmp_dir, 'notify_log'), mail_list=['bench@localhost'],
+                 send_deadline=0)
+    write = sys.stdout.write
+    line = 'step 0000000 loss 0.000000 ' + 'x' * 52 + '\n'
+    start = time.perf_counter()
+    for _ in range(lines):
+        write(line)
+    sys.stdout.flush()
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'lines_per_s': lines / seconds, 'mb_per_s': lines * len(line) / seconds / 1024 ** 2}
+
+
+def bench_monitor_overhead(tmp_dir, seconds):
+    backend = new_backend(tmp_dir)
+    idle_start = time.process_time()
+    time.sleep(seconds)
+    idle = time.process_time() - idle_start  # Without monitoring, nearly nothing
+
+    start = time.process_time()
+    backend.start_monitor(backend.log_folder_path)
+    time.sleep(seconds)
+    backend.stop_monitor()
+    cpu = time.process_time() - start - idle
+    return {'cpu_percent': max(cpu, 0) / seconds * 100}
+
+
+def bench_zip(tmp_dir, mb):
+    data_dir = os.path.join(tmp_dir, 'data')
+    write_files(data_dir, mb)
+    backend = new_backend(tmp_dir)
+    start = time.perf_counter()
+    error = backend.zipDir(data_dir, os.path.join(tmp_dir, 'data'))
+    seconds = time.perf_counter() - start
+    if error:
+        raise error
+    return {'seconds': seconds, 'mb_per_s': mb / seconds,
+            'ratio': os.path.getsize(os.path.join(tmp_dir, 'data.zip')) / (mb * 1024 * 1024)}
+
+
+def bench_mime_memory(tmp_dir, mb):
+    import tracemalloc
+    from notifyemail.mail_stream import StreamingMessage
+    from notifyemail.outbox import Outbox, SpooledMessage
+    data_dir = os.path.join(tmp_dir, 'data')
+    write_files(data_dir, mb)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    message = StreamingMessage('[bench LOG] mime_memory', 'bench@localhost', ['bench@localhost'])
+    message.set_body('start time: -\nend time: -\n' * 100)
+    for name in sorted(os.listdir(data_dir)):
+        message.add_attachment(os.path.join(data_dir, name), name)
+    outbox = Outbox(os.path.join(tmp_dir, 'outbox'))
+    item_path = outbox.put(message)  # Spooled, as at the end of a run
+    for chunk in SpooledMessage(item_path, outbox.read_envelope(item_path)).iter_chunks():
+        pass  # Encoded as when it is sent
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': seconds, 'peak_mb': peak / 1024 ** 2, 'message_mb': message.encoded_size() / 1024 ** 2}
+
+
+def bench_exit_latency(tmp_dir, lines, mb):
+    sink = start_sink()
+    data_path = ''
+    if mb:
+        data_path = os.path.join(tmp_dir, 'data')
+        write_files(data_path, mb)
+    end_time_path = os.path.join(tmp_dir, 'end_time')
+    code = EXIT_CHILD_CODE.format(package_root=PACKAGE_ROOT, port=sink.port,
+                                  log_root_path=os.path.join(tmp_dir, 'notify_log'), data_path=data_path,
+                                  lines=lines, end_time_path=end_time_path)
+    subprocess.run([sys.executable, '-c', code], cwd=tmp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   timeout=600)
+    sink.stop()
+    if not sink.messages:
+        raise RuntimeError('No email arrived at the sink')
+    with open(end_time_path) as f:
+        end_time = float(f.read())
+    return {'latency_s': sink.last_time - end_time, 'message_mb': sink.bytes / 1024 ** 2}
+
+
+def child(args):
+    sys.path.insert(0, PACKAGE_ROOT)
+    workload = WORKLOADS[args.benchmark][args.size]
+    os.chdir(args.tmp_dir)  # Removed by the parent, after the notifier of this process is done with it
+    metrics = globals()['bench_' + args.benchmark](args.tmp_dir, **workload)
+    with open(args.result_path, 'w') as f:
+        json.dump(metrics, f)
+
+
+def run_benchmark(benchmark, size, timeout):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_path = os.path.join(tmp_dir, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--child', '--benchmark', benchmark, '--size', size,
+                   '--tmp_dir', tmp_dir, '--result_path', result_path]
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                 timeout=timeout)
+        if process.returncode != 0 or not os.path.exists(result_path):
+            return {'error': (process.stderr.strip().splitlines() or ['exit status %d' % process.returncode])[-1]}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PACKAGE_ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    """Print the ratio of every metric to the same metric of the baseline, marking the regressions.
+    """
+    old = {(r['benchmark'], r['size']): r['metrics'] for r in baseline['results']}
+    print('\ncompared with %s (%s)' % (baseline.get('commit'), baseline.get('time')))
+    print('%-18s %-8s %-12s %12s %12s %8s' % ('benchmark', 'size', 'metric', 'baseline', 'current', 'ratio'))
+    for r in results:
+        for metric, value in r['metrics'].items():
+            before = old.get((r['benchmark'], r['size']), {}).get(metric)
+            if metric not in HIGHER_IS_BETTER or not isinstance(before, (int, float)) or not before:
+                continue
+            ratio = value / before
+            worse = ratio < 0.9 if HIGHER_IS_BETTER[metric] else ratio > 1.1
+            print('%-18s %-8s %-12s %12.3f %12.3f %7.2fx%s' % (r['benchmark'], r['size'], metric, before, value,
+                                                              ratio, '  <- worse' if worse else ''))
+
+
+def main(args):
+    results = []
+    for benchmark in args.benchmarks:
+        for size in args.sizes:
+            metrics = run_benchmark(benchmark, size, args.timeout)
+            results.append({'benchmark': benchmark, 'size': size, 'workload': WORKLOADS[benchmark][size],
+                            'metrics': metrics})
+            print('%-18s %-8s %s' % (benchmark, size, '  '.join(
+                '%s=%.3f' % (name, value) if isinstance(value, float) else '%s=%s' % (name, value)
+                for name, value in metrics.items())))
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('results written to', args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 1 if any('error' in r['metrics'] for r in results) else 0
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Benchmark suite of notifyemail')
+    parser.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=['small', 'medium', 'large'])
+    parser.add_argument('--output', default=None, type=str, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, type=str, help='JSON file of a previous run to compare with')
+    parser.add_argument('--timeout', default=900, type=float, help='give up a benchmark after this many seconds')
+
+    # Internal parameters of the child process
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--benchmark', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--size', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--tmp_dir', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--result_path', default=None, type=str, help=argparse.SUPPRESS)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    if args.child:
+        child(args)
+    else:
+        sys.exit(main(args))
@@ -1,103 +1,301 @@
-"""
-notifyemail-1.1.0
-
-Notifyemail is a package that sends notifications via email when your code finishes 
-running on a remote server, even within a Local-Area-Network (LAN). 
-It also works well with other environments like Google Colab and notifies you of 
-the results when program finished.
-
-Hope it can do some help for your project :)
-
-Special thanks:
- - 吕尚青
- - 张天翊
- - 雷言理
- - 吴雨卓
-"""
-
-import threading
-import os
-import psutil
-import re
-import socket
-import sys
-import time
-import shutil
-import zipfile
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from .notify_backend import NotifyBackend
-from .notify_frontend import NotifyFrontend
-from .tools import Logger, _setup, _Reboost, _add_text, _add_file, _send_log
-
-
-# By default, start notify background process with empty values
-notify_frontend = NotifyFrontend(log_root_path=None, mail_host=None,
-                                 mail_user=None, mail_pass=None,
-                                 default_receiving_list=None, max_log_cnt=5, 
-                                 init_import=True)
-
-
-### Mail settings ###
-def setup(notify_frontend=notify_frontend, *args, **kwargs):
-    """
-    Configure email settings, start the notify background process.
-
-    Parameters
-    ----------
-    mail_host : str
-        The SMTP server hostname. Default is None.
-
-    mail_user : str
-        The email account used for sending notifications. Default is None.
-
-    mail_pass : str
-        The authorization code for the email account. Default is None.
-
-    log_root_path : str
-        The root path where log files will be saved. Default is None.
-
-    default_receiving_list : str or list, optional
-        The default recipient(s) for notifications. It can be a single email address (str) 
-        or a list of email addresses. Default is None.
-
-    max_log_cnt : int, optional
-        The maximum number of logs that Notify will not auto-delete. 
-        This is intended to save space on the local drive. Default is 5.
-    
-    default_reciving_list : str or list, optional
-        The alias of default_receiving_list.
-
-    mail_list : str or list, optional
-        The recipient(s) for the logs. It can be a single email address (str) or a list of email addresses.
-
-    notify_frontend : notify class, optional
-        The notify class object used for sending notifications.
-    
-    Returns
-    -------
-    None
-        Start the notify background process and prints the following information:
-        - The log root path.
-        - The mail user (email account).
-        - The default receiving list for notifications.
-        - The number of logs that will not be auto-deleted.
-    """
-    _setup(notify_frontend=notify_frontend, *args, **kwargs)
-
-### Add text or files ###
-
-def add_text(text_input, notify_frontend=notify_frontend):
-    return _add_text(text_input, notify_frontend=notify_frontend)
-
-def add_file(file_dir, notify_frontend=notify_frontend):
-    return _add_file(file_dir, notify_frontend=notify_frontend)
-
-### Compatible functions ###
-
-def Reboost(notify_frontend=notify_frontend, *args, **kwargs):
-    _Reboost(notify_frontend=notify_frontend, *args, **kwargs)
-
-def send_log(mail_list=None, notify_frontend=notify_frontend):
-    return _send_log(mail_list=mail_list, notify_frontend=notify_frontend)
\ No newline at end of file
+"""
+notifyemail-1.1.0
+
+Notifyemail is a package that sends notifications via email when your code finishes 
+running on a remote server, even within a Local-Area-Network (LAN). 
+It also works well with other environments like Google Colab and notifies you of 
+the results when program finished.
+
+Hope it can do some help for your project :)
+
+Special thanks:
+ - 吕尚青
+ - 张天翊
+ - 雷言理
+ - 吴雨卓
+"""
+
+import os
+
+# Nothing heavy is imported here: psutil, smtplib, email, zipfile... are loaded by setup(), by sending
+# or by zipping, when they are needed. `import notifyemail` stays cheap for programs which may never
+# call setup(), see benchmark/import_time.py.
+
+# A child process of a program which captures children sends its output to the parent
+if 'NOTIFYEMAIL_CHILD_CAPTURE' in os.environ:
+    from .child_capture import install_from_environ
+    install_from_environ()
+
+# Attributes loaded at first access (PEP 562)
+_LAZY_ATTRIBUTES = {
+    'NotifyBackend': 'notify_backend',
+    'NotifyFrontend': 'notify_frontend',
+    'Logger': 'tools',
+    'Collector': 'monitor',
+    'register_collector': 'monitor',
+}
+
+_notify_frontend = None  # The default NotifyFrontend, created with empty values at first use
+
+
+def _import_attribute(module_name, name):
+    import importlib
+    value = getattr(importlib.import_module('.' + module_name, __name__), name)
+    # Importing the notify_frontend submodule binds it to the package attribute of the same name,
+    # which belongs to the default NotifyFrontend object.
+    if _notify_frontend is not None:
+        globals()['notify_frontend'] = _notify_frontend
+    else:
+        globals().pop('notify_frontend', None)  # Created by __getattr__ at first access
+    return value
+
+
+def _frontend(notify_frontend=None):
+    """Return notify_frontend if given, otherwise the default NotifyFrontend.
+    """
+    global _notify_frontend
+    if notify_frontend is not None:
+        return notify_frontend
+    if _notify_frontend is None:
+        NotifyFrontend = _import_attribute('notify_frontend', 'NotifyFrontend')
+        # By default, start notify background process with empty values
+        _notify_frontend = NotifyFrontend(log_root_path=None, mail_host=None,
+                                          mail_user=None, mail_pass=None,
+                                          default_receiving_list=None, max_log_cnt=5,
+                                          init_import=True)
+        globals()['notify_frontend'] = _notify_frontend
+    return _notify_frontend
+
+
+def __getattr__(name):
+    if name == 'notify_frontend':
+        return _frontend()
+    if name in _LAZY_ATTRIBUTES:
+        value = _import_attribute(_LAZY_ATTRIBUTES[name], name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+### Mail settings ###
+def setup(notify_frontend=None, *args, **kwargs):
+    """
+    Configure email settings, start the notify background process.
+
+    Parameters
+    ----------
+    mail_host : str
+        The SMTP server hostname. Default is None.
+
+    mail_user : str
+        The email account used for sending notifications. Default is None.
+
+    mail_pass : str
+        The authorization code for the email account. Default is None.
+
+    log_root_path : str
+        The root path where log files will be saved. Default is None.
+
+    default_receiving_list : str or list, optional
+        The default recipient(s) for notifications. It can be a single email address (str) 
+        or a list of email addresses. Default is None.
+
+    max_log_cnt : int, optional
+        The maximum number of logs that Notify will not auto-delete. 
+        This is intended to save space on the local drive. Default is 5.
+    
+    default_reciving_list : str or list, optional
+        The alias of default_receiving_list.
+
+    mail_list : str or list, optional
+        The recipient(s) for the logs. It can be a single email address (str) or a list of email addresses.
+
+    notify_frontend : notify class, optional
+        The notify class object used for sending notifications. Default is None (the default NotifyFrontend).
+
+    log_buffer_size : int, optional
+        Buffered capture mode. If greater than 0, print outputs are batched in memory and written 
+        to the log file by a background thread once this many characters are pending. 
+        Recommended for programs printing a lot. Default is 0 (write through).
+
+    log_flush_interval : float, optional
+        In buffered capture mode, the maximum time (in seconds) before a print output 
+        is written to the log file. Default is 1.0.
+
+    log_head_limit : int, optional
+        Keep only the first log_head_limit bytes (or lines) of the outputs in the log, together 
+        with the tail. The size of the log stays bounded for long runs. Default is None (no limit).
+
+    log_tail_limit : int, optional
+        Keep only the last log_tail_limit bytes (or lines) of the outputs in the log, together 
+        with the head. Default is None (no limit).
+
+    log_limit_unit : str, optional
+        The unit of log_head_limit and log_tail_limit, 'bytes' or 'lines'. Default is 'bytes'.
+
+    log_segment_size : int, optional
+        Write the log in segments of this many bytes. Closed segments are gzipped in the background 
+        at low CPU priority while the program runs, and attached to the email compressed, so chatty 
+        runs use less disk space and less work at exit. Default is 0 (one plain file).
+
+    log_collapse : bool, optional
+        Collapse progress bars and repeated lines in the log: a line redrawn with '\r' keeps its final 
+        state only and a run of identical lines is written once followed by '[repeated N×]'. The 
+        terminal output is unchanged. Default is False.
+
+    log_progress_interval : float, optional
+        With log_collapse, also keep one state of a redrawn line every this many seconds, so the log 
+        still shows how the progress went. Default is None (final state only).
+
+    log_max_bytes : int, optional
+        Total size (in bytes) of the logs kept under log_root_path, across all programs. The oldest 
+        finished runs are removed first, in the background. Default is None (no limit).
+
+    log_max_age : float, optional
+        Age (in days) after which the log of a run is removed. Default is None (no limit).
+
+    zip_workers : int, optional
+        Number of threads compressing the files added by add_file(). The compression speed (MB/s) 
+        is reported in the email. Default is None (the number of CPUs).
+
+    zip_codec : str, optional
+        Codec for compressible files, 'deflate', 'bzip2' or 'lzma'. Files which are compressed 
+        already (.png, .npz, .pt, .gz, .zip, ... or random-looking data) are stored as they are. 
+        The bytes saved and time spent per codec are reported in the email. Default is 'deflate'.
+
+    zip_fast : bool, optional
+        Fast codec mode, deflate at level 1 for all compressible files. Default is False.
+
+    zip_cache_size : int, optional
+        Keep compressed files in a cache under log_root_path, so files which did not change 
+        are not compressed again in the next run. This is the size budget (in bytes) of the 
+        cache, least recently used files are evicted first. Default is 0 (no cache).
+
+    zip_cache_hash : bool, optional
+        Identify cached files by their content hash instead of size and modification time. 
+        Default is False.
+
+    monitor_intervals : dict, optional
+        Time interval (in seconds) between samples of each monitoring collector, 
+        e.g. {'cpu': 0.25, 'mem': 1}. The CPU time used by the monitor itself is 
+        reported in the server status log. Default is None (the default interval of each collector, 
+        e.g. CPU every 0.25 s, memory every second).
+
+    monitor_collectors : list, optional
+        Monitoring collectors to run. Built-in collectors are 'cpu', 'mem', 'disk_io' (MB/s), 'net' (MB/s), 
+        'load' (load average), 'swap', 'disk_free' (GB free on the filesystem of log_root_path) and 
+        'process' (CPU time, RSS, I/O, threads and open files of this program and its child processes). 
+        Your own Collector subclasses can be registered with notify.register_collector() before setup(), 
+        or passed here directly. Default is None (all registered collectors).
+
+    monitor_csv_points : int, optional
+        Every monitoring sample is kept at full resolution in binary series files of the log folder 
+        (see notifyemail.timeseries.TimeSeriesReader). The series attached to the email 
+        (server_series.zip, one CSV per collector) are downsampled to this number of rows. Default is 1000.
+
+    monitor_csv_method : str, optional
+        Downsampling method of the attached series, 'lttb' (largest triangle three buckets) 
+        or 'minmax' (minimum and maximum of every bucket). Default is 'lttb'.
+
+    mail_port : int, optional
+        The SMTP server port. Default is None (465 with SSL, 25 without).
+
+    mail_ssl : bool, optional
+        Connect to the SMTP server with SSL, otherwise with STARTTLS if the server offers it. Default is True.
+
+    smtp_prewarm : bool, optional
+        Connect and log in to the SMTP server in the background at setup. The connection is kept 
+        alive during the run and reused for the final email, and a rejected login is reported 
+        at once instead of when the program ends. Default is False.
+
+    mail_max_size : int, optional
+        Size limit (in bytes) of one email, base64 encoding included. Most providers accept 20 to 50 MB. 
+        A bigger notification is split into numbered emails sent over one connection, and a large 
+        attachment into volumes 'name.001', 'name.002', ... joined with `cat name.0* > name`. 
+        Default is 20000000 (20 MB), 0 to never split.
+
+    progress_interval : float, optional
+        Time interval (in seconds) between periodic progress mails, sent while the program runs. 
+        Each one carries the output since the previous one, the new add_text() content and the 
+        server status so far. Default is None (only when send_progress() is called).
+
+    progress_burst : int, optional
+        Maximum number of progress mails sent in a burst. Default is 3.
+
+    progress_refill : float, optional
+        Time (in seconds) after which one more progress mail is allowed. Requests beyond this rate 
+        limit are merged into the next progress mail. Default is 600.
+
+    progress_tail_bytes : int, optional
+        Maximum size (in bytes) of the new output carried by a progress mail. Default is 32768.
+
+    smtp_timeout : float, optional
+        Socket timeout (in seconds) of the SMTP connections. Default is 120.
+
+    send_deadline : float, optional
+        The final email is first saved in an outbox under log_root_path, then sent with retries 
+        (exponential backoff with jitter) for at most send_deadline seconds after the program ends. 
+        Messages still unsent are retried by the next run of the same account, by notify.flush_outbox() or by 
+        `python -m notifyemail flush`. Default is 300.
+
+    daemon_socket : str or bool, optional
+        Use the notify daemon of the node (started with `python -m notifyemail daemon`), 
+        True for its default socket path. The daemon samples the system metrics once for all jobs 
+        and sends the final emails over a small pool of reused SMTP connections. If it does not 
+        answer, everything runs locally. Default is None (no daemon).
+
+    capture_children : bool, optional
+        Also capture the output of child processes into the log, each line tagged with the name 
+        and PID of its process: forked multiprocessing workers, spawned workers and Python 
+        subprocesses which import notifyemail, and programs started with notify.popen(). 
+        Default is False.
+
+    capture_mode : str, optional
+        'python' captures what is written to sys.stdout and sys.stderr. 'fd' redirects the file 
+        descriptors 1 and 2 to pipes read by a background thread, so the output of C/C++ extensions, 
+        native libraries, os.system() and child processes is captured too (without tags, 
+        capture_children is not used in this mode). Default is 'python'.
+    
+    Returns
+    -------
+    None
+        Start the notify background process and prints the following information:
+        - The log root path.
+        - The mail user (email account).
+        - The default receiving list for notifications.
+        - The number of logs that will not be auto-deleted.
+    """
+    from .tools import _setup
+    _setup(notify_frontend=_frontend(notify_frontend), *args, **kwargs)
+
+### Add text or files ###
+
+def add_text(text_input, notify_frontend=None):
+    from .tools import _add_text
+    return _add_text(text_input, notify_frontend=_frontend(notify_frontend))
+
+def add_file(file_dir, notify_frontend=None):
+    from .tools import _add_file
+    return _add_file(file_dir, notify_frontend=_frontend(notify_frontend))
+
+def send_progress(note=None, notify_frontend=None):
+    from .tools import _send_progress
+    return _send_progress(note=note, notify_frontend=_frontend(notify_frontend))
+
+def flush_outbox(deadline=None, notify_frontend=None):
+    from .tools import _flush_outbox
+    return _flush_outbox(deadline=deadline, notify_frontend=_frontend(notify_frontend))
+
+def popen(args, name=None, notify_frontend=None, **kwargs):
+    from .tools import _popen
+    return _popen(args, name=name, notify_frontend=_frontend(notify_frontend), **kwargs)
+
+### Compatible functions ###
+
+def Reboost(notify_frontend=None, *args, **kwargs):
+    from .tools import _Reboost
+    _Reboost(notify_frontend=_frontend(notify_frontend), *args, **kwargs)
+
+def send_log(mail_list=None, notify_frontend=None):
+    from .tools import _send_log
+    return _send_log(mail_list=mail_list, notify_frontend=_frontend(notify_frontend))
@@ -0,0 +1,75 @@
+"""
+Command line tools of notifyemail.
+
+    python -m notifyemail flush --log_root_path LOG_ROOT --mail_host HOST --mail_user USER [--mail_pass PASS]
+
+Send the messages left in the outbox of LOG_ROOT by runs of this account (HOST and USER) which could not
+deliver them.
+The password can also be given in the NOTIFYEMAIL_MAIL_PASS environment variable.
+
+    python -m notifyemail daemon [--socket PATH] [--pool_size N]
+
+Run the notify daemon of the node, used by the jobs which call notify.setup(daemon_socket=True).
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from .daemon import NotifyDaemon
+from .outbox import Outbox
+from .smtp_session import SmtpSession
+
+
+def flush(args):
+    outbox_dir = os.path.join(args.log_root_path, '.notify_outbox')
+    if not os.path.isdir(outbox_dir):
+        print('No outbox in', args.log_root_path)
+        return 0
+    mail_pass = args.mail_pass or os.environ.get('NOTIFYEMAIL_MAIL_PASS')
+    if not mail_pass:
+        print('Please give --mail_pass or set NOTIFYEMAIL_MAIL_PASS')
+        return 2
+    outbox = Outbox(outbox_dir)
+    session = SmtpSession(args.mail_host, args.mail_user, mail_pass, mail_port=args.mail_port,
+                          mail_ssl=not args.no_ssl, timeout=args.smtp_timeout)
+    deadline = None if args.deadline is None else time.monotonic() + args.deadline
+    sent, left = outbox.deliver(session.connect, deadline=deadline, force=True, account=(args.mail_host, args.mail_user))
+    print(f'Outbox flushed: {sent} message(s) sent, {left} left.')
+    return 1 if left else 0
+
+
+def daemon(args):
+    NotifyDaemon(args.socket, pool_size=args.pool_size).serve_forever()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m notifyemail')
+    commands = parser.add_subparsers(dest='command')
+    flush_parser = commands.add_parser('flush', help='Send the messages left in the outbox.')
+    flush_parser.add_argument('--log_root_path', required=True)
+    flush_parser.add_argument('--mail_host', required=True)
+    flush_parser.add_argument('--mail_user', required=True)
+    flush_parser.add_argument('--mail_pass', default=None)
+    flush_parser.add_argument('--mail_port', type=int, default=None)
+    flush_parser.add_argument('--no_ssl', action='store_true', help='Use STARTTLS instead of SSL.')
+    flush_parser.add_argument('--smtp_timeout', type=float, default=120)
+    flush_parser.add_argument('--deadline', type=float, default=None,
+                              help='Keep retrying with backoff for at most this many seconds.')
+    daemon_parser = commands.add_parser('daemon', help='Run the notify daemon of the node.')
+    daemon_parser.add_argument('--socket', default=None, help='Unix socket path (default: per-user path in the temp folder).')
+    daemon_parser.add_argument('--pool_size', type=int, default=2, help='SMTP connections per account.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'flush':
+        return flush(args)
+    if args.command == 'daemon':
+        return daemon(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,411 @@
+"""
+Capture of the output of child processes into the run log.
+
+Logger only replaces sys.stdout and sys.stderr of the interpreter which called notify.setup(), so the
+output of multiprocessing workers and subprocesses never reached Log_Cache.log. With
+setup(capture_children=True) a ChildOutputCollector listens on a local socket:
+
+- Forked children (multiprocessing 'fork', os.fork) get their streams replaced by an at-fork hook.
+- Spawned multiprocessing children connect before they unpickle their task, through a line added to
+  their start command.
+- Other Python subprocesses find the collector address in the NOTIFYEMAIL_CHILD_CAPTURE environment
+  variable and connect when they import notifyemail.
+- Other programs are started with notify.popen(), which sends their stdout and stderr through a pipe.
+
+A single reader thread multiplexes all connections and pipes with a selector and writes the output
+into the log, every line tagged with the name and PID of its process. Children never wait on it:
+their output is queued in memory and sent by a background thread.
+"""
+
+import atexit
+import collections
+import os
+import secrets
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ENV_NAME = 'NOTIFYEMAIL_CHILD_CAPTURE'
+
+_collector = None  # The collector of this process, if capture_children is on
+_connection = None  # The connection of this process to the collector of its parent
+
+
+class ChildSource(object):
+    """A connection or pipe read by the collector, with its unfinished last line.
+    """
+
+    __slots__ = ('stream', 'tag', 'tee', 'partial')
+
+    def __init__(self, stream, tag=None, tee=False):
+        self.stream = stream
+        self.tag = tag  # None until the header of a connection is received
+        self.tee = tee  # Also copy the output to the terminal (pipes, whose process has no terminal of its own)
+        self.partial = b''
+
+
+class ChildOutputCollector(object):
+    """
+    Gather the output of child processes into a LogWriter, each line tagged with '[name pid] '.
+
+    Inputs:
+    - log_writer : LogWriter
+        The writer of Log_Cache.log.
+
+    - terminal : file, optional
+        Where the output of the processes started with popen() is copied to. Default is None (sys.__stdout__).
+
+    - max_line : int, optional
+        An unfinished line longer than this (in bytes) is written out as it is. Default is 65536.
+    """
+
+    read_size = 64 * 1024
+
+    def __init__(self, log_writer, terminal=None, max_line=65536):
+        self.log_writer = log_writer
+        self.terminal = terminal if terminal is not None else sys.__stdout__
+        self.max_line = max_line
+        self.token = secrets.token_hex(8)  # Children prove they were started by this run
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.address = '127.0.0.1:%d:%s:%d' % (self.listener.getsockname()[1], self.token, os.getpid())
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.wakeup_read, self.wakeup_write = socket.socketpair()
+        self.wakeup_read.setblocking(False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+        self.new_pipes = collections.deque()  # Sources added by other threads, registered by the reader
+        self.sources = {}  # File descriptor -> ChildSource
+        self.stopping = False
+        self.linger = 0.5
+        self.stop_deadline = None
+        self.lines = 0
+        self.bytes = 0
+        self.thread = threading.Thread(target=self.run, name='notify-child-capture', daemon=True)
+
+    def start(self):
+        """Start the reader and publish the address to the child processes.
+        """
+        global _collector
+        self.thread.start()
+        os.environ[ENV_NAME] = self.address
+        _collector = self
+        _patch_spawn_command_line()
+
+    def popen(self, args, name=None, **kwargs):
+        """
+        subprocess.Popen() whose stdout (and stderr, unless given) goes to the run log.
+
+        Parameters
+        ----------
+        args : str or list
+            The program and its arguments, as for subprocess.Popen().
+
+        name : str, optional
+            The tag of the output lines. Default is None (the program name).
+
+        **kwargs : optional
+            Other subprocess.Popen() arguments.
+
+        Returns
+        -------
+        subprocess.Popen
+        """
+        read_fd, write_fd = os.pipe()
+        kwargs.setdefault('stderr', subprocess.STDOUT)
+        try:
+            process = subprocess.Popen(args, stdout=write_fd, **kwargs)
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)  # The child holds the only write end, so the pipe ends with the child
+        if name is None:
+            program = args if isinstance(args, str) else args[0]
+            name = os.path.basename(str(program).split()[0])
+        self.new_pipes.append(ChildSource(os.fdopen(read_fd, 'rb', buffering=0), tag=name + ' %d' % process.pid, tee=True))
+        self.wakeup_write.send(b'\0')
+        return process
+
+    def run(self):
+        idle_since = None
+        while True:
+            timeout = 0.1 if self.stopping else None
+            events = self.selector.select(timeout)
+            while self.new_pipes:
+                source = self.new_pipes.popleft()
+                self.sources[source.stream.fileno()] = source
+                self.selector.register(source.stream, selectors.EVENT_READ, source)
+            for key, mask in events:
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wakeup_read:
+                    try:
+                        self.wakeup_read.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.read(key.data)
+            if self.stopping:
+                # Wait for the children which are still alive to send what they have queued
+                if events or idle_since is None:
+                    idle_since = time.monotonic()
+                if not self.sources or time.monotonic() - idle_since > self.linger \
+                        or time.monotonic() > self.stop_deadline:
+                    break
+        for source in list(self.sources.values()):
+            self.remove(source)
+        self.selector.close()
+        self.listener.close()
+        self.wakeup_read.close()
+        self.wakeup_write.close()
+
+    def accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        source = ChildSource(sock)
+        self.sources[sock.fileno()] = source
+        self.selector.register(sock, selectors.EVENT_READ, source)
+
+    def read(self, source):
+        try:
+            if isinstance(source.stream, socket.socket):
+                data = source.stream.recv(self.read_size)
+            else:
+                data = os.read(source.stream.fileno(), self.read_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.remove(source)
+            return
+
+        if source.tag is None:  # Header of a connection: 'token name pid\n'
+            data = source.partial + data
+            end = data.find(b'\n')
+            if end < 0:
+                source.partial = data
+                if len(data) > 1024:
+                    self.remove(source)
+                return
+            token, _, tag = data[:end].decode('utf-8', 'replace').partition(' ')
+            if token != self.token:
+                source.partial = b''
+                self.remove(source)
+                return
+            source.tag = tag
+            source.partial = b''
+            data = data[end + 1:]
+            if not data:
+                return
+        elif source.tee:
+            self.terminal.write(data.decode('utf-8', 'replace'))
+            self.terminal.flush()
+
+        data = source.partial + data
+        end = data.rfind(b'\n') + 1
+        if end == 0 and len(data) > self.max_line:
+            end = len(data)  # A very long line, e.g. a progress bar redrawn with '\r'
+        source.partial = data[end:]
+        if end:
+            self.write_lines(source, data[:end])
+
+    def write_lines(self, source, data):
+        prefix = b'[' + source.tag.encode('utf-8', 'replace') + b'] '
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        lines = data.count(b'\n')
+        self.lines += lines
+        self.bytes += len(data)
+        # One replace() tags all the lines of the chunk
+        data = prefix + data[:-1].replace(b'\n', b'\n' + prefix) + b'\n'
+        self.log_writer.write(data.decode('utf-8', 'replace'))
+
+    def remove(self, source):
+        if source.partial and source.tag is not None:
+            self.write_lines(source, source.partial)
+        source.partial = b''
+        self.sources.pop(source.stream.fileno(), None)
+        try:
+            self.selector.unregister(source.stream)
+        except (KeyError, ValueError):
+            pass
+        source.stream.close()
+
+    def close(self, linger=0.5, timeout=5.0):
+        """
+        Stop reading once the children are done, before the log is closed.
+
+        Parameters
+        ----------
+        linger : float, optional
+            Keep reading while children still send something, until they are quiet for this time (in seconds). Default is 0.5.
+
+        timeout : float, optional
+            Stop after this time (in seconds) anyway, e.g. when pool workers stay alive. Default is 5.0.
+        """
+        global _collector
+        if _collector is self:
+            _collector = None
+            if os.environ.get(ENV_NAME) == self.address:
+                del os.environ[ENV_NAME]
+        if not self.thread.is_alive():
+            return
+        self.linger = linger
+        self.stop_deadline = time.monotonic() + timeout
+        self.stopping = True
+        self.wakeup_write.send(b'\0')
+        self.thread.join()
+
+
+class ChildConnection(object):
+    """
+    Output of a child process queued in memory and sent to the collector of its parent by a background thread.
+
+    A write only appends to the queue and wakes the sender up. The sender takes everything queued while
+    it was busy in one send, so chatty processes send large chunks and quiet ones are not delayed.
+
+    Inputs:
+    - address : str
+        The collector address 'host:port:token:parent pid'.
+    """
+
+    def __init__(self, address):
+        host, port, self.token, _ = address.split(':')
+        self.server_address = (host, int(port))
+        self.pid = os.getpid()
+        self.sock = None
+        self.broken = False  # The collector is gone, the output is only kept on the terminal
+        self.buffer = collections.deque()
+        self.send_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def write(self, data):
+        if self.broken:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.send_loop, name='notify-child-output', daemon=True)
+            self.thread.start()
+        self.buffer.append(data)
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def send_loop(self):
+        while not self.broken:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.flush()
+
+    def connect(self):
+        # The process name is known only once multiprocessing has set up the child, so the header is sent here
+        import multiprocessing
+        name = multiprocessing.current_process().name
+        if name == 'MainProcess':
+            name = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'python'
+        sock = socket.create_connection(self.server_address, timeout=5)
+        sock.sendall(('%s %s %d\n' % (self.token, name, self.pid)).encode('utf-8'))
+        return sock
+
+    def flush(self):
+        with self.send_lock:
+            pending = [self.buffer.popleft() for _ in range(len(self.buffer))]
+            if not pending or self.broken:
+                return
+            try:
+                if self.sock is None:
+                    self.sock = self.connect()
+                self.sock.sendall(''.join(pending).encode('utf-8', 'replace'))
+            except OSError:
+                self.broken = True
+                if self.sock is not None:
+                    self.sock.close()
+
+
+class ChildStream(object):
+    """Stream of a child process, written to its terminal and to its ChildConnection.
+    """
+
+    def __init__(self, connection, terminal):
+        self.connection = connection
+        self.terminal = terminal
+
+    def write(self, message):
+        if self.terminal is not None:
+            self.terminal.write(message)
+        self.connection.write(message)
+
+    def flush(self):
+        if self.terminal is not None:
+            self.terminal.flush()
+        self.connection.flush()
+
+
+def install_child_streams(address):
+    """Send sys.stdout and sys.stderr of this process to the collector at `address` as well.
+    """
+    global _connection
+    _connection = ChildConnection(address)
+    sys.stdout = ChildStream(_connection, sys.__stdout__)
+    sys.stderr = ChildStream(_connection, sys.__stderr__)
+    atexit.register(_connection.flush)
+
+
+def install_from_environ():
+    """Called at import: connect this process to the collector of its parent, if the parent captures children.
+    """
+    address = os.environ.get(ENV_NAME)
+    if not address or _connection is not None:
+        return
+    try:
+        parent_pid = int(address.rsplit(':', 1)[1])
+    except (IndexError, ValueError):
+        return
+    if parent_pid != os.getpid():
+        install_child_streams(address)
+
+
+def _patch_spawn_command_line():
+    """Make spawned multiprocessing children connect first, even if their main module does not import notifyemail.
+    """
+    from multiprocessing import spawn
+    if getattr(spawn.get_command_line, 'notifyemail_capture', False):
+        return
+    get_command_line = spawn.get_command_line
+
+    def get_capturing_command_line(**kwds):
+        command = get_command_line(**kwds)
+        if '-c' in command:  # Not frozen: [python, options, '-c', code, '--multiprocessing-fork']
+            index = command.index('-c') + 1
+            command[index] = 'try:\n    from notifyemail.child_capture import install_from_environ\n' \
+                             '    install_from_environ()\nexcept ImportError:\n    pass\n' + command[index]
+        return command
+
+    get_capturing_command_line.notifyemail_capture = True
+    spawn.get_command_line = get_capturing_command_line
+
+
+def _after_fork_in_child():
+    global _collector
+    if _collector is not None:  # Forked from the process which captures children
+        address, _collector = _collector.address, None
+    elif _connection is not None and _connection.pid != os.getpid():  # Forked from a captured child
+        address = _connection.server_address[0] + ':%d:%s:0' % (_connection.server_address[1], _connection.token)
+    else:
+        return
+    install_child_streams(address)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,463 @@
+import bz2
+import collections
+import hashlib
+import json
+import math
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+
+# Files of these types are compressed already, deflating them again costs CPU for almost no size gain.
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.7z', '.rar',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov',
+    '.npz', '.pt', '.pth', '.ckpt', '.h5', '.hdf5', '.parquet', '.pdf', '.docx', '.xlsx', '.pptx',
+}
+
+ZIP_CODECS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+
+
+def sample_entropy(file_path, sample_size=64 * 1024):
+    """Shannon entropy (bits per byte) of the beginning of a file. Compressed or random data is close to 8.
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_size)
+    if not sample:
+        return 0.0
+    entropy = 0.0
+    for count in collections.Counter(sample).values():
+        p = count / len(sample)
+        entropy -= p * math.log2(p)
+    return entropy
+
+
+def get_compressor(codec, compresslevel=None):
+    """Raw compressor of a zip member, as zipfile creates it. compresslevel is ignored by lzma.
+    """
+    if codec == 'deflate':
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    elif codec == 'bzip2':
+        if compresslevel is None:
+            compresslevel = 9
+        return bz2.BZ2Compressor(compresslevel)
+    elif codec == 'lzma':
+        return zipfile.LZMACompressor()  # Writes the LZMA properties header required by the zip format
+    return None
+
+
+class CompressedMember(object):
+    """
+    A file compressed by a worker, waiting to be written into the zip archive.
+
+    The compressed data is kept in memory for small files and spooled to a temporary file for large ones.
+    """
+
+    def __init__(self, zinfo, codec, seconds, data=None, spool_path=None, source_path=None, blob_path=None,
+                 cached=False):
+        self.zinfo = zinfo
+        self.codec = codec  # Name of the codec, a key of ZIP_CODECS
+        self.seconds = seconds  # Time spent on compressing this member
+        self.data = data
+        self.spool_path = spool_path
+        self.source_path = source_path  # Stored members are copied from the source file directly
+        self.blob_path = blob_path  # Compressed data kept by MemberCache, copied but not removed
+        self.cached = cached  # Taken from MemberCache instead of being compressed
+
+    def write_to(self, fp):
+        """Write the compressed data. Stored members are written by ParallelZipper.write_member() instead.
+        """
+        if self.blob_path is not None:
+            with open(self.blob_path, 'rb') as f:
+                shutil.copyfileobj(f, fp, 1024 * 1024)
+        elif self.spool_path is None:
+            fp.write(self.data)
+        else:
+            with open(self.spool_path, 'rb') as f:
+                shutil.copyfileobj(f, fp, 1024 * 1024)
+            os.remove(self.spool_path)
+
+
+class CompressTask(object):
+    """A file waiting to be compressed by a worker thread.
+    """
+
+    def __init__(self, file_path, arcname):
+        self.file_path = file_path
+        self.arcname = arcname
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class MemberCache(object):
+    """
+    Persistent cache of compressed zip members, so unchanged files are not compressed again in the next run.
+
+    A member is identified by its path, size and modification time (or by the SHA-1 of its content if
+    hash_content is set, then identical files share one entry), together with the compression settings.
+    Compressed data is kept as one blob file per member next to index.json, and the least recently used
+    entries are evicted once the blobs exceed max_size bytes.
+
+    Inputs:
+    - cache_dir : str
+        The cache directory, created if missing.
+
+    - max_size : int, optional
+        Size budget (in bytes) of the cached blobs. Default is 1 GB.
+
+    - hash_content : bool, optional
+        Identify files by the SHA-1 of their content, which also catches changes that keep size and
+        modification time. Default is False.
+    """
+
+    def __init__(self, cache_dir, max_size=1024 ** 3, hash_content=False):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_size = max_size
+        self.hash_content = hash_content
+        self.lock = threading.Lock()
+        self.hits = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.index = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def make_key(self, file_path, settings):
+        """Cache key of a file compressed with the given settings (a string describing the zipper setup).
+        """
+        if self.hash_content:
+            digest = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for data in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(data)
+            identity = 'sha1:' + digest.hexdigest()
+        else:
+            st = os.stat(file_path)
+            identity = '%s|%d|%d' % (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+        return hashlib.sha1((identity + '|' + settings).encode('utf-8')).hexdigest()
+
+    def blob_path(self, key):
+        return os.path.join(self.cache_dir, key + '.bin')
+
+    def get(self, key):
+        """Return the cached entry (a dict) of key, or None.
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            if entry['codec'] != 'store' and not os.path.exists(self.blob_path(key)):
+                del self.index[key]  # Evicted by another run
+                return None
+            entry['last_used'] = time.time()
+            self.hits += 1
+            return entry
+
+    def put(self, key, member):
+        """Keep the compressed data of member, which then refers to the cached blob.
+        """
+        zinfo = member.zinfo
+        if member.codec != 'store':
+            blob_path = self.blob_path(key)
+            if member.spool_path is not None:
+                shutil.move(member.spool_path, blob_path)
+                member.spool_path = None
+            else:
+                with open(blob_path, 'wb') as f:
+                    f.write(member.data)
+                member.data = None
+            member.blob_path = blob_path
+        with self.lock:
+            self.index[key] = {'codec': member.codec, 'CRC': zinfo.CRC, 'file_size': zinfo.file_size,
+                               'compress_size': zinfo.compress_size if member.codec != 'store' else 0,
+                               'last_used': time.time()}
+
+    def save(self):
+        """Merge with the index on disk (other runs may have changed it), evict, and write it back.
+        """
+        with self.lock:
+            index = self.load_index()
+            for key, entry in self.index.items():
+                if key not in index or index[key]['last_used'] < entry['last_used']:
+                    index[key] = entry
+
+            # Evict the least recently used blobs over the size budget
+            total_size = sum(entry['compress_size'] for entry in index.values())
+            for key in sorted(index, key=lambda k: index[k]['last_used']):
+                if total_size <= self.max_size:
+                    break
+                total_size -= index[key]['compress_size']
+                del index[key]
+                if os.path.exists(self.blob_path(key)):
+                    os.remove(self.blob_path(key))
+
+            temp_path = self.index_path + '.%d.tmp' % os.getpid()
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(temp_path, self.index_path)
+            self.index = index
+
+
+class ParallelZipper(object):
+    """
+    Compress files into a zip archive with a pool of worker threads.
+
+    zlib releases the GIL while compressing, so the members of a folder are compressed concurrently on
+    several cores. The main thread writes the compressed members into the archive in the original order,
+    and zipfile writes the central directory (with zip64 records when needed), so the result is a normal zip.
+
+    Inputs:
+    - workers : int, optional
+        Number of compressing threads. Default is None (the number of CPUs).
+
+    - codec : str, optional
+        Codec of the compressible files: 'deflate', 'bzip2' or 'lzma'. Files with a known compressed type
+        (see INCOMPRESSIBLE_EXTENSIONS) or a sampled entropy above entropy_threshold are always stored.
+        Default is 'deflate'.
+
+    - fast : bool, optional
+        Fast codec mode, use deflate at level 1 for every compressible file. Default is False.
+
+    - entropy_threshold : float, optional
+        Files whose first 64 KB have a higher entropy (bits per byte) are stored. Default is 7.5.
+
+    - compresslevel : int, optional
+        Level of deflate and bzip2, from 1 (fastest) to 9 (smallest), None for the codec default (as in
+        zipfile). lzma has no level. Default is 6.
+
+    - spool_dir : str, optional
+        Where compressed members larger than memory_limit are kept before being written into the archive.
+        Default is None (the system temporary directory).
+
+    - memory_limit : int, optional
+        Compressed members up to this size (in bytes) are kept in memory. Default is 1 MB.
+
+    - cache : MemberCache, optional
+        Reuse members compressed in previous runs. Default is None (no cache).
+    """
+
+    read_size = 1024 * 1024  # Bytes read from the source file per step
+
+    def __init__(self, workers=None, codec='deflate', fast=False, entropy_threshold=7.5,
+                 compresslevel=6, spool_dir=None, memory_limit=1024 * 1024, cache=None):
+        if codec not in ZIP_CODECS:
+            raise ValueError(f'codec should be one of {list(ZIP_CODECS)}, got {codec}')
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.codec = 'deflate' if fast else codec
+        self.compresslevel = 1 if fast else compresslevel
+        self.entropy_threshold = entropy_threshold
+        self.spool_dir = spool_dir
+        self.memory_limit = memory_limit
+        self.cache = cache
+        # Compression settings, part of the cache key
+        self.settings = '%s|%s|%s' % (self.codec, self.compresslevel, self.entropy_threshold)
+
+    def zip_path(self, src_path, out_path):
+        """
+        Compress a file or a folder into out_path.
+
+        Parameters
+        ----------
+        src_path : str
+            The file or folder to compress. Files of a folder are stored relative to the folder.
+
+        out_path : str
+            The zip file to create.
+
+        Returns
+        -------
+        dict
+            Statistics: 'files', 'bytes_in', 'bytes_out', 'seconds', and 'codecs' with the same
+            statistics for each codec used ('seconds' being the compressing time spent by the workers).
+            'cached' counts the members taken from the cache.
+        """
+        start_time = time.time()
+        members = self.list_members(src_path)
+
+        stats = {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'codecs': {}, 'cached': 0}
+        spool = tempfile.mkdtemp(prefix='notify_zip_', dir=self.spool_dir)
+        tasks = queue.Queue(maxsize=self.workers * 4)  # Bounded, so memory does not grow with the folder size
+        pending = collections.deque()
+
+        # Plain threads instead of concurrent.futures: the backend zips after the interpreter started
+        # shutting down, when executors refuse new work.
+        threads = [threading.Thread(target=self.worker_loop, args=(tasks, spool), daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            with zipfile.ZipFile(out_path, 'w', allowZip64=True) as zip_file:
+                for file_path, arcname in members:
+                    if len(pending) >= self.workers * 4:
+                        self.write_member(zip_file, pending.popleft().wait(), stats)
+                    task = CompressTask(file_path, arcname)
+                    pending.append(task)
+                    tasks.put(task)
+                while pending:
+                    self.write_member(zip_file, pending.popleft().wait(), stats)
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+            shutil.rmtree(spool, ignore_errors=True)
+            if self.cache is not None:
+                self.cache.save()
+        stats['seconds'] = time.time() - start_time
+        return stats
+
+    def worker_loop(self, tasks, spool):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            try:
+                task.result = self.get_member(task.file_path, task.arcname, spool)
+            except Exception as e:
+                task.error = e
+            task.done.set()
+
+    def list_members(self, src_path):
+        """Yield (file path, name in the archive) of every file to compress.
+        """
+        if os.path.isdir(src_path):
+            for path, dirnames, filenames in os.walk(src_path):
+                fpath = path.replace(src_path, '')  # Child folder
+                for filename in filenames:
+                    yield os.path.join(path, filename), os.path.join(fpath, filename)
+        elif os.path.isfile(src_path):
+            yield src_path, os.path.basename(src_path)
+
+    def get_member(self, file_path, arcname, spool):
+        """Take the member from the cache, or compress it (and put it into the cache).
+        """
+        if self.cache is None:
+            return self.compress_member(file_path, arcname, spool)
+
+        key = self.cache.make_key(file_path, self.settings)
+        entry = self.cache.get(key)
+        if entry is None:
+            member = self.compress_member(file_path, arcname, spool)
+            self.cache.put(key, member)
+            return member
+
+        zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+        zinfo.compress_type = ZIP_CODECS[entry['codec']]
+        zinfo.CRC = entry['CRC']
+        zinfo.file_size = entry['file_size']
+        if entry['codec'] == 'store':
+            zinfo.compress_size = entry['file_size']
+            return CompressedMember(zinfo, 'store', 0.0, source_path=file_path, cached=True)
+        zinfo.compress_size = entry['compress_size']
+        return CompressedMember(zinfo, entry['codec'], 0.0, blob_path=self.cache.blob_path(key), cached=True)
+
+    def choose_codec(self, file_path):
+        """Store the files which are compressed already, use the configured codec for the others.
+        """
+        if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return 'store'
+        if sample_entropy(file_path) > self.entropy_threshold:
+            return 'store'
+        return self.codec
+
+    def compress_member(self, file_path, arcname, spool):
+        """Compress one file (runs in a worker thread).
+        """
+        start_time = time.time()
+        codec = self.choose_codec(file_path)
+        zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+        zinfo.compress_type = ZIP_CODECS[codec]
+        compressor = get_compressor(codec, self.compresslevel)
+
+        crc = 0
+        file_size = 0
+        chunks = []
+        chunks_size = 0
+        spool_file = None
+        with open(file_path, 'rb') as f:
+            while True:
+                data = f.read(self.read_size)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+                if compressor is None:
+                    continue  # Stored, only the CRC is needed
+                compressed = compressor.compress(data)
+                if compressed:
+                    chunks.append(compressed)
+                    chunks_size += len(compressed)
+                if chunks_size > self.memory_limit:
+                    if spool_file is None:
+                        spool_file = tempfile.NamedTemporaryFile(dir=spool, delete=False)
+                    spool_file.write(b''.join(chunks))
+                    chunks = []
+                    chunks_size = 0
+
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        if compressor is None:
+            zinfo.compress_size = file_size
+            return CompressedMember(zinfo, codec, time.time() - start_time, source_path=file_path)
+        chunks.append(compressor.flush())
+        if spool_file is None:
+            data = b''.join(chunks)
+            zinfo.compress_size = len(data)
+            return CompressedMember(zinfo, codec, time.time() - start_time, data=data)
+        spool_file.write(b''.join(chunks))
+        zinfo.compress_size = spool_file.tell()
+        spool_file.close()
+        return CompressedMember(zinfo, codec, time.time() - start_time, spool_path=spool_file.name)
+
+    def write_member(self, zip_file, member, stats):
+        """Write a compressed member into the archive (runs in the main thread).
+        """
+        zinfo = member.zinfo
+        if member.source_path is not None:
+            # Stored members are read from the source again, a live log may have changed since its CRC was
+            # computed. zipfile computes the CRC and the sizes of the data actually written.
+            with open(member.source_path, 'rb') as src, zip_file.open(zinfo, 'w') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        else:
+            # zipfile has no public way to add data compressed already, the member is added as
+            # ZipFile.open(zinfo, 'w') does, with the sizes and CRC known beforehand.
+            zinfo.header_offset = zip_file.fp.tell()
+            zip_file.fp.write(zinfo.FileHeader())
+            member.write_to(zip_file.fp)
+            zip_file.filelist.append(zinfo)
+            zip_file.NameToInfo[zinfo.filename] = zinfo
+            zip_file.start_dir = zip_file.fp.tell()
+            zip_file._didModify = True  # Let ZipFile.close() write the central directory
+
+        codec_stats = stats['codecs'].setdefault(member.codec, {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0})
+        for item in [stats, codec_stats]:
+            item['files'] += 1
+            item['bytes_in'] += zinfo.file_size
+            item['bytes_out'] += zinfo.compress_size
+        codec_stats['seconds'] += member.seconds
+        stats['cached'] += member.cached
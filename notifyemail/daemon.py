@@ -0,0 +1,352 @@
+"""
+Host-wide notify daemon.
+
+Many jobs on one node can share a single daemon instead of each running its own system monitor and
+SMTP login. A job registers over a Unix socket when notify.setup() runs with daemon_socket. The
+daemon samples the system metrics once for all jobs and returns each job its statistics for the
+job's own time window. When the job ends, it writes its email to its outbox and hands the item over.
+The daemon then sends the email over a small pool of reused SMTP connections.
+
+Start it with:
+
+    python -m notifyemail daemon [--socket PATH]
+"""
+
+import heapq
+import json
+import os
+import smtplib
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+import psutil
+
+from .monitor import MetricAggregator, Sampler, create_collectors
+from .outbox import Outbox
+from .smtp_session import SmtpSession
+
+# Collectors whose metrics do not depend on the job, sampled once by the daemon
+SYSTEM_COLLECTORS = ['cpu', 'mem', 'disk_io', 'net', 'load', 'swap']
+
+
+def default_socket_path():
+    """Per-user socket path in the temporary folder.
+    """
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), 'notifyemail-%s.sock' % uid)
+
+
+class DaemonClient(object):
+    """
+    Talk to the notify daemon: one JSON request line and one JSON reply line per connection.
+
+    Inputs:
+    - socket_path : str, optional
+        The daemon socket. Default is None (default_socket_path()).
+
+    - timeout : float, optional
+        Socket timeout (in seconds). Default is 5.
+    """
+
+    def __init__(self, socket_path=None, timeout=5.0):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+
+    def request(self, op, **fields):
+        """Send a request, return the reply. Raise OSError if the daemon cannot be reached or fails.
+        """
+        fields['op'] = op
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(fields).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+        if not line:
+            raise OSError('The notify daemon closed the connection')
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise OSError('The notify daemon failed: %s' % reply.get('error'))
+        return reply
+
+    def available(self):
+        try:
+            self.request('ping')
+        except (OSError, ValueError):
+            return False
+        return True
+
+
+class SmtpPool(object):
+    """
+    Logged-in SMTP connections reused across emails, at most `size` per account.
+
+    Inputs:
+    - size : int, optional
+        Maximum number of connections per account. Default is 2.
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self.idle = {}  # Account key -> idle connections
+        self.slots = {}  # Account key -> semaphore bounding the open connections
+        self.lock = threading.Lock()
+        self.logins = 0
+
+    @staticmethod
+    def account_key(settings):
+        return tuple(settings.get(key) for key in ('mail_host', 'mail_port', 'mail_ssl', 'mail_user', 'mail_pass'))
+
+    def acquire(self, settings):
+        """Return (account key, connection): an idle connection which still answers NOOP, or a new one.
+        """
+        key = self.account_key(settings)
+        with self.lock:
+            slots = self.slots.setdefault(key, threading.BoundedSemaphore(self.size))
+        slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    idle = self.idle.get(key)
+                    smtp = idle.pop() if idle else None
+                if smtp is None:
+                    break
+                try:
+                    if smtp.noop()[0] == 250:
+                        return key, smtp
+                except (smtplib.SMTPException, OSError):
+                    pass
+                SmtpSession.close_quietly(smtp)
+            session = SmtpSession(settings['mail_host'], settings['mail_user'], settings['mail_pass'],
+                                  mail_port=settings.get('mail_port'), mail_ssl=settings.get('mail_ssl', True),
+                                  timeout=settings.get('smtp_timeout', 120))
+            smtp = session.connect()
+            self.logins += 1
+            return key, smtp
+        except BaseException:
+            slots.release()
+            raise
+
+    def release(self, key, smtp, broken=False):
+        if broken:
+            SmtpSession.close_quietly(smtp)
+        else:
+            with self.lock:
+                self.idle.setdefault(key, []).append(smtp)
+        self.slots[key].release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for smtp in connections:
+                try:
+                    smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    SmtpSession.close_quietly(smtp)
+
+
+class DaemonJob(object):
+    """A registered job: its pid and the system statistics since it registered.
+    """
+
+    def __init__(self, job_id, pid):
+        self.job_id = job_id
+        self.pid = pid
+        self.aggregators = {}
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            reply = self.server.notify_daemon.handle_request(request)
+            reply['ok'] = True
+        except Exception as e:
+            reply = {'ok': False, 'error': repr(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class NotifyDaemon(object):
+    """
+    The notify daemon: shared system sampling and email delivery for the jobs of one node.
+
+    Inputs:
+    - socket_path : str, optional
+        The Unix socket to listen on. Default is None (default_socket_path()).
+
+    - pool_size : int, optional
+        Maximum number of SMTP connections per account. Default is 2.
+
+    - monitor_intervals : dict, optional
+        Time interval (in seconds) between samples of each system collector. Default is None (collector defaults).
+
+    - max_attempts : int, optional
+        Delivery attempts of an email before it is left in the outbox of its job. Default is 8.
+    """
+
+    def __init__(self, socket_path=None, pool_size=2, monitor_intervals=None, max_attempts=8):
+        self.socket_path = socket_path or default_socket_path()
+        self.pool = SmtpPool(pool_size)
+        self.max_attempts = max_attempts
+        self.jobs = {}
+        self.lock = threading.Lock()  # Guards self.jobs and their aggregators
+        self.stop_event = threading.Event()
+        self.sampler = Sampler(create_collectors(SYSTEM_COLLECTORS, monitor_intervals), self.on_sample)
+        self.last_prune = time.monotonic()
+
+        # Delivery queue: (due time, sequence, item path, smtp settings, attempts)
+        self.deliveries = []
+        self.sequence = 0
+        self.delivery_ready = threading.Condition()
+        self.workers = [threading.Thread(target=self.delivery_loop, name='notify-daemon-send', daemon=True)
+                        for _ in range(pool_size)]
+        self.sent = 0
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            if DaemonClient(self.socket_path).available():
+                raise RuntimeError('A notify daemon is already listening on %s' % self.socket_path)
+            os.remove(self.socket_path)  # Left by a daemon which did not exit cleanly
+        self.server = DaemonServer(self.socket_path, DaemonRequestHandler)
+        self.server.notify_daemon = self
+        os.chmod(self.socket_path, 0o600)  # The requests carry SMTP credentials
+
+        threading.Thread(target=self.sampler.run, args=(self.stop_event,), name='notify-daemon-sampler',
+                         daemon=True).start()
+        for worker in self.workers:
+            worker.start()
+        print('notify daemon listening on', self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop_event.set()
+            with self.delivery_ready:
+                self.delivery_ready.notify_all()
+            self.server.server_close()
+            self.pool.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    '''
+    Shared sampling
+    '''
+
+    def on_sample(self, collector, values, timestamp):
+        with self.lock:
+            for job in self.jobs.values():
+                for key, value in values.items():
+                    if key not in job.aggregators:
+                        job.aggregators[key] = MetricAggregator(key)
+                    job.aggregators[key].add(value)
+            if time.monotonic() - self.last_prune > 60:
+                self.last_prune = time.monotonic()
+                for job_id in [job_id for job_id, job in self.jobs.items() if not psutil.pid_exists(job.pid)]:
+                    del self.jobs[job_id]  # The job died without finishing
+
+    '''
+    Requests
+    '''
+
+    def handle_request(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            with self.lock:
+                return {'jobs': len(self.jobs), 'sent': self.sent, 'logins': self.pool.logins}
+        if op == 'register':
+            with self.lock:
+                self.jobs[request['job']] = DaemonJob(request['job'], request['pid'])
+            return {'collectors': SYSTEM_COLLECTORS}
+        if op == 'report':  # Means of the report period which just ended
+            with self.lock:
+                job = self.jobs[request['job']]
+                periods = {key: aggregator.end_period() for key, aggregator in job.aggregators.items()}
+            return {'periods': {key: period.mean for key, period in periods.items() if period.count}}
+        if op == 'finish':  # Statistics of the whole job
+            with self.lock:
+                job = self.jobs.pop(request['job'])
+                return {'states': {key: aggregator.state() for key, aggregator in job.aggregators.items()}}
+        if op == 'submit':
+            item_path = request['item']
+            if not Outbox.claim(item_path):
+                return {'queued': False}  # Being sent by another process, or sent already
+            self.schedule_delivery(item_path, request['smtp'], 0, 0.0)
+            return {'queued': True}
+        raise ValueError('Unknown request %r' % op)
+
+    '''
+    Delivery
+    '''
+
+    def schedule_delivery(self, item_path, settings, attempts, delay):
+        with self.delivery_ready:
+            self.sequence += 1
+            heapq.heappush(self.deliveries, (time.monotonic() + delay, self.sequence, item_path, settings, attempts))
+            self.delivery_ready.notify()
+
+    def delivery_loop(self):
+        while not self.stop_event.is_set():
+            with self.delivery_ready:
+                if not self.deliveries:
+                    self.delivery_ready.wait()
+                    continue
+                due_time = self.deliveries[0][0]
+                if due_time > time.monotonic():
+                    self.delivery_ready.wait(due_time - time.monotonic())
+                    continue
+                due_time, sequence, item_path, settings, attempts = heapq.heappop(self.deliveries)
+            self.deliver(item_path, settings, attempts)
+
+    def deliver(self, item_path, settings, attempts):
+        if not os.path.exists(item_path):
+            return  # Sent by someone else meanwhile
+        outbox = Outbox(os.path.dirname(item_path))
+        try:
+            key, smtp = self.pool.acquire(settings)
+        except smtplib.SMTPAuthenticationError as e:
+            print('Login rejected, %s is left in its outbox: %s' % (item_path, e))
+            Outbox.release(item_path)
+            return
+        except (smtplib.SMTPException, OSError) as e:
+            self.retry(outbox, item_path, settings, attempts, e)
+            return
+        try:
+            outbox.send_item(item_path, smtp)
+        except smtplib.SMTPServerDisconnected as e:
+            self.pool.release(key, smtp, broken=True)
+            self.retry(outbox, item_path, settings, attempts, e)
+        except smtplib.SMTPException as e:  # Before OSError, its base class
+            self.pool.release(key, smtp)
+            if outbox.is_permanent(e):
+                outbox.move_to_failed(item_path, e)
+            else:
+                self.retry(outbox, item_path, settings, attempts, e)
+        except OSError as e:
+            self.pool.release(key, smtp, broken=True)
+            self.retry(outbox, item_path, settings, attempts, e)
+        else:
+            self.pool.release(key, smtp)
+            with self.lock:
+                self.sent += 1
+
+    def retry(self, outbox, item_path, settings, attempts, error):
+        outbox.record_failure([item_path], error)
+        if attempts + 1 >= self.max_attempts:
+            print('Giving up %s after %s attempts, it is left in its outbox: %r' % (item_path, attempts + 1, error))
+            Outbox.release(item_path)
+            return
+        self.schedule_delivery(item_path, settings, attempts + 1, outbox.backoff(attempts + 1))
@@ -0,0 +1,133 @@
+"""
+File-descriptor-level capture of stdout and stderr.
+
+Logger replaces sys.stdout and sys.stderr, so output written straight to file descriptors 1 and 2
+(C/C++ extensions, native libraries, os.system(), child processes) never reaches it. FdCapture points
+these descriptors at pipes with dup2(). For each stream a reader thread copies everything to the
+original terminal and into the LogWriter of Log_Cache.log, with large reads.
+"""
+
+import codecs
+import os
+import sys
+import threading
+import time
+
+F_SETPIPE_SZ = 1031  # Linux fcntl command, not exposed by the fcntl module before Python 3.10
+
+
+class FdStreamCapture(object):
+    """
+    Capture of one file descriptor.
+
+    Inputs:
+    - fd : int
+        The captured file descriptor, 1 or 2.
+
+    - log_writer : LogWriter
+        The writer of Log_Cache.log.
+
+    - read_size : int, optional
+        Maximum size (in bytes) of one read from the pipe. Default is 1048576.
+
+    - batch_delay : float, optional
+        After a small read, wait this long (in seconds) so the pipe fills up and the next read is large. Where
+        the system allows it the pipe is enlarged to read_size bytes, so the program does not block meanwhile.
+        Default is 0.01.
+    """
+
+    def __init__(self, fd, log_writer, read_size=1 << 20, batch_delay=0.01):
+        self.fd = fd
+        self.log_writer = log_writer
+        self.read_size = read_size
+        self.batch_delay = batch_delay
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')  # A read may end inside a character
+        self.bytes = 0
+
+        self.saved_fd = os.dup(fd)  # The original terminal
+        self.read_fd, write_fd = os.pipe()
+        try:
+            import fcntl
+            fcntl.fcntl(write_fd, F_SETPIPE_SZ, read_size)  # Fewer wake-ups of the reader for chatty programs
+        except (ImportError, OSError):
+            pass
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        self.thread = threading.Thread(target=self.run, name='notify-fd-capture-%d' % fd, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.read_fd, self.read_size)
+            except OSError:
+                break
+            if not data:
+                break
+            self.bytes += len(data)
+            self.tee(data)
+            self.log_writer.write(self.decoder.decode(data))
+            if len(data) < self.read_size // 16:
+                time.sleep(self.batch_delay)
+        self.log_writer.write(self.decoder.decode(b'', final=True))
+        os.close(self.read_fd)
+
+    def tee(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.saved_fd, view)
+            except OSError:
+                return  # The terminal is gone, the output still goes to the log
+            view = view[written:]
+
+    def restore(self, timeout=1.0):
+        """Point the descriptor back to the terminal and read what is left in the pipe.
+        """
+        os.dup2(self.saved_fd, self.fd)  # Closes the write end held by this process
+        # Child processes which are still running keep the pipe open, do not wait for them forever
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            os.close(self.saved_fd)
+
+
+class FdCapture(object):
+    """
+    Capture of file descriptors 1 and 2 into a LogWriter, copied to the terminal as well.
+
+    Inputs:
+    - log_writer : LogWriter
+        The writer of Log_Cache.log.
+
+    - read_size : int, optional
+        Maximum size (in bytes) of one read from the pipes. Default is 1048576.
+
+    - batch_delay : float, optional
+        Wait after a small read (in seconds), so the pipes fill up. Default is 0.01.
+    """
+
+    def __init__(self, log_writer, read_size=1 << 20, batch_delay=0.01):
+        self.log_writer = log_writer
+        self.read_size = read_size
+        self.batch_delay = batch_delay
+        self.streams = []
+
+    def start(self):
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()  # Output buffered so far belongs to the terminal only
+            except (AttributeError, ValueError):
+                pass
+        self.streams = [FdStreamCapture(fd, self.log_writer, self.read_size, self.batch_delay) for fd in (1, 2)]
+
+    def close(self, timeout=1.0):
+        """Stop capturing, after the Python streams are flushed into the pipes.
+        """
+        for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+            try:
+                stream.flush()
+            except (AttributeError, ValueError):
+                pass
+        streams, self.streams = self.streams, []
+        for stream in streams:
+            stream.restore(timeout)
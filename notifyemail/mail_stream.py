@@ -0,0 +1,275 @@
+import base64
+import os
+import re
+import smtplib
+import uuid
+from email.header import Header
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from email.utils import encode_rfc2231
+
+
+class StreamingMessage(object):
+    """
+    A multipart email whose attachments are read and base64-encoded chunk by chunk while sending.
+
+    Only the mail body text is held in memory. Each attachment is a file path and stays on disk until
+    its turn comes in the SMTP DATA stream, so the memory used by sending does not depend on the
+    attachment size.
+
+    Inputs:
+    - subject : str
+        The mail title.
+
+    - mail_user : str
+        The sender account.
+
+    - mail_list : list
+        The recipients.
+    """
+
+    chunk_size = 57 * 1024  # Raw bytes read per step, a multiple of 57 so every base64 line is 76 characters
+
+    def __init__(self, subject, mail_user, mail_list):
+        self.subject = subject
+        self.mail_user = mail_user
+        self.mail_list = mail_list
+        self.body = ''
+        self.attachments = []  # (file path, file name shown in the email, offset, length or None for the whole file)
+        self.boundary = '===============' + uuid.uuid4().hex + '=='
+
+    def set_body(self, text):
+        self.body = text
+
+    def add_attachment(self, file_path, file_name, offset=0, length=None):
+        """Attach a file, or length bytes of it from offset (a volume of a split file).
+        """
+        self.attachments.append((file_path, file_name, offset, length))
+
+    def iter_chunks(self, with_payload=True):
+        """
+        Yield the serialized message as bytes chunks with CRLF line endings. Every chunk ends with a line break.
+        With with_payload=False the base64 content of the attachments is skipped.
+        """
+        yield (header_line('Content-Type', 'multipart/mixed; boundary="%s"' % self.boundary) +
+               header_line('MIME-Version', '1.0') +
+               header_line('Subject', self.subject) +
+               header_line('From', self.mail_user) +
+               header_line('To', ';'.join(self.mail_list)) +
+               b'\r\n')
+
+        # Mail body text
+        yield ('--%s\r\n' % self.boundary).encode('ascii')
+        yield MIMEText(self.body, 'plain', 'utf-8').as_bytes(policy=SMTP) + b'\r\n'
+
+        # Attachments, encoded straight from the disk
+        for file_path, file_name, offset, length in self.attachments:
+            yield ('--%s\r\n' % self.boundary).encode('ascii')
+            yield (header_line('Content-Type', 'application/octet-stream') +
+                   header_line('MIME-Version', '1.0') +
+                   header_line('Content-Transfer-Encoding', 'base64') +
+                   header_line('Content-Disposition', 'attachment; ' + filename_param(file_name)) +
+                   b'\r\n')
+            if with_payload:
+                with open(file_path, 'rb') as f:
+                    f.seek(offset)
+                    left = length
+                    while left is None or left > 0:
+                        data = f.read(self.chunk_size if left is None else min(self.chunk_size, left))
+                        if not data:
+                            break
+                        if left is not None:
+                            left -= len(data)
+                        yield base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+        yield ('--%s--\r\n' % self.boundary).encode('ascii')
+
+    def encoded_size(self):
+        """Size (in bytes) of the serialized message, computed without reading the attachments.
+        """
+        size = sum(len(chunk) for chunk in self.iter_chunks(with_payload=False))
+        for attachment in self.attachments:
+            size += base64_size(attachment_size(attachment))
+        return size
+
+
+def attachment_size(attachment):
+    """Raw size (in bytes) of an attachment of StreamingMessage.
+    """
+    file_path, file_name, offset, length = attachment
+    if length is None:
+        return os.path.getsize(file_path) - offset
+    return length
+
+
+def split_message(message, max_size):
+    """
+    Split a StreamingMessage into numbered messages of at most max_size bytes each, base64 overhead included.
+
+    Attachments are bin-packed (first fit, largest first) into as few messages as possible. An attachment
+    which does not fit into a message of its own is cut into volumes 'name.001', 'name.002', ..., to be
+    joined with e.g. `cat name.0* > name`. The first message keeps the body text, the others list their
+    attachments, and the subjects end with '(i/n)'.
+
+    Parameters
+    ----------
+    message : StreamingMessage
+        The message to split.
+
+    max_size : int
+        Size limit (in bytes) of the serialized messages, e.g. the message size limit of the provider.
+
+    Returns
+    -------
+    list
+        The messages, [message] itself if it fits.
+    """
+    if not max_size or message.encoded_size() <= max_size:
+        return [message]
+
+    def new_part(subject, body, attachments=()):
+        part = StreamingMessage(subject, message.mail_user, message.mail_list)
+        part.boundary = message.boundary
+        part.set_body(body)
+        part.attachments = list(attachments)
+        return part
+
+    def cost(attachment):
+        """Bytes added to a message by the attachment, its headers included."""
+        empty = new_part('', '')
+        return new_part('', '', [attachment]).encoded_size() - empty.encoded_size()
+
+    # Size of a part without attachments, with the longest subject and body a part can get
+    listing = ''.join('%s.000\n' % attachment[1] for attachment in message.attachments)
+    reserve = new_part(message.subject + ' (000/000)', message.body + '#' * 200 + listing).encoded_size()
+    room = max_size - reserve
+
+    # Cut what does not fit into a message of its own into volumes
+    items = []  # (cost, attachment)
+    for attachment in message.attachments:
+        item_cost = cost(attachment)
+        if item_cost <= room:
+            items.append((item_cost, attachment))
+            continue
+        file_path, file_name, offset, length = attachment
+        size = attachment_size(attachment)
+        header_cost = cost((file_path, file_name + '.000', 0, 0))
+        volume = (room - header_cost) // 78 * 57  # Raw bytes whose base64 lines (76 characters + CRLF) fit
+        if volume <= 0:
+            raise ValueError(f'A message size limit of {max_size} bytes leaves no room for attachments')
+        for index in range((size + volume - 1) // volume):
+            items.append((header_cost + base64_size(min(volume, size - index * volume)),
+                          (file_path, '%s.%03d' % (file_name, index + 1), offset + index * volume,
+                           min(volume, size - index * volume))))
+
+    # First fit decreasing, then the parts are ordered and keep the attachments in their original order
+    bins = []  # [used bytes, [item index]]
+    for index in sorted(range(len(items)), key=lambda index: -items[index][0]):
+        for used_items in bins:
+            if used_items[0] + items[index][0] <= room:
+                break
+        else:
+            used_items = [0, []]
+            bins.append(used_items)
+        used_items[0] += items[index][0]
+        used_items[1].append(index)
+    for used_items in bins:
+        used_items[1].sort()
+    bins.sort(key=lambda used_items: used_items[1][0])
+
+    count = len(bins)
+    parts = []
+    for number, (used, indexes) in enumerate(bins, 1):
+        attachments = [items[index][1] for index in indexes]
+        subject = '%s (%d/%d)' % (message.subject, number, count)
+        if number == 1:
+            body = message.body + '\n[This notification is split into %d emails to fit the size limit of %s bytes]\n' \
+                   % (count, format(max_size, ','))
+        else:
+            body = 'Part %d of %d.\n\nAttachments:\n%s' % (number, count,
+                                                            ''.join('%s\n' % attachment[1] for attachment in attachments))
+        parts.append(new_part(subject, body, attachments))
+    return parts
+
+
+def header_line(name, value):
+    """Fold a header into a CRLF-terminated line, encoding non-ascii values as RFC 2047 words.
+    """
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        value = Header(value, 'utf-8').encode()
+    return SMTP.fold(name, value).encode('ascii')
+
+
+def filename_param(file_name):
+    try:
+        file_name.encode('ascii')
+    except UnicodeEncodeError:
+        return "filename*=%s" % encode_rfc2231(file_name, 'utf-8')
+    return 'filename="%s"' % file_name
+
+
+def base64_size(n_bytes):
+    """Size of n_bytes after base64 encoding with 76-character lines and CRLF line breaks.
+    """
+    encoded = (n_bytes + 2) // 3 * 4
+    return encoded + (encoded + 75) // 76 * 2
+
+
+def send_streaming(smtp, message):
+    """
+    Send a StreamingMessage through an SMTP connection which has been logged in.
+
+    The message is written into the DATA stream chunk by chunk, instead of serializing the whole
+    message like smtplib.SMTP.sendmail() does.
+
+    Parameters
+    ----------
+    smtp : smtplib.SMTP
+        The connected (and logged in) SMTP session.
+
+    message : StreamingMessage
+        The message to send.
+
+    Returns
+    -------
+    dict
+        Recipients refused by the server, same as smtplib.SMTP.sendmail().
+    """
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(message.mail_user)
+    if code != 250:
+        reset_quietly(smtp)
+        raise smtplib.SMTPSenderRefused(code, resp, message.mail_user)
+
+    refused = {}
+    for mail_recv in message.mail_list:
+        code, resp = smtp.rcpt(mail_recv)
+        if code not in (250, 251):
+            refused[mail_recv] = (code, resp)
+    if len(refused) == len(message.mail_list):
+        reset_quietly(smtp)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = smtp.docmd('data')
+    if code != 354:
+        reset_quietly(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in message.iter_chunks():
+        smtp.send(re.sub(rb'(?m)^\.', b'..', chunk))  # Dot-stuffing, every chunk starts at a line beginning
+    smtp.send(b'.\r\n')
+    code, resp = smtp.getreply()
+    if code != 250:
+        reset_quietly(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def reset_quietly(smtp):
+    """Abort the current mail transaction, ignoring a lost connection.
+    """
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
@@ -0,0 +1,724 @@
+import heapq
+import math
+import os
+import sys
+import time
+from array import array
+
+import psutil
+
+try:
+    import resource  # Peak RSS of the main process, Unix only
+except ImportError:
+    resource = None
+
+
+COLLECTORS = {}  # Registered collector classes: name -> class
+
+
+def register_collector(collector_class):
+    """
+    Register a Collector subclass under its `name`, so it can be selected with the monitor_collectors
+    option of setup(). Can be used as a class decorator.
+
+    Parameters
+    ----------
+    collector_class : type
+        A subclass of Collector with a unique `name`.
+
+    Returns
+    -------
+    type
+        The registered class.
+    """
+    if not (isinstance(collector_class, type) and issubclass(collector_class, Collector)):
+        raise TypeError('A collector must be a subclass of notifyemail.Collector, got %r' % (collector_class,))
+    COLLECTORS[collector_class.name] = collector_class
+    return collector_class
+
+
+def create_collectors(specs=None, intervals=None, path=None):
+    """
+    Build the collectors to run.
+
+    Parameters
+    ----------
+    specs : list, optional
+        Registered collector names, Collector subclasses or Collector objects. Default is None (all registered collectors).
+
+    intervals : dict, optional
+        Time interval (in seconds) between samples, by collector name. Collectors not listed use their default_interval.
+
+    path : str, optional
+        The directory watched by collectors which need one (e.g. the free space of its filesystem).
+
+    Returns
+    -------
+    list
+        The Collector objects.
+    """
+    intervals = intervals or {}
+    collectors = []
+    for spec in (list(COLLECTORS) if specs is None else specs):
+        if isinstance(spec, Collector):
+            collectors.append(spec)
+            continue
+        if isinstance(spec, str):
+            if spec not in COLLECTORS:
+                raise ValueError('Unknown collector %r, registered collectors are %s' % (spec, list(COLLECTORS)))
+            spec = COLLECTORS[spec]
+        collectors.append(spec(interval=intervals.get(spec.name), path=path))
+    return collectors
+
+
+class Collector(object):
+    """
+    Base class of the server monitoring collectors.
+
+    A collector reads its counters without blocking and returns them as a dict when sample() is called.
+    The Sampler calls it every `interval` seconds. Every metric it returns is aggregated and reported
+    in the server status log.
+
+    Inputs:
+    - interval : float, optional
+        Time interval (in seconds) between two samples. Default is None (the class default_interval).
+
+    - path : str, optional
+        A directory the collector may watch, the log root path when built by the backend.
+    """
+
+    name = 'collector'
+    default_interval = 1.0
+
+    def __init__(self, interval=None, path=None):
+        self.interval = interval or self.default_interval
+        self.path = path
+
+    def start(self):
+        """Called once before the first sample, e.g. to initialize counters.
+        """
+        pass
+
+    def sample(self):
+        """Return the current values as a dict: metric name -> float (or a list of floats).
+        """
+        raise NotImplementedError
+
+    def summary(self):
+        """Return additional lines for the server status summary at the end of the run ('' for none).
+        """
+        return ''
+
+
+class RateCollector(Collector):
+    """
+    Base class of the collectors reporting the rates of cumulative counters (e.g. bytes read).
+
+    Subclasses implement counters(), returning a dict: metric name -> cumulative value (or None if
+    unavailable). sample() returns the change per second since the previous sample, divided by `scale`.
+    """
+
+    scale = 1024 * 1024  # Rates in MB/s
+
+    def start(self):
+        self.last_counters = self.counters()
+        self.last_time = time.monotonic()
+
+    def counters(self):
+        raise NotImplementedError
+
+    def sample(self):
+        counters = self.counters()
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        rates = {}
+        if counters and self.last_counters:
+            for key, value in counters.items():
+                if key in self.last_counters:
+                    rates[key] = max(value - self.last_counters[key], 0) / elapsed / self.scale
+        self.last_counters, self.last_time = counters, now
+        return rates
+
+
+@register_collector
+class CpuCollector(Collector):
+    """CPU usage (%) of every core since the previous sample.
+    """
+
+    name = 'cpu'
+    default_interval = 0.25
+
+    def start(self):
+        psutil.cpu_percent(interval=None, percpu=True)  # Start counting, the next call returns the usage since now
+
+    def sample(self):
+        return {'cpu': psutil.cpu_percent(interval=None, percpu=True)}
+
+
+@register_collector
+class MemoryCollector(Collector):
+    """Memory usage (%) of the server.
+    """
+
+    name = 'mem'
+
+    def sample(self):
+        return {'mem': psutil.virtual_memory().percent}
+
+
+@register_collector
+class DiskIOCollector(RateCollector):
+    """Read and write rates (MB/s) of all disks.
+    """
+
+    name = 'disk_io'
+
+    def counters(self):
+        io = psutil.disk_io_counters()
+        if io is None:  # No disk statistics, e.g. in some containers
+            return {}
+        return {'disk_read_mb_s': io.read_bytes, 'disk_write_mb_s': io.write_bytes}
+
+
+@register_collector
+class NetworkCollector(RateCollector):
+    """Sent and received rates (MB/s) of all network interfaces.
+    """
+
+    name = 'net'
+
+    def counters(self):
+        io = psutil.net_io_counters()
+        if io is None:
+            return {}
+        return {'net_sent_mb_s': io.bytes_sent, 'net_recv_mb_s': io.bytes_recv}
+
+
+@register_collector
+class LoadCollector(Collector):
+    """Load average over the last minute, and per CPU.
+    """
+
+    name = 'load'
+    default_interval = 5.0
+
+    def sample(self):
+        load = psutil.getloadavg()[0]
+        return {'load_1m': load, 'load_per_cpu': load / (psutil.cpu_count() or 1)}
+
+
+@register_collector
+class SwapCollector(Collector):
+    """Swap usage (%) of the server.
+    """
+
+    name = 'swap'
+    default_interval = 5.0
+
+    def sample(self):
+        return {'swap': psutil.swap_memory().percent}
+
+
+@register_collector
+class DiskFreeCollector(Collector):
+    """Free space (GB) on the filesystem of `path` (the log root path), the current directory if not given.
+    """
+
+    name = 'disk_free'
+    default_interval = 30.0
+
+    def sample(self):
+        path = self.path if self.path and os.path.exists(self.path) else os.getcwd()
+        return {'disk_free_gb': psutil.disk_usage(path).free / 1024 ** 3}
+
+
+class ProcessRecord(object):
+    """
+    Resource usage of one process of the monitored tree, kept after the process exits.
+    """
+
+    __slots__ = ('pid', 'name', 'cpu_seconds', 'rss', 'peak_rss', 'read_bytes', 'write_bytes',
+                 'threads', 'fds', 'alive')
+
+    def __init__(self, pid, name):
+        self.pid = pid
+        self.name = name
+        self.cpu_seconds = 0.0
+        self.rss = 0
+        self.peak_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.threads = 0
+        self.fds = 0
+        self.alive = True
+
+
+@register_collector
+class ProcessTreeCollector(Collector):
+    """
+    Resource usage of the notified program: the main process and all its child processes
+    (e.g. multiprocessing or DataLoader workers).
+
+    Every sample lists the children once (a single scan of the process table) and reads each process
+    with cached psutil.Process objects in oneshot mode. CPU seconds, current and peak RSS, I/O bytes,
+    threads and open files are recorded per process, and the tree totals are reported as metrics.
+    """
+
+    name = 'process'
+
+    def __init__(self, interval=None, path=None, pid=None):
+        super(ProcessTreeCollector, self).__init__(interval, path)
+        self.pid = pid or os.getpid()
+        self.processes = {}  # pid -> psutil.Process of the living processes
+        self.records = {}  # pid -> ProcessRecord, also of the exited processes
+        self.peak_tree_rss = 0
+        self.max_processes = 0
+        self.last_cpu_seconds = 0.0
+        self.last_time = None
+
+    def start(self):
+        self.root = psutil.Process(self.pid)
+        self.processes[self.pid] = self.root
+        self.last_time = time.monotonic()
+
+    def sample(self):
+        # Refresh the tree: keep the known Process objects, create the new ones only
+        try:
+            children = self.root.children(recursive=True)
+        except psutil.Error:
+            children = []
+        living = {self.pid: self.root}
+        for child in children:
+            living[child.pid] = self.processes.get(child.pid, child)
+        for pid in self.processes:
+            if pid not in living and pid in self.records:
+                self.records[pid].alive = False
+        self.processes = living
+
+        for pid, process in living.items():
+            self.read_process(pid, process)
+
+        alive_records = [record for record in self.records.values() if record.alive]
+        tree_rss = sum(record.rss for record in alive_records)
+        cpu_seconds = sum(record.cpu_seconds for record in self.records.values())
+        self.peak_tree_rss = max(self.peak_tree_rss, tree_rss)
+        self.max_processes = max(self.max_processes, len(alive_records))
+
+        now = time.monotonic()
+        cpu_percent = 100.0 * (cpu_seconds - self.last_cpu_seconds) / max(now - self.last_time, 1e-9)
+        self.last_cpu_seconds, self.last_time = cpu_seconds, now
+        return {'proc_cpu': cpu_percent,
+                'proc_rss_mb': tree_rss / 1024 ** 2,
+                'proc_count': len(alive_records),
+                'proc_threads': sum(record.threads for record in alive_records)}
+
+    def read_process(self, pid, process):
+        record = self.records.get(pid)
+        try:
+            with process.oneshot():
+                if record is None:
+                    record = self.records[pid] = ProcessRecord(pid, process.name())
+                cpu = process.cpu_times()
+                record.cpu_seconds = cpu.user + cpu.system
+                record.rss = process.memory_info().rss
+                record.threads = process.num_threads()
+                try:
+                    io = process.io_counters()
+                    record.read_bytes, record.write_bytes = io.read_bytes, io.write_bytes
+                except (AttributeError, psutil.AccessDenied):
+                    pass  # Not available on this platform
+                try:
+                    record.fds = process.num_fds() if hasattr(process, 'num_fds') else process.num_handles()
+                except psutil.AccessDenied:
+                    pass
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            if record is not None:
+                record.alive = False
+            return
+        except psutil.AccessDenied:
+            return
+        record.peak_rss = max(record.peak_rss, record.rss)
+
+    def main_peak_rss(self):
+        """High-water mark of the main process RSS, from the kernel if available.
+        """
+        peak = self.records[self.pid].peak_rss if self.pid in self.records else 0
+        if resource is not None and self.pid == os.getpid():
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak = max(peak, max_rss if sys.platform == 'darwin' else max_rss * 1024)  # Bytes on macOS, KB elsewhere
+        return peak
+
+    def tree_cpu_seconds(self):
+        """
+        CPU seconds of the whole tree. Exited children are only sampled until their last sample, so the
+        kernel accounting of the waited-for children is used for them when it is larger.
+        """
+        exited = sum(record.cpu_seconds for record in self.records.values() if not record.alive)
+        if resource is not None and self.pid == os.getpid():
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            exited = max(exited, usage.ru_utime + usage.ru_stime)
+        return exited + sum(record.cpu_seconds for record in self.records.values() if record.alive)
+
+    def summary(self, max_children=10):
+        if not self.records:
+            return ''
+        mb = 1024 ** 2
+        records = list(self.records.values())
+        main = self.records.get(self.pid)
+        children = sorted((record for record in records if record.pid != self.pid),
+                          key=lambda record: record.cpu_seconds, reverse=True)
+        text = 'Process Tree:            main PID %s, %s child processes seen, at most %s processes at once\n' \
+               'Process CPU Time (s):    %s  | Main Process:           %s\n' \
+               'Process RSS (MB):        %s  | Peak:                   %s\n' \
+               'Main Process RSS (MB):   %s  | Peak:                   %s\n' \
+               'Process I/O (MB):        %s read  | %s written\n' % \
+               (self.pid, len(children), self.max_processes,
+                round(self.tree_cpu_seconds(), 2),
+                round(main.cpu_seconds, 2) if main else '',
+                round(sum(record.rss for record in records if record.alive) / mb, 1), round(self.peak_tree_rss / mb, 1),
+                round(main.rss / mb, 1) if main else '', round(self.main_peak_rss() / mb, 1),
+                round(sum(record.read_bytes for record in records) / mb, 1),
+                round(sum(record.write_bytes for record in records) / mb, 1))
+        if children:
+            text += '    %-8s %-16s %10s %14s %10s %10s %8s %6s\n' % \
+                    ('PID', 'Name', 'CPU (s)', 'Peak RSS (MB)', 'Read (MB)', 'Write (MB)', 'Threads', 'FDs')
+            for record in children[:max_children]:
+                text += '    %-8s %-16s %10s %14s %10s %10s %8s %6s%s\n' % \
+                        (record.pid, record.name[:16], round(record.cpu_seconds, 2), round(record.peak_rss / mb, 1),
+                         round(record.read_bytes / mb, 1), round(record.write_bytes / mb, 1),
+                         record.threads, record.fds, '' if record.alive else '  (exited)')
+            if len(children) > max_children:
+                text += '    ... and %s more child processes\n' % (len(children) - max_children)
+        return text
+
+
+class Sampler(object):
+    """
+    Run collectors on their own timer schedules in one thread.
+
+    The next due collector is kept on a heap, and the thread sleeps on the stop event until then,
+    so it never blocks in a measurement and stop() takes effect at once.
+
+    A collector raising an exception is stopped, the error is kept in `errors`, and the other
+    collectors go on.
+
+    Inputs:
+    - collectors : list
+        The Collector objects to run.
+
+    - on_sample : callable
+        Called as on_sample(collector, values, timestamp) after every sample.
+    """
+
+    def __init__(self, collectors, on_sample):
+        self.collectors = collectors
+        self.on_sample = on_sample
+        self.errors = {}  # Collector name -> error which stopped it
+        self.cpu_seconds = 0.0  # CPU time used by the sampler thread itself
+        self.wall_seconds = 0.0
+
+    def run(self, stop_event):
+        """Sample until stop_event is set, then take a last sample of every collector.
+        """
+        start_wall = time.monotonic()
+        start_cpu = time.thread_time()
+
+        schedule = []
+        for i, collector in enumerate(self.collectors):
+            try:
+                collector.start()
+            except Exception as e:
+                self.errors[collector.name] = e
+                continue
+            heapq.heappush(schedule, (start_wall + collector.interval, i))
+
+        while schedule:
+            due_time, i = schedule[0]
+            if stop_event.wait(max(0.0, due_time - time.monotonic())):
+                break
+            heapq.heappop(schedule)
+            if not self.take_sample(self.collectors[i]):
+                continue
+
+            # Skip the missed ticks (e.g. after the machine was suspended) instead of catching up
+            due_time += self.collectors[i].interval
+            heapq.heappush(schedule, (max(due_time, time.monotonic()), i))
+
+        for collector in self.collectors:
+            if collector.name not in self.errors:
+                self.take_sample(collector)
+
+        self.cpu_seconds = time.thread_time() - start_cpu
+        self.wall_seconds = time.monotonic() - start_wall
+
+    def take_sample(self, collector):
+        """Sample a collector, return False if it failed.
+        """
+        try:
+            values = collector.sample()
+        except Exception as e:
+            self.errors[collector.name] = e
+            return False
+        self.on_sample(collector, values, time.time())
+        return True
+
+    def overhead(self):
+        """CPU usage (%) of the sampler thread over its running time.
+        """
+        return 100.0 * self.cpu_seconds / max(self.wall_seconds, 1e-9)
+
+
+class RunningStats(object):
+    """
+    Online count, mean, variance, min and max of a stream of numbers (Welford's algorithm).
+    Memory and the cost of add() are constant.
+    """
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+class RingBuffer(object):
+    """
+    The last `capacity` values of a stream, stored in a fixed-size array of doubles.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.values = array('d', bytes(8 * capacity))
+        self.count = 0  # Values added so far (the buffer holds min(count, capacity) of them)
+
+    def append(self, value):
+        self.values[self.count % self.capacity] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def to_list(self):
+        """Values from the oldest to the newest.
+        """
+        if self.count <= self.capacity:
+            return self.values[:self.count].tolist()
+        start = self.count % self.capacity
+        return (self.values[start:] + self.values[:start]).tolist()
+
+
+class P2Quantile(object):
+    """
+    Streaming estimate of one quantile with the P-square algorithm (Jain & Chlamtac, 1985).
+    Only five markers are kept, whatever the number of values.
+
+    Inputs:
+    - p : float
+        The quantile to estimate, e.g. 0.95.
+    """
+
+    __slots__ = ('p', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []  # Marker heights (the first five values until the markers are initialized)
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell of the value, extending the extreme markers if needed
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= heights[k + 1]:
+                k += 1
+
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Move the middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def parabolic(self, i, d):
+        h, n = self.heights, self.positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        if len(self.heights) < 5:
+            if not self.heights:
+                return 0.0
+            return self.heights[int(round(self.p * (len(self.heights) - 1)))]
+        return self.heights[2]
+
+
+class QuantileSketch(object):
+    """
+    Fixed-size streaming estimates of several quantiles (p50, p95 and p99 by default).
+    """
+
+    def __init__(self, quantiles=(0.5, 0.95, 0.99)):
+        self.estimators = [P2Quantile(q) for q in quantiles]
+
+    def add(self, value):
+        for estimator in self.estimators:
+            estimator.add(value)
+
+    def values(self):
+        """Dict: quantile -> estimated value.
+        """
+        return {estimator.p: estimator.value() for estimator in self.estimators}
+
+
+class CoreStats(object):
+    """
+    Running mean and max usage of every core, kept in arrays of doubles.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sums = None
+        self.maxs = None
+
+    def add(self, values):
+        if self.sums is None or len(self.sums) != len(values):
+            self.sums = array('d', bytes(8 * len(values)))
+            self.maxs = array('d', bytes(8 * len(values)))
+            self.count = 0
+        self.count += 1
+        sums, maxs = self.sums, self.maxs
+        for i, value in enumerate(values):
+            sums[i] += value
+            if value > maxs[i]:
+                maxs[i] = value
+
+    def means(self):
+        if not self.count:
+            return []
+        return [total / self.count for total in self.sums]
+
+    def imbalance(self):
+        """(difference between the busiest and the idlest core mean, busiest core, idlest core).
+        """
+        means = self.means()
+        if not means:
+            return 0.0, 0, 0
+        busiest = max(range(len(means)), key=means.__getitem__)
+        idlest = min(range(len(means)), key=means.__getitem__)
+        return means[busiest] - means[idlest], busiest, idlest
+
+
+class MetricAggregator(object):
+    """
+    Constant-memory aggregation of one metric.
+
+    Keeps RunningStats of the whole run and of the current report period, a QuantileSketch of the
+    run, and the most recent samples in a RingBuffer. A per-core metric (a list of values) is
+    averaged over the cores, and every core is also followed in CoreStats.
+
+    Inputs:
+    - name : str
+        Name of the metric.
+
+    - ring_size : int, optional
+        Number of recent samples kept. Default is 1024.
+    """
+
+    def __init__(self, name, ring_size=1024):
+        self.name = name
+        self.run = RunningStats()
+        self.period = RunningStats()
+        self.recent = RingBuffer(ring_size)
+        self.quantiles = QuantileSketch()
+        self.cores = CoreStats()
+
+    def add(self, value):
+        if isinstance(value, (list, tuple)):
+            self.cores.add(value)
+            value = sum(value) / len(value) if value else 0.0
+        self.run.add(value)
+        self.quantiles.add(value)
+        self.period.add(value)
+        self.recent.append(value)
+
+    def end_period(self):
+        """Return the statistics of the report period which just ended, and start a new one.
+        """
+        period = self.period
+        self.period = RunningStats()
+        return period
+
+    def state(self):
+        """The run statistics as a JSON-serializable dict, see from_state().
+        """
+        return {'name': self.name,
+                'run': [self.run.count, self.run.mean, self.run.m2, self.run.min, self.run.max],
+                'quantiles': [[q.p, q.heights, q.positions, q.desired] for q in self.quantiles.estimators],
+                'cores': [self.cores.count, list(self.cores.sums or []), list(self.cores.maxs or [])],
+                'last': self.recent.to_list()[-1:]}
+
+    @classmethod
+    def from_state(cls, state, ring_size=1024):
+        """Rebuild an aggregator from state(), e.g. one received from the notify daemon.
+        """
+        aggregator = cls(state['name'], ring_size)
+        run = aggregator.run
+        run.count, run.mean, run.m2, run.min, run.max = state['run']
+        aggregator.quantiles.estimators = []
+        for p, heights, positions, desired in state['quantiles']:
+            estimator = P2Quantile(p)
+            estimator.heights, estimator.positions, estimator.desired = heights, positions, desired
+            aggregator.quantiles.estimators.append(estimator)
+        count, sums, maxs = state['cores']
+        if sums:
+            aggregator.cores.count = count
+            aggregator.cores.sums, aggregator.cores.maxs = array('d', sums), array('d', maxs)
+        for value in state['last']:
+            aggregator.recent.append(value)
+        return aggregator
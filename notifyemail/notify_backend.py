@@ -1,15 +1,14 @@
 import threading
 import os
-import psutil
 import re
-import socket
 import sys
 import time
-import shutil
-import zipfile
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from .monitor import COLLECTORS, MetricAggregator, Sampler, create_collectors
+from .progress import ProgressReporter
+from .timeseries import TimeSeriesReader, TimeSeriesWriter, flatten_sample
+
+# Sending and zipping modules (smtplib, ssl, email, zipfile, ...) are imported by import_send_modules()
+# in the background thread, so that neither setup() nor the exit waits for them.
 
 class NotifyBackend(threading.Thread):
     """
@@ -36,49 +35,203 @@ class NotifyBackend(threading.Thread):
     - mail_list : list or tuple
         The list of email addresses for receiving notifications.
 
+    - log_writer : LogWriter, optional
+        The writer behind Log_Cache.log. It is drained and closed before the log is read, and its compressed
+        segments (if any) are attached before the last part of the log.
+
+    - zip_workers : int, optional
+        Number of threads compressing the files added by add_file(). Default is None (the number of CPUs).
+
+    - zip_codec : str, optional
+        Codec for compressible files: 'deflate', 'bzip2' or 'lzma'. Compressed files are stored. Default is 'deflate'.
+
+    - zip_fast : bool, optional
+        Use deflate at level 1 for all compressible files. Default is False.
+
+    - zip_cache_size : int, optional
+        Size budget (in bytes) of the compressed member cache under log_root_path. Default is 0 (no cache).
+
+    - zip_cache_hash : bool, optional
+        Identify cached files by their content hash instead of size and modification time. Default is False.
+
+    - monitor_intervals : dict, optional
+        Time interval (in seconds) between samples of each collector, e.g. {'cpu': 0.25, 'mem': 1}.
+
+    - monitor_collectors : list, optional
+        Collectors to run: registered collector names, Collector subclasses or Collector objects.
+        Default is None (all registered collectors).
+
+    - monitor_csv_points : int, optional
+        Maximum number of rows of each series in the attached server_series.zip. Default is 1000.
+
+    - monitor_csv_method : str, optional
+        Downsampling method of the attached series, 'lttb' or 'minmax'. Default is 'lttb'.
+
+    - mail_port : int, optional
+        The SMTP server port. Default is None (465 with SSL, 25 without).
+
+    - mail_ssl : bool, optional
+        Connect to the SMTP server with SSL, otherwise with STARTTLS if offered. Default is True.
+
+    - smtp_prewarm : bool, optional
+        Connect and log in to the SMTP server in the background right away, keep the connection alive
+        and reuse it for the final email. A rejected login is reported at once. Default is False.
+
+    - mail_max_size : int, optional
+        Size limit (in bytes) of one email, base64 encoding included. A bigger log email is split with
+        split_message() into numbered emails, which are queued in order and sent over one connection.
+        Default is 20000000, 0 to never split.
+
+    - progress_interval : float, optional
+        Time interval (in seconds) between periodic progress mails. Default is None (only on send_progress()).
+
+    - progress_burst : int, optional
+        Maximum number of progress mails sent in a burst. Default is 3.
+
+    - progress_refill : float, optional
+        Time (in seconds) after which one more progress mail is allowed. Default is 600.
+
+    - smtp_timeout : float, optional
+        Socket timeout (in seconds) of the SMTP connections. Default is 120.
+
+    - send_deadline : float, optional
+        Time (in seconds) spent at most on delivering the final email (retries included) after the program
+        ends. Unsent messages stay in the outbox under log_root_path. Default is 300.
+
+    - daemon_socket : str or bool, optional
+        Socket of the notify daemon (True for the default path). If the daemon answers, the system metrics
+        come from its shared sampler and the final email is handed over to it. Default is None (no daemon).
+
+    - child_capture : ChildOutputCollector, optional
+        The collector of the output of child processes. It is stopped before the log is closed. Default is None.
+
+    - fd_capture : FdCapture, optional
+        The capture of file descriptors 1 and 2 (capture_mode='fd'). It is stopped before the log is closed. Default is None.
+
+    - retention : RetentionManager, optional
+        The retention manager of log_root_path. The end of the run is recorded in its index, then obsolete
+        runs are removed. Default is None.
+
+    - run_id : str, optional
+        The id of the run in the index of the retention manager. Default is None.
+
     Dependencies:
     - class Logger
     """
 
-    def __init__(self, log_root_path, log_folder_name, mail_host, mail_user, mail_pass, mail_list):
+    def __init__(self, log_root_path, log_folder_name, mail_host, mail_user, mail_pass, mail_list, log_writer=None,
+                 zip_workers=None, zip_codec='deflate', zip_fast=False, zip_cache_size=0, zip_cache_hash=False,
+                 monitor_intervals=None, monitor_collectors=None, monitor_csv_points=1000, monitor_csv_method='lttb',
+                 mail_port=None, mail_ssl=True, smtp_prewarm=False, mail_max_size=20 * 1000 * 1000,
+                 progress_interval=None, progress_burst=3, progress_refill=600, smtp_timeout=120, send_deadline=300,
+                 daemon_socket=None, child_capture=None, fd_capture=None, retention=None, run_id=None):
         threading.Thread.__init__(self, name='notify')
 
         # User-defined monitoring parameters
         self.report_time = 300  # Time interval (in seconds) to calculate and write average values into the log file (300 seconds)
-        self.sample_time = 5  # Time interval (in seconds) for each monitoring sample (5 seconds)
-        self.max_log_under_root_path = 5  # Maximum number of logs from the same log source
+        self.monitor_intervals = monitor_intervals  # Time interval (in seconds) between samples of each collector
+        self.daemon_client = None  # Client of the notify daemon, if one answered
+        self.job_id = '%s-%s' % (os.getpid(), log_folder_name)
+        if daemon_socket:
+            from .daemon import SYSTEM_COLLECTORS, DaemonClient
+            client = DaemonClient(None if daemon_socket is True else daemon_socket)
+            try:
+                client.request('register', job=self.job_id, pid=os.getpid())
+                self.daemon_client = client
+            except (OSError, ValueError, AttributeError) as e:
+                print('The notify daemon is not available, monitoring and sending locally: ', e)
+            if self.daemon_client is not None and monitor_collectors is None:
+                # The daemon samples the system metrics, only the collectors of this job run here
+                monitor_collectors = [name for name in COLLECTORS if name not in SYSTEM_COLLECTORS]
+        self.collectors = create_collectors(monitor_collectors, monitor_intervals, path=log_root_path)
+        self.monitor_csv_points = monitor_csv_points  # Rows of each downsampled series attached to the email
+        self.monitor_csv_method = monitor_csv_method
 
         # Define global variables
         self.mail_host = mail_host
         self.mail_user = mail_user
         self.mail_pass = mail_pass
         self.mail_list = mail_list  # List of email addresses to receive notifications
+        self.smtp_settings = {'mail_host': mail_host, 'mail_port': mail_port, 'mail_ssl': mail_ssl,
+                              'mail_user': mail_user, 'mail_pass': mail_pass, 'smtp_timeout': smtp_timeout}
+        self.smtp_session = None  # SmtpSession, created at first use by get_smtp_session()
+        self.smtp_lock = threading.Lock()
+        self.send_deadline = send_deadline  # Time (in seconds) spent at most on the delivery after the program ends
+        self.mail_max_size = mail_max_size  # Size limit of one email
+        if smtp_prewarm:
+            self.get_smtp_session().start()  # Connect and log in while the program runs
+        self.log_writer = log_writer  # Writer of Log_Cache.log
+        self.child_capture = child_capture  # Collector of the output of child processes, if any
+        self.fd_capture = fd_capture  # File-descriptor-level capture, if any
+        self.retention = retention  # Retention manager of log_root_path, if any
+        self.run_id = run_id  # Id of the run in the retention index
+        self.run_ended = False  # Whether the end of the run has been recorded
+        self.zip_workers = zip_workers  # Number of compressing threads
+        self.zip_codec = zip_codec  # Codec for compressible files
+        self.zip_fast = zip_fast  # Fast codec mode
+        self.zip_cache_size = zip_cache_size  # Size budget of the compressed member cache, 0 to disable it
+        self.zip_cache_hash = zip_cache_hash  # Identify cached files by content hash
+        self.zip_cache = None
+        self.zip_stats = []  # (zip file name, statistics) of every compressed attachment
 
         call_func_name = 'default'
         self.log_folder_name = log_folder_name  # Log folder name (time-based)
         self.log_root_path = log_root_path  # Root directory for log files
         self.log_folder_path = os.path.join(log_root_path, call_func_name, log_folder_name)  # Log folder directory
-        self.finish_process = 0  # Set to 1 after the process ends normally
+        self.stop_event = threading.Event()  # Set after the process ends, wakes up the monitor at once
         self.monitor_process = False  # Monitoring thread status
+        self.server_log_file = None  # Handle of Server_Status.log, open while monitoring
+        self.series_dir = os.path.join(self.log_folder_path, 'Server_Series')  # Full resolution samples of each collector
         self.additional_explain = ''    # Additional explanation, generally includes information like 'compressed file not found'.
                                         # If assigned a value, it will be appended to the email content in Trans_Body.log
+        self.monitor_summary = ''  # Finish block of Server_Status.log, appended to the email content
         self.start_time = time.time()   # Record the start time of the monitoring process
+        self.aggregators = {}  # MetricAggregator of each monitored metric, shown in progress mails
+
+        # Progress mails, each one carries what is new since the previous one
+        self.progress_position = 0  # Position in the captured output, see LogWriter.read_since()
+        self.progress_body_offset = 0  # Bytes of Trans_Body.log already sent
+        self.progress = ProgressReporter(self.send_progress_email, interval=progress_interval,
+                                         burst=progress_burst, refill=progress_refill)
+        self.progress.start()
 
         # Start server monitoring process
         self.start_monitor(self.log_folder_path, log_name='Server_Status.log',
-                           report_time=self.report_time, sample_time=self.sample_time)
+                           report_time=self.report_time, collectors=self.collectors)
 
     def run(self):
-        """Check if the main process is alive.
+        """Wait for the main thread to finish, then stop monitoring and send the email.
+        """
+        self.import_send_modules()
+        # The interpreter releases the main thread as the first step of its shutdown sequence,
+        # so this returns right after the main program ends, without polling.
+        threading.main_thread().join()
+        self.progress.stop()  # The final email replaces the pending progress mail
+        if self.child_capture is not None:
+            self.child_capture.close()  # Let the remaining children send their last output
+        self.stop_monitor()  # End server performance monitoring.
+        try:
+            self.send_email()
+        finally:
+            if not self.run_ended:  # Returned early, the run is recorded as failed
+                self.end_run(self.log_folder_path, 'failed')
+
+    def import_send_modules(self):
+        """Import the modules used for zipping and sending while the program runs.
+        """
+        from . import compress, mail_stream, outbox, smtp_session  # noqa: F401
+
+    def get_smtp_session(self):
+        """The SmtpSession of this run, created at first use.
         """
-        while 1:
-            # Check if alive every self.sample_time.
-            for i in threading.enumerate():
-                if i.name == "MainThread" and not i.is_alive():  # Perform post-processing tasks after the main thread ends.
-                    self.stop_monitor()  # End server performance monitoring.
-                    self.send_email()
-                    return
-            time.sleep(self.sample_time)
+        with self.smtp_lock:
+            if self.smtp_session is None:
+                from .smtp_session import SmtpSession
+                settings = self.smtp_settings
+                self.smtp_session = SmtpSession(settings['mail_host'], settings['mail_user'], settings['mail_pass'],
+                                                mail_port=settings['mail_port'], mail_ssl=settings['mail_ssl'],
+                                                timeout=settings['smtp_timeout'])
+            return self.smtp_session
 
     '''
     ****************************************
@@ -86,7 +239,7 @@ class NotifyBackend(threading.Thread):
     ****************************************
     '''
 
-    def start_monitor(self, log_dir, log_name='server_status.log', report_time=300, sample_time=5):
+    def start_monitor(self, log_dir, log_name='server_status.log', report_time=300, collectors=None):
         """
         Start monitor function.
 
@@ -101,20 +254,20 @@ class NotifyBackend(threading.Thread):
         report_time : int, optional
             Time interval (in seconds) between log reports (default is 300 seconds).
 
-        sample_time : int, optional
-            Time interval (in seconds) between performance samples (default is 5 seconds).
+        collectors : list, optional
+            The Collector objects to run (default is None, all registered collectors).
         """
         self.monitor_process = threading.Thread(target=self.server_monitor_process, daemon=True,
-                                                args=(log_dir, log_name, report_time, sample_time))
+                                                args=(log_dir, log_name, report_time, collectors))
         self.monitor_process.start()
 
     def stop_monitor(self):
         if bool(self.monitor_process):
-            self.finish_process += 1
+            self.stop_event.set()
             self.monitor_process.join()  # Waiting for monitor_process finished
         print("finished")
 
-    def server_monitor_process(self, log_dir, log_name='server_status.log', report_time=300, sample_time=5):
+    def server_monitor_process(self, log_dir, log_name='server_status.log', report_time=300, collectors=None):
         """
         Main function for server monitoring.
 
@@ -129,98 +282,203 @@ class NotifyBackend(threading.Thread):
         report_time : int, optional
             Time interval (in seconds) between writing mean values to the log (default is 300 seconds).
 
-        sample_time : int, optional
-            Time interval (in seconds) between each monitoring sample (default is 5 seconds).
+        collectors : list, optional
+            The Collector objects to run (default is None, all registered collectors).
 
         Returns
         -------
         None
         """
-        next_time_to_report = report_time
+        if collectors is None:
+            collectors = create_collectors(path=self.log_root_path)
 
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
 
         self.write_information_to_log(log_dir, log_name, info_type='init', report_time=report_time,
-                                      sample_time=sample_time)
+                                      sample_time=', '.join('%s %s' % (c.name, c.interval) for c in collectors))
         print('start monitoring:)')
 
-        cpu_list = []
-        mem_list = []
-
-        cpu_avg_list = []
-        mem_avg_list = []
-        cpu_max_list = []
-        mem_max_list = []
-        while True:
-            cpu_list.append(psutil.cpu_percent(interval=sample_time, percpu=True))
-            mem_list.append(psutil.virtual_memory().percent)
-            next_time_to_report -= sample_time
-
-            # Save and exit after process ends
-            if self.finish_process == 1:
-                cpu_avg_list.append(self.calc_avg_cpu_usage_percentage(cpu_list))
-                mem_avg_list.append(self.calc_avg_mem_usage_percentage(mem_list))
-                cpu_max_list.append(self.calc_max_cpu_usage(cpu_list))
-                mem_max_list.append(max(mem_list))
-                self.save_server_log(cpu_avg_list[-1], mem_avg_list[-1], log_dir, log_name)
-
-                cpu_avg = self.calc_avg_mem_usage_percentage(cpu_avg_list)
-                mem_avg = self.calc_avg_mem_usage_percentage(mem_avg_list)
-                cpu_max = self.calc_avg_mem_usage_percentage(cpu_max_list)
-                mem_max = self.calc_avg_mem_usage_percentage(mem_max_list)
-                self.write_information_to_log(log_dir, log_name, info_type='finish',
-                                              cpu_avg=cpu_avg, mem_avg=mem_avg, cpu_max=cpu_max, mem_max=mem_max)
-                return 0
-
+        # Statistics of every sample and of every report period, one aggregator per metric
+        aggregators = {'cpu': MetricAggregator('cpu'), 'mem': MetricAggregator('mem')}
+        self.aggregators = aggregators
+        next_time_to_report = [time.monotonic() + report_time]
+
+        # Every sample is also stored in a binary series per collector
+        os.makedirs(self.series_dir, exist_ok=True)
+        writers = {}
+
+        def report():
+            for writer in writers.values():
+                writer.flush()
+            periods = {key: aggregator.end_period() for key, aggregator in aggregators.items()}
+            means = {key: period.mean for key, period in periods.items() if period.count}
+            if self.daemon_client is not None:
+                try:
+                    means.update(self.daemon_client.request('report', job=self.job_id)['periods'])
+                except (OSError, ValueError, KeyError):
+                    pass
+            if not means:
+                return
+            others = {key: round(mean, 2) for key, mean in means.items() if key not in ('cpu', 'mem')}
+            self.save_server_log(round(means.get('cpu', 0.0), 2), round(means.get('mem', 0.0), 2), log_dir, log_name,
+                                 others=others)
+
+        def on_sample(collector, values, timestamp):
+            for key, value in values.items():
+                if key not in aggregators:
+                    aggregators[key] = MetricAggregator(key)
+                aggregators[key].add(value)
+            columns = flatten_sample(values)
+            if collector.name not in writers and columns:  # The columns are fixed by the first sample with values
+                writers[collector.name] = TimeSeriesWriter(os.path.join(self.series_dir, collector.name + '.bin'),
+                                                           columns)
+            if collector.name in writers:
+                writers[collector.name].append(timestamp, columns)
             # Normal save
-            elif next_time_to_report <= 0:
-                cpu_avg_list.append(self.calc_avg_cpu_usage_percentage(cpu_list))
-                mem_avg_list.append(self.calc_avg_mem_usage_percentage(mem_list))
-                cpu_max_list.append(self.calc_max_cpu_usage(cpu_list))
-                mem_max_list.append(max(mem_list))
-                self.save_server_log(cpu_avg_list[-1], mem_avg_list[-1], log_dir, log_name)
-                cpu_list = []
-                mem_list = []
-                next_time_to_report = report_time
-
-    def calc_avg_cpu_usage_percentage(self, cpu_usage_list_divided_by_time):
-        avg_cpu_usage = 0
-        cnt = 0
-        for _sample in cpu_usage_list_divided_by_time:
-            for single_cpu_percentage in _sample:
-                avg_cpu_usage += single_cpu_percentage
-                cnt += 1
-        avg_cpu_usage = avg_cpu_usage / cnt
-        return round(avg_cpu_usage, 2)
-
-    def calc_max_cpu_usage(self, cpu_usage_list_divided_by_time):
-        max_cpu_usage = 0
-        for _sample in cpu_usage_list_divided_by_time:
-            avg_usage = 0
-            for single_cpu_percentage in _sample:
-                avg_usage += single_cpu_percentage
-            avg_usage /= len(_sample)
-            if avg_usage > max_cpu_usage:
-                max_cpu_usage = avg_usage
-        return round(max_cpu_usage, 2)
-
-    def calc_avg_mem_usage_percentage(self, mem_usage_list_divided_by_time):
-        avg_mem_usage = 0
-        for _sample in mem_usage_list_divided_by_time:
-            avg_mem_usage += _sample
-        avg_mem_usage = avg_mem_usage / len(mem_usage_list_divided_by_time)
-        return round(avg_mem_usage, 2)
-
-    def save_server_log(self, cpu_usage, mem_usage, log_dir, log_name):
+            if time.monotonic() >= next_time_to_report[0]:
+                report()
+                next_time_to_report[0] = time.monotonic() + report_time
+
+        # Sample until the process ends, each collector on its own schedule
+        sampler = Sampler(collectors, on_sample)
+        sampler.run(self.stop_event)
+
+        # Save and exit after process ends
+        report()
+        if self.daemon_client is not None:
+            # Statistics of the system metrics sampled by the daemon during this job
+            try:
+                states = self.daemon_client.request('finish', job=self.job_id)['states']
+                for key, state in states.items():
+                    aggregators[key] = MetricAggregator.from_state(state)
+            except (OSError, ValueError, KeyError) as e:
+                print('Cannot get the server status from the notify daemon: ', e)
+        cpu_run, mem_run = aggregators['cpu'].run, aggregators['mem'].run
+        self.monitor_summary = self.write_information_to_log(
+            log_dir, log_name, info_type='finish',
+            cpu_avg=round(cpu_run.mean, 2), mem_avg=round(mem_run.mean, 2),
+            cpu_max=round(cpu_run.max, 2) if cpu_run.count else '', mem_max=round(mem_run.max, 2) if mem_run.count else '',
+            cpu_std=round(cpu_run.std(), 2), mem_std=round(mem_run.std(), 2),
+            monitor_cpu_time=round(sampler.cpu_seconds, 3), monitor_overhead=round(sampler.overhead(), 3),
+            details=self.format_monitor_details(aggregators, sampler.errors, collectors))
+        for writer in writers.values():
+            writer.close()
+        self.close_server_log()
+        return 0
+
+    def format_monitor_details(self, aggregators, errors=None, collectors=None):
+        """
+        Format the percentiles of the CPU and memory usage, the per-core CPU usage and the other
+        collected metrics of the run.
+
+        Parameters
+        ----------
+        aggregators : dict
+            The MetricAggregator of each metric.
+
+        errors : dict, optional
+            The errors which stopped collectors, by collector name.
+
+        collectors : list, optional
+            The collectors, whose summary() lines are added (e.g. the process tree usage).
+
+        Returns
+        -------
+        str
+            The lines to add to the finish block of the log.
+        """
+        cpu_quantiles = aggregators['cpu'].quantiles.values()
+        mem_quantiles = aggregators['mem'].quantiles.values()
+        details = 'CPU p50 / p95 / p99:     %s\n' \
+                  'Memory p50 / p95 / p99:  %s\n' % \
+                  (' / '.join(str(round(cpu_quantiles[q], 2)) for q in (0.5, 0.95, 0.99)),
+                   ' / '.join(str(round(mem_quantiles[q], 2)) for q in (0.5, 0.95, 0.99)))
+
+        # Collector summaries, e.g. the usage of the notified program and its child processes
+        for collector in collectors or []:
+            try:
+                details += collector.summary()
+            except Exception as e:
+                details += 'Collector %s summary failed:  %r\n' % (collector.name, e)
+
+        cores = aggregators['cpu'].cores
+        core_means = cores.means()
+        if core_means:
+            imbalance, busiest, idlest = cores.imbalance()
+            details += 'Core Imbalance:          %s  | Busiest Core %s: %s  | Idlest Core %s: %s\n' % \
+                       (round(imbalance, 2), busiest, round(core_means[busiest], 2),
+                        idlest, round(core_means[idlest], 2))
+            details += 'Per-core Average / Maximum CPU Usage:\n'
+            items = ['core %-3s %6s / %-6s' % (i, round(mean, 1), round(cores.maxs[i], 1))
+                     for i, mean in enumerate(core_means)]
+            for i in range(0, len(items), 4):  # Four cores per line
+                details += '    ' + '  '.join(items[i:i + 4]) + '\n'
+
+        # Metrics of the other collectors
+        others = [aggregator for key, aggregator in aggregators.items() if key not in ('cpu', 'mem') and aggregator.run.count]
+        if others:
+            details += 'Other Metrics (Average / p95 / Maximum):\n'
+            for aggregator in others:
+                details += '    %-18s %s / %s / %s\n' % (aggregator.name, round(aggregator.run.mean, 3),
+                                                         round(aggregator.quantiles.values()[0.95], 3),
+                                                         round(aggregator.run.max, 3))
+        for name, error in (errors or {}).items():
+            details += 'Collector %s stopped:  %r\n' % (name, error)
+        return details
+
+    def save_server_log(self, cpu_usage, mem_usage, log_dir, log_name, others=None):
         now_time = time.strftime(f'%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
         format_save = 'Time: {:20s} | CPU: {:6s} | Mem: {:6s} '.format(now_time, str(cpu_usage), str(mem_usage))
-        with open(os.path.join(log_dir, log_name), mode="a", encoding="utf-8") as f:
-            f.write(format_save + '\n')
-            f.close()
+        for key, value in (others or {}).items():
+            format_save += '| {}: {} '.format(key, value)
+        self.open_server_log(log_dir, log_name).write(format_save + '\n')
+
+    def open_server_log(self, log_dir, log_name):
+        """Return the handle of the server status log, opened once and line buffered.
+        """
+        if self.server_log_file is None:
+            self.server_log_file = open(os.path.join(log_dir, log_name), mode="a", encoding="utf-8", buffering=1)
+        return self.server_log_file
+
+    def close_server_log(self):
+        if self.server_log_file is not None:
+            self.server_log_file.close()
+            self.server_log_file = None
+
+    def export_server_series(self, zip_path):
+        """
+        Export the series of every collector to a CSV file, downsampled to monitor_csv_points rows,
+        and pack them into one zip file.
+
+        Parameters
+        ----------
+        zip_path : str
+            The zip file to create.
+
+        Returns
+        -------
+        bool
+            Whether any series has been exported.
+        """
+        if not os.path.isdir(self.series_dir):
+            return False
+        series_names = sorted(name for name in os.listdir(self.series_dir) if name.endswith('.bin'))
+        if not series_names:
+            return False
+        import zipfile
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for series_name in series_names:
+                csv_path = os.path.join(self.series_dir, series_name[:-4] + '.csv')
+                with TimeSeriesReader(os.path.join(self.series_dir, series_name)) as reader:
+                    reader.to_csv(csv_path, points=self.monitor_csv_points, method=self.monitor_csv_method)
+                zf.write(csv_path, os.path.basename(csv_path))
+                os.remove(csv_path)
+        return True
 
     def write_information_to_log(self, log_dir, log_name, info_type, report_time=60, sample_time=5,
-                                 cpu_avg='', mem_avg='', cpu_max='', mem_max=''):
+                                 cpu_avg='', mem_avg='', cpu_max='', mem_max='', cpu_std='', mem_std='',
+                                 monitor_cpu_time='', monitor_overhead='', details=''):
         """
         Write statistical information to the beginning or end of the log.
 
@@ -253,9 +511,25 @@ class NotifyBackend(threading.Thread):
         mem_max : str, optional
             The maximum memory usage to be written to the log.
 
+        cpu_std : str, optional
+            The standard deviation of the CPU usage to be written to the log.
+
+        mem_std : str, optional
+            The standard deviation of the memory usage to be written to the log.
+
+        monitor_cpu_time : str, optional
+            The CPU time (in seconds) used by the monitor itself.
+
+        monitor_overhead : str, optional
+            The CPU usage (%) of the monitor itself over the run.
+
+        details : str, optional
+            Additional lines written at the end of the 'finish' block, e.g. percentiles and per-core usage.
+
         Returns
         -------
-        None
+        str
+            The statement written to the log.
         """
         current_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
         if info_type == 'init':
@@ -268,13 +542,16 @@ class NotifyBackend(threading.Thread):
             status_statement = '============================================\n' \
                            'Monitoring End Time:     %s\n' \
                            'Average CPU Usage:       %s  | Average Memory Usage:   %s\n' \
-                           'Maximum CPU Usage:       %s  | Maximum Memory Usage:   %s\n' % \
-                           (current_time, str(cpu_avg), str(mem_avg), str(cpu_max), str(mem_max))
+                           'Maximum CPU Usage:       %s  | Maximum Memory Usage:   %s\n' \
+                           'CPU Usage Std:           %s  | Memory Usage Std:       %s\n' \
+                           'Monitor CPU Time (s):    %s  | Monitor Overhead:       %s%%\n' \
+                           '%s' % \
+                           (current_time, str(cpu_avg), str(mem_avg), str(cpu_max), str(mem_max),
+                            str(cpu_std), str(mem_std), str(monitor_cpu_time), str(monitor_overhead), details)
         else:
             return 1
-        with open(os.path.join(log_dir, log_name), mode="a", encoding="utf-8") as f:
-            f.write(status_statement + '\n')
-            f.close()
+        self.open_server_log(log_dir, log_name).write(status_statement + '\n')
+        return status_statement
 
     '''
     ****************************************
@@ -298,10 +575,7 @@ class NotifyBackend(threading.Thread):
         func_name_path = os.path.join(self.log_folder_path, 'Func_Name.log')
 
         # Setup mail info
-        if os.path.exists(settings_path):
-            self.mail_list = []
-            for mail_recv in open(settings_path, 'r'):
-                self.mail_list.append(re.sub(r'\n', '', mail_recv))
+        self.load_mail_list(settings_path)
 
         # Setup time
         time_start = self.start_time
@@ -332,18 +606,13 @@ class NotifyBackend(threading.Thread):
         mail_title = '[' + source_server + '  LOG] ' + processing_log_name
 
         # Setup mail content
-        message = MIMEMultipart()
-        message['Subject'] = mail_title
-        message['From'] = self.mail_user
-
-        # Setup receipient (or recipients)
-        if len(self.mail_list) > 1:
-            message['To'] = ";".join(self.mail_list)
-        elif len(self.mail_list) == 1:  # If only one mailbox is specified, send to this mailbox
-            message['To'] = self.mail_list[0]
-        else:
+        # Attachments stay on disk, they are encoded chunk by chunk while sending.
+        if len(self.mail_list) == 0:
             print("mail_list problem occured!")
             return -1
+        from .mail_stream import StreamingMessage, split_message
+        from .outbox import Outbox
+        message = StreamingMessage(mail_title, self.mail_user, self.mail_list)
 
         # Setup mail body text
         running_info = "start time: %s \nend time: %s \nsource: %s \n=================\n\n" % (
@@ -364,40 +633,50 @@ class NotifyBackend(threading.Thread):
                     trans_body_content = l.read()
                     l.close()
                 running_info += ('\n' + trans_body_content)
-        message.attach(MIMEText(running_info, 'plain', 'utf-8'))
 
         # Manage appendixs
         self.prepare_trans_file()  # Compress user specified files (if exists)
         if os.path.exists(trans_file_zip_path):
             for zip_file in os.listdir(trans_file_zip_path):
-                zip_file_full_path = os.path.join(trans_file_zip_path, zip_file)
-                with open(zip_file_full_path, 'rb') as Af:
-                    file = Af.read()
-                try:
-                    Af.close()
-                    # Add appendix
-                    log_part = MIMEText(file, 'base64', 'utf-8')
-                    log_part["Content-Type"] = 'application/octet-stream'
-                    # filename is the name shown in the email.
-                    log_part["Content-Disposition"] = 'attachment; filename="%s"' % zip_file
-                    message.attach(log_part)
-                except:
-                    print("Erro occur in adding additional file:", zip_file)
-                else:
-                    print("An additional file has been added to the mail:", zip_file)
+                message.add_attachment(os.path.join(trans_file_zip_path, zip_file), zip_file)
+                print("An additional file has been added to the mail:", zip_file)
 
         # Block log generation
         # (stdout has been redefined as the Logger class during the import of notify,
         # so we directly call the functions of the Logger class here)
-        sys.stdout.close_log_and_put_back()
-
-        # Get print output: processing_log
+        if self.fd_capture is not None:
+            self.fd_capture.close()
         try:
-            # Read log file (as a text appendix file)
-            with open(log_cache_path, 'r', encoding='UTF-8') as l:
-                processing_log = l.read()
-                l.close()
-            if processing_log[0] is not '*':
+            sys.stdout.close_log_and_put_back()
+        except AttributeError:
+            pass  # sys.stdout has been replaced by someone else
+        log_segments = []  # Compressed segments of the log, before the last part in Log_Cache.log
+        if self.log_writer is not None:
+            self.log_writer.close()  # Final drain of the buffered output
+            log_segments = self.log_writer.segment_files()
+            if self.log_writer.dropped_bytes:
+                running_info += '\n[The attached log keeps its head and tail only, %s lines (%s bytes) dropped]\n' % \
+                                (format(self.log_writer.dropped_lines, ','), format(self.log_writer.dropped_bytes, ','))
+            output_filter = self.log_writer.output_filter
+            if output_filter is not None and output_filter.chars_out < output_filter.chars_in:
+                running_info += '\n[Progress bars and repeated lines collapsed in the attached log, %s of %s characters kept]\n' % \
+                                (format(output_filter.chars_out, ','), format(output_filter.chars_in, ','))
+        if self.additional_explain:
+            running_info += '\n' + self.additional_explain
+        if self.monitor_summary:
+            running_info += '\n[Server status]\n' + self.monitor_summary.lstrip('=\n')
+        message.set_body(running_info)
+
+        # Check print output: processing_log (only its title is read, the file is attached as it is)
+        try:
+            if log_segments and log_segments[0].endswith('.gz'):
+                import gzip
+                with gzip.open(log_segments[0], 'rb') as l:
+                    processing_log_title = l.read(1)
+            else:
+                with open(log_segments[0] if log_segments else log_cache_path, 'rb') as l:
+                    processing_log_title = l.read(1)
+            if processing_log_title != b'*':
                 print("processing log title erro")
         except Exception as e:
             print("processing log status erro: ", e)
@@ -405,12 +684,12 @@ class NotifyBackend(threading.Thread):
         else:
             print("processing log catched")
 
-        # Read server log: server_log
+        # Check server log: server_log
         try:
-            with open(server_status_path, 'r', encoding='UTF-8') as f:
-                server_log = f.read()
+            with open(server_status_path, 'rb') as f:
+                server_log_title = f.read(1)
                 f.close()
-            if server_log[0] is not '=':
+            if server_log_title != b'=':
                 print("server log title erro")
         except Exception as e:
             print("server log status erro: ", e)
@@ -419,30 +698,51 @@ class NotifyBackend(threading.Thread):
             print("server log catched")
 
         try:
-            # Appendix 1: processing_log
-            log_part = MIMEText(processing_log, 'base64', 'utf-8')
-            log_part["Content-Type"] = 'application/octet-stream'
-            file = processing_log_name + log_type
-            log_part[
-                "Content-Disposition"] = 'attachment; filename="%s"' % file
-            message.attach(log_part)
+            # Appendix 1: processing_log, the compressed segments are attached as they are
+            for index, segment_path in enumerate(log_segments):
+                message.add_attachment(segment_path, '%s.part%03d%s%s' % (processing_log_name, index + 1, log_type,
+                                                                          '.gz' if segment_path.endswith('.gz') else ''))
+            if log_segments:
+                message.add_attachment(log_cache_path, '%s.part%03d%s' % (processing_log_name, len(log_segments) + 1,
+                                                                           log_type))
+            else:
+                message.add_attachment(log_cache_path, processing_log_name + log_type)
 
             # Appendix 2: server_log
-            log_part = MIMEText(server_log, 'base64', 'utf-8')
-            log_part["Content-Type"] = 'application/octet-stream'
-            file = 'server_status' + log_type
-            log_part[
-                "Content-Disposition"] = 'attachment; filename="%s"' % file
-            message.attach(log_part)
-
-            # Instantiation, which is also the login process.
-            smtp = smtplib.SMTP_SSL(self.mail_host, timeout=3000)
-            smtp.ehlo(self.mail_host)
-            smtp.login(self.mail_user, self.mail_pass)
-            smtp.sendmail(self.mail_user, self.mail_list, message.as_string())
-            smtp.quit()
-            print('Log email sent successfully, title: ', mail_title)
-            print('If not found, please check the spam folder :)')
+            message.add_attachment(server_status_path, 'server_status' + log_type)
+
+            # Appendix 3: downsampled series of the server status
+            server_series_path = os.path.join(self.log_folder_path, 'server_series.zip')
+            if self.export_server_series(server_series_path):
+                message.add_attachment(server_series_path, 'server_series.zip')
+
+            # Serialize the message into the outbox first, so it is not lost if the delivery fails.
+            # Messages left by previous runs of the same account are retried too.
+            # A message over the size limit of the provider is split into numbered emails.
+            outbox = Outbox(os.path.join(self.log_root_path, '.notify_outbox'))
+            parts = split_message(message, self.mail_max_size)
+            if len(parts) > 1:
+                print('The log email is split into %d emails of at most %s bytes' % (len(parts),
+                                                                                   format(self.mail_max_size, ',')))
+            item_paths = [outbox.put(part, mail_host=self.mail_host) for part in parts]
+            if self.daemon_client is not None and self.hand_over_outbox(item_paths):
+                print('Log email handed over to the notify daemon, title: ', mail_title)
+                sent, left = 0, 0
+                run_status = 'queued'
+            else:
+                self.deliver_outbox(outbox, deadline=time.monotonic() + self.send_deadline)
+                # Only the messages of this run decide its status, the outbox may hold older ones
+                left = sum(os.path.isdir(item_path) for item_path in item_paths)
+                failed = sum(os.path.isdir(os.path.join(outbox.failed_dir, os.path.basename(item_path)))
+                             for item_path in item_paths)
+                sent = len(item_paths) - left - failed
+                run_status = 'failed' if failed else 'queued' if left else 'sent'
+            if left:
+                print('%s message(s) could not be sent yet and wait in %s. They will be sent by the next run '
+                      'or by notify.flush_outbox().' % (left, outbox.outbox_dir))
+            elif sent == len(item_paths):
+                print('Log email sent successfully, title: ', mail_title)
+                print('If not found, please check the spam folder :)')
 
             # Move log & remove obsolete data
             try:
@@ -452,12 +752,148 @@ class NotifyBackend(threading.Thread):
 
             new_root_path = os.path.join(self.log_root_path, call_func_name)
             new_folder_path = os.path.join(new_root_path, self.log_folder_name)
-            if not os.path.exists(new_root_path):
-                os.mkdir(new_root_path)
-            self.delete_obsolete_log(new_root_path)
-            shutil.move(self.log_folder_path, new_root_path)
+            os.makedirs(new_root_path, exist_ok=True)
+            if new_folder_path != self.log_folder_path:
+                suffix = 0
+                while True:
+                    try:
+                        os.rename(self.log_folder_path, new_folder_path)  # Fails if the target folder exists
+                        break
+                    except OSError:
+                        if not os.path.isdir(new_folder_path):
+                            raise
+                    suffix += 1  # Another run of the same program started within the same second
+                    new_folder_path = os.path.join(new_root_path, f'{self.log_folder_name}-{suffix}')
+            self.end_run(new_folder_path, run_status)
         except Exception as e:
             print('Failed to send the mail: ', e)
+            self.end_run(self.log_folder_path, 'failed')
+
+    def end_run(self, folder_path, status):
+        """Record the end of the run in the retention index and remove obsolete runs.
+        """
+        self.run_ended = True
+        if self.retention is None:
+            return
+        try:
+            self.retention.end_run(self.run_id, os.path.relpath(folder_path, self.log_root_path), status)
+        except OSError as e:
+            print('Failed to update the log index: ', e)
+        self.retention.prune()
+
+    def deliver_outbox(self, outbox, deadline=None):
+        """
+        Deliver the messages of the outbox, the first attempt over the connection prepared by smtp_session.
+
+        Returns
+        -------
+        tuple
+            (number of messages sent, number of messages of this account left in the outbox).
+        """
+        connections = [0]
+
+        def connect():
+            connections[0] += 1
+            session = self.get_smtp_session()
+            return session.acquire() if connections[0] == 1 else session.connect()
+
+        return outbox.deliver(connect, deadline=deadline, account=(self.mail_host, self.mail_user))
+
+    def hand_over_outbox(self, item_paths):
+        """
+        Hand the outbox items of this run over to the notify daemon, which sends them with its SMTP connection pool.
+        Items left by other runs may belong to other accounts, they are sent by flush_outbox() or the next
+        local delivery.
+
+        Parameters
+        ----------
+        item_paths : list
+            The outbox items just put by this run.
+
+        Returns
+        -------
+        bool
+            Whether the daemon took all of them. Otherwise the remaining ones are sent here.
+        """
+        try:
+            for item_path in item_paths:
+                self.daemon_client.request('submit', item=os.path.abspath(item_path), smtp=self.smtp_settings)
+        except (OSError, ValueError) as e:
+            print('The notify daemon did not take the email, sending it here: ', e)
+            return False
+        return True
+
+    def load_mail_list(self, settings_path):
+        """Read the recipients set by send_log() (if any) from Settings.log.
+        """
+        if os.path.exists(settings_path):
+            self.mail_list = []
+            for mail_recv in open(settings_path, 'r'):
+                self.mail_list.append(re.sub(r'\n', '', mail_recv))
+
+    def send_progress_email(self, notes):
+        """
+        Send a progress mail with the output since the previous progress mail, the new add_text() content
+        and the monitoring statistics so far. Called by the ProgressReporter thread.
+
+        Parameters
+        ----------
+        notes : list
+            The notes passed to send_progress() since the previous progress mail.
+        """
+        self.load_mail_list(os.path.join(self.log_folder_path, 'Settings.log'))
+        if not self.mail_list:
+            return
+        try:
+            with open(os.path.join(self.log_folder_path, 'Func_Name.log'), 'r') as l:
+                call_func_name = l.read()
+        except OSError:
+            call_func_name = 'default'
+        source_server = self.get_host_name()
+        now = time.time()
+        mail_title = '[%s  PROGRESS] %s__%s #%s' % (source_server, call_func_name,
+                                                    time.strftime('%Y_%m_%d-%H_%M_%S', time.localtime(self.start_time)),
+                                                    self.progress.sent + 1)
+
+        running_info = "start time: %s \nnow: %s (running for %s) \nsource: %s \n=================\n" % (
+            time.strftime('%Y_%m_%d  %H:%M:%S', time.localtime(self.start_time)),
+            time.strftime('%Y_%m_%d  %H:%M:%S', time.localtime(now)),
+            time.strftime('%H:%M:%S', time.gmtime(now - self.start_time)), source_server)
+        if notes:
+            running_info += '\n[Notes]\n' + '\n'.join(notes) + '\n'
+
+        # New add_text() content, read from where the previous progress mail stopped
+        trans_body_path = os.path.join(self.log_folder_path, 'Trans_Body.log')
+        if os.path.exists(trans_body_path):
+            with open(trans_body_path, 'rb') as f:
+                f.seek(self.progress_body_offset)
+                new_text = f.read()
+            self.progress_body_offset += len(new_text)
+            if new_text:
+                running_info += '\n[New text]\n' + new_text.decode('utf-8', 'replace')
+
+        # Monitoring statistics so far
+        stats = [(key, aggregator) for key, aggregator in list(self.aggregators.items()) if aggregator.run.count]
+        if stats:
+            running_info += '\n[Server status]  now / average / maximum\n'
+            for key, aggregator in stats:
+                recent = aggregator.recent.to_list()
+                running_info += '    %-18s %s / %s / %s\n' % (key, round(recent[-1], 2) if recent else '',
+                                                             round(aggregator.run.mean, 2), round(aggregator.run.max, 2))
+
+        # Output since the previous progress mail
+        if self.log_writer is not None and self.log_writer.recent_limit:
+            output, self.progress_position, skipped = self.log_writer.read_since(self.progress_position)
+            running_info += '\n[New output]\n'
+            if skipped:
+                running_info += '[%s bytes of earlier output are only in the final log]\n' % format(skipped, ',')
+            running_info += output
+
+        from .mail_stream import StreamingMessage, send_streaming
+        message = StreamingMessage(mail_title, self.mail_user, self.mail_list)
+        message.set_body(running_info)
+        with self.get_smtp_session().connection() as smtp:
+            send_streaming(smtp, message)
 
     def prepare_trans_file(self):
         """
@@ -480,10 +916,20 @@ class NotifyBackend(threading.Thread):
             if not os.path.exists(trans_file_zip_path):
                 os.mkdir(trans_file_zip_path)
 
+            # Compressed members are reused across runs (if enabled)
+            if self.zip_cache_size:
+                from .compress import MemberCache
+                self.zip_cache = MemberCache(os.path.join(self.log_root_path, '.notify_zip_cache'),
+                                             max_size=self.zip_cache_size, hash_content=self.zip_cache_hash)
+
             # Read all files and compress them into Temp_Zip_File
+            added_paths = set()
             for file_path in open(trans_file_log_path, 'r'):
                 file_path = re.sub(r'\n', '', file_path)
-                full_path = os.path.join(os.getcwd(), file_path)
+                full_path = os.path.normpath(os.path.join(os.getcwd(), file_path))
+                if full_path in added_paths:
+                    continue  # The same path is added more than once
+                added_paths.add(full_path)
                 if os.path.exists(full_path):
                     zip_file_name = re.findall(r'[^/\\]+$', file_path)[0]  # zip file name (same as original file name)
                     zip_err = self.zipDir(full_path, os.path.join(trans_file_zip_path, zip_file_name))  # Compress & save
@@ -492,9 +938,25 @@ class NotifyBackend(threading.Thread):
                 else:
                     print('cannot zip file: ', file_path)
 
+            # Compression summary, also appended to the mail body
+            for zip_file_name, stats in self.zip_stats:
+                zip_summary = '%s: %d files, %.2f MB -> %.2f MB in %.2f s (%.2f MB/s, %d workers)' % \
+                              (zip_file_name, stats['files'], stats['bytes_in'] / 1e6, stats['bytes_out'] / 1e6,
+                               stats['seconds'], stats['bytes_in'] / 1e6 / max(stats['seconds'], 1e-6),
+                               self.zip_workers or os.cpu_count() or 1)
+                if stats['cached']:
+                    zip_summary += ', %d files reused from the cache' % stats['cached']
+                for codec, codec_stats in sorted(stats['codecs'].items()):
+                    zip_summary += '\n  - %-8s %d files, %.2f MB saved in %.2f s' % \
+                                   (codec + ':', codec_stats['files'],
+                                    (codec_stats['bytes_in'] - codec_stats['bytes_out']) / 1e6, codec_stats['seconds'])
+                print(zip_summary)
+                self.additional_explain += zip_summary + '\n'
+
     def zipDir(self, dirpath, outFullPath):
         """
         Compresses the specified folder to the specified path.
+        Files are compressed in parallel by ParallelZipper, see self.zip_workers.
 
         Parameters
         ----------
@@ -504,50 +966,19 @@ class NotifyBackend(threading.Thread):
         outFullPath : str
             Output path for the compressed file. Example: 'aaa/bbb/c.zip'
         """
+        from .compress import ParallelZipper
         try:
-            zip = zipfile.ZipFile(outFullPath + '.zip', 'w', zipfile.ZIP_DEFLATED)
-            # Directory: iterally compress
-            if os.path.isdir(dirpath):
-                for path, dirnames, filenames in os.walk(dirpath):
-                    # only compress the files and folders under the target folder (including the parent folder itself)
-                    parent_path = os.path.abspath('.')  # Parent folder
-                    fpath = path.replace(dirpath, '')  # Child folder
-                    for filename in filenames:
-                        zip.write(os.path.join(path, filename),
-                                  os.path.join(fpath, filename))
-                zip.close()
-            # File: compress directly
-            elif os.path.isfile(dirpath):
-                zip.write(dirpath, re.findall(r'[^/\\]+$', outFullPath)[0])
-                zip.close()
+            zipper = ParallelZipper(workers=self.zip_workers, codec=self.zip_codec, fast=self.zip_fast,
+                                    spool_dir=self.log_folder_path, cache=self.zip_cache)
+            stats = zipper.zip_path(dirpath, outFullPath + '.zip')
         except Exception as e:
             return e
+        self.zip_stats.append((os.path.basename(outFullPath) + '.zip', stats))
         return 0
 
-    def delete_obsolete_log(self, log_root_path):
-        """
-        Check and remove early logs.
-
-        Parameters
-        ----------
-        log_root_path : str
-            The root path where logs are stored. This function will check for early logs
-            in this directory and remove them if necessary.
-        """
-        create_time_dict = {}
-        create_time_list = []
-        for file_name in os.listdir(log_root_path):
-            c_time = int(time.mktime(time.strptime(file_name, '%Y_%m_%d-%H_%M_%S')))
-            create_time_list.append(c_time)
-            create_time_dict[c_time] = file_name
-        if len(create_time_list) >= self.max_log_under_root_path - 1:
-            create_time_list.sort()
-            for c_time in create_time_list[:-self.max_log_under_root_path + 1]:
-                shutil.rmtree(os.path.join(log_root_path, create_time_dict[c_time]))
-                print('obsolete log deleted: ', create_time_dict[c_time])
-
     def get_host_name(self):
         """Get server hostname
         """
+        import socket
         return socket.gethostname()
 
@@ -1,16 +1,7 @@
-import threading
 import os
-import psutil
-import re
-import socket
 import sys
 import time
-import shutil
-import zipfile
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from .tools import Logger
+from .tools import Logger, LogWriter
 from .notify_backend import NotifyBackend
 
 
@@ -36,7 +27,16 @@ class NotifyFrontend:
     - class NotifyFrontend
     """
 
-    def __init__(self, log_root_path, mail_host, mail_user, mail_pass, default_receiving_list, max_log_cnt=5, init_import=False):
+    def __init__(self, log_root_path, mail_host, mail_user, mail_pass, default_receiving_list, max_log_cnt=5, init_import=False,
+                 log_buffer_size=0, log_flush_interval=1.0,
+                 log_head_limit=None, log_tail_limit=None, log_limit_unit='bytes', log_segment_size=0,
+                 log_collapse=False, log_progress_interval=None, log_max_bytes=None, log_max_age=None,
+                 zip_workers=None, zip_codec='deflate', zip_fast=False, zip_cache_size=0, zip_cache_hash=False,
+                 monitor_intervals=None, monitor_collectors=None, monitor_csv_points=1000, monitor_csv_method='lttb',
+                 mail_port=None, mail_ssl=True, smtp_prewarm=False, mail_max_size=20 * 1000 * 1000,
+                 progress_interval=None, progress_burst=3, progress_refill=600, progress_tail_bytes=32768,
+                 smtp_timeout=120, send_deadline=300, daemon_socket=None, capture_children=False,
+                 capture_mode='python'):
         """
         Initialize NotifyFrontend.
 
@@ -63,6 +63,127 @@ class NotifyFrontend:
         
         init_import : bool
             Set to True during import.
+
+        log_buffer_size : int, optional
+            Buffered capture mode. If greater than 0, print outputs are batched in memory and written to
+            Log_Cache.log by a background thread once this many characters are pending. Default is 0 (write through).
+
+        log_flush_interval : float, optional
+            In buffered capture mode, the maximum time (in seconds) a print output stays in memory before it
+            is written to Log_Cache.log. Default is 1.0.
+
+        log_head_limit : int, optional
+            Keep only the first log_head_limit bytes (or lines) of the print outputs, plus the tail. Default is None (no limit).
+
+        log_tail_limit : int, optional
+            Keep only the last log_tail_limit bytes (or lines) of the print outputs, plus the head. Default is None (no limit).
+
+        log_limit_unit : str, optional
+            'bytes' or 'lines', the unit of log_head_limit and log_tail_limit. Default is 'bytes'.
+
+        log_segment_size : int, optional
+            Write Log_Cache.log in segments of this many bytes. Closed segments are gzipped by a low-priority
+            background thread while the program runs and attached to the email as they are. Default is 0 (one file).
+
+        log_collapse : bool, optional
+            Keep only the final state of lines redrawn with '\r' (progress bars) in Log_Cache.log, and write runs
+            of identical lines once followed by '[repeated N×]'. The terminal output is unchanged. Default is False.
+
+        log_progress_interval : float, optional
+            With log_collapse, also keep one state of a redrawn line every this many seconds. Default is None
+            (final state only).
+
+        log_max_bytes : int, optional
+            Total size (in bytes) of the runs kept under log_root_path, across all programs. The oldest finished
+            runs are removed first. Default is None (no limit).
+
+        log_max_age : float, optional
+            Age (in days) after which a run is removed. Default is None (no limit).
+
+        zip_workers : int, optional
+            Number of threads compressing the files added by add_file(). Default is None (the number of CPUs).
+
+        zip_codec : str, optional
+            Codec for compressible files: 'deflate', 'bzip2' or 'lzma'. Files which are compressed already
+            (by type or by sampled entropy) are stored. Default is 'deflate'.
+
+        zip_fast : bool, optional
+            Fast codec mode, deflate at level 1 for all compressible files. Default is False.
+
+        zip_cache_size : int, optional
+            Keep compressed files in a cache under log_root_path, so unchanged files are not compressed again
+            in the next run. This is the size budget (in bytes) of the cache. Default is 0 (no cache).
+
+        zip_cache_hash : bool, optional
+            Identify cached files by their content hash instead of size and modification time. Default is False.
+
+        monitor_intervals : dict, optional
+            Time interval (in seconds) between samples of each monitoring collector, e.g. {'cpu': 0.25, 'mem': 1}.
+            Default is None (the default interval of each collector, e.g. CPU every 0.25 s, memory every second).
+
+        monitor_collectors : list, optional
+            Monitoring collectors to run: names of registered collectors ('cpu', 'mem', 'disk_io', 'net', 'load',
+            'swap', 'disk_free', 'process' or registered with register_collector()), Collector subclasses or Collector objects.
+            Default is None (all registered collectors).
+
+        monitor_csv_points : int, optional
+            Every sample is kept in binary series files of the log folder. The series attached to the email
+            (server_series.zip, one CSV per collector) are downsampled to this number of rows. Default is 1000.
+
+        monitor_csv_method : str, optional
+            Downsampling method of the attached series, 'lttb' (largest triangle three buckets, keeps the shape)
+            or 'minmax' (keeps the minimum and maximum of every bucket). Default is 'lttb'.
+
+        mail_port : int, optional
+            The SMTP server port. Default is None (465 with SSL, 25 without).
+
+        mail_ssl : bool, optional
+            Connect to the SMTP server with SSL, otherwise with STARTTLS if the server offers it. Default is True.
+
+        smtp_prewarm : bool, optional
+            Connect and log in to the SMTP server in the background at setup, keep the connection alive and
+            reuse it for the final email. A rejected login is reported at once. Default is False.
+
+        mail_max_size : int, optional
+            Size limit (in bytes) of one email, base64 encoding included. A bigger notification is split into
+            numbered emails, large attachments into volumes 'name.001', 'name.002', ... which are joined with
+            `cat name.0* > name`. The emails are sent over one connection. Default is 20000000 (20 MB), set it
+            to the limit of the provider, or 0 to never split.
+
+        progress_interval : float, optional
+            Time interval (in seconds) between periodic progress mails. Default is None (only on send_progress()).
+
+        progress_burst : int, optional
+            Maximum number of progress mails sent in a burst. Default is 3.
+
+        progress_refill : float, optional
+            Time (in seconds) after which one more progress mail is allowed. Requests beyond the limit are merged
+            into the next mail. Default is 600.
+
+        progress_tail_bytes : int, optional
+            Maximum size (in bytes) of the new output carried by a progress mail. Default is 32768.
+
+        smtp_timeout : float, optional
+            Socket timeout (in seconds) of the SMTP connections. Default is 120.
+
+        send_deadline : float, optional
+            Time (in seconds) spent at most on delivering the final email (retries included) after the program ends.
+            Unsent messages stay in the outbox under log_root_path, see flush_outbox(). Default is 300.
+
+        daemon_socket : str or bool, optional
+            Socket of the notify daemon (`python -m notifyemail daemon`), True for its default path. If the daemon
+            answers, it samples the system metrics for all jobs of the node and sends the final email with its
+            pool of SMTP connections. Otherwise everything runs locally. Default is None (no daemon).
+
+        capture_children : bool, optional
+            Also capture the output of child processes: forked and spawned multiprocessing workers, Python
+            subprocesses importing notifyemail, and programs started with popen(). Each line is tagged with the
+            name and PID of its process in Log_Cache.log. Default is False.
+
+        capture_mode : str, optional
+            'python' replaces sys.stdout and sys.stderr. 'fd' redirects file descriptors 1 and 2 to pipes, so the
+            output of C extensions, native libraries, os.system() and child processes is captured as well (untagged,
+            capture_children is not used in this mode). Default is 'python'.
         """
         self.log_root_path = log_root_path
         self.mail_host = mail_host
@@ -70,6 +191,50 @@ class NotifyFrontend:
         self.mail_pass = mail_pass
         self.default_receiving_list = default_receiving_list
         self.max_log_cnt = max_log_cnt
+        self.log_buffer_size = log_buffer_size
+        self.log_flush_interval = log_flush_interval
+        self.log_head_limit = log_head_limit
+        self.log_tail_limit = log_tail_limit
+        self.log_limit_unit = log_limit_unit
+        self.log_segment_size = log_segment_size
+        self.log_collapse = log_collapse
+        self.log_progress_interval = log_progress_interval
+        self.log_max_bytes = log_max_bytes
+        self.log_max_age = log_max_age
+        self.retention = None
+        self.zip_workers = zip_workers
+        if zip_codec not in ['deflate', 'bzip2', 'lzma']:
+            raise ValueError(f'zip_codec should be "deflate", "bzip2" or "lzma", got {zip_codec}')
+        self.zip_codec = zip_codec
+        self.zip_fast = zip_fast
+        self.zip_cache_size = zip_cache_size
+        self.zip_cache_hash = zip_cache_hash
+        self.monitor_intervals = monitor_intervals
+        self.monitor_collectors = monitor_collectors
+        self.monitor_csv_points = monitor_csv_points
+        if monitor_csv_method not in ['lttb', 'minmax']:
+            raise ValueError(f'monitor_csv_method should be "lttb" or "minmax", got {monitor_csv_method}')
+        self.monitor_csv_method = monitor_csv_method
+        self.mail_port = mail_port
+        self.mail_ssl = mail_ssl
+        self.smtp_prewarm = smtp_prewarm
+        self.mail_max_size = mail_max_size
+        self.progress_interval = progress_interval
+        self.progress_burst = progress_burst
+        self.progress_refill = progress_refill
+        self.progress_tail_bytes = progress_tail_bytes
+        self.smtp_timeout = smtp_timeout
+        self.send_deadline = send_deadline
+        self.daemon_socket = daemon_socket
+        self.capture_children = capture_children
+        self.child_capture = None
+        if capture_mode not in ['python', 'fd']:
+            raise ValueError(f'capture_mode should be "python" or "fd", got {capture_mode}')
+        if capture_mode == 'fd' and capture_children:
+            raise ValueError('capture_children is not used with capture_mode="fd", child processes write to the captured descriptors')
+        self.capture_mode = capture_mode
+        self.fd_capture = None
+        self.notify_backend = None
 
         # Only the NotifyFrontend with empty value is called during importing the module.
         if init_import:
@@ -82,10 +247,20 @@ class NotifyFrontend:
             call_func_name = 'default'
 
             self.log_creation_path = os.path.join(self.log_root_path, call_func_name)  # log main dir = log root dir + program name.
-            self.max_log_under_root_path = self.max_log_cnt  # max log count under log root directory. If exceed, remove earliest log.
 
+            # Create directories
+            os.makedirs(self.log_creation_path, exist_ok=True)
+
+            # Runs are recorded in an index under log_root_path, obsolete runs are removed in the background.
+            # The run folder is created under the lock of the index, so runs started within the same second,
+            # in any process, get distinct folders.
+            from .retention import RetentionManager
+            self.retention = RetentionManager(self.log_root_path, max_count=self.max_log_cnt,
+                                              max_bytes=self.log_max_bytes, max_age=self.log_max_age)
             log_folder_name = time.strftime('%Y_%m_%d-%H_%M_%S', time.localtime(time.time()))  # Use current time as sub-folder name.
+            run_id, log_folder_name = self.retention.start_run(call_func_name, log_folder_name)
             self.log_folder_path = os.path.join(self.log_creation_path, log_folder_name)
+            self.retention.prune_async()
 
             # All "print" outputs are saved into this file.
             self.log_cache_path = os.path.join(self.log_folder_path, 'Log_Cache.log')
@@ -104,20 +279,31 @@ class NotifyFrontend:
             # File to save the function names. This file is used for internal logging purposes.
             self.func_name_path = os.path.join(self.log_folder_path, 'Func_Name.log')
 
-            # Create directories
-            if not os.path.exists(self.log_root_path):
-                os.mkdir(self.log_root_path)
-            if not os.path.exists(self.log_creation_path):
-                os.mkdir(self.log_creation_path)
-            if os.path.exists(self.log_folder_path):
-                os.rmdir(self.log_folder_path)
-            os.mkdir(self.log_folder_path)
-
-            self.delete_obsolete_log()  # Remove obsolete logs
-
             # Redirect print output to the file. When program ends, exit.
-            sys.stdout = Logger(self.log_cache_path, path=os.getcwd())  # Normal output
-            sys.stderr = Logger(self.log_cache_path, path=os.getcwd())  # Warning output
+            # Both streams share one writer, so their outputs keep the printing order in the log.
+            self.log_writer = LogWriter(os.path.join(os.getcwd(), self.log_cache_path),
+                                        buffer_size=self.log_buffer_size,
+                                        flush_interval=self.log_flush_interval,
+                                        head_limit=self.log_head_limit,
+                                        tail_limit=self.log_tail_limit,
+                                        limit_unit=self.log_limit_unit,
+                                        segment_size=self.log_segment_size,
+                                        collapse=self.log_collapse,
+                                        progress_interval=self.log_progress_interval,
+                                        # Periodic progress mails need the recent output from the start,
+                                        # for send_progress() alone it is kept from the first call on
+                                        recent_limit=self.progress_tail_bytes if self.progress_interval else 0)
+            if self.capture_children:
+                from .child_capture import ChildOutputCollector
+                self.child_capture = ChildOutputCollector(self.log_writer, terminal=sys.stdout)
+                self.child_capture.start()
+            if self.capture_mode == 'fd':
+                from .fd_capture import FdCapture
+                self.fd_capture = FdCapture(self.log_writer)
+                self.fd_capture.start()
+            else:
+                sys.stdout = Logger(stream_name='stdout', log_writer=self.log_writer)  # Normal output
+                sys.stderr = Logger(stream_name='stderr', log_writer=self.log_writer)  # Warning output
 
             # Write into log header
             fileName = time.strftime('LOG_Cache_' + '%Y_%m_%d_%H_%M', time.localtime(time.time()))
@@ -126,8 +312,25 @@ class NotifyFrontend:
             # Start notify background process
             notify_backend_thread = NotifyBackend(self.log_root_path, log_folder_name, mail_host=self.mail_host,
                                                   mail_user=self.mail_user,
-                                                  mail_pass=self.mail_pass, mail_list=self.default_receiving_list)
+                                                  mail_pass=self.mail_pass, mail_list=self.default_receiving_list,
+                                                  log_writer=self.log_writer, zip_workers=self.zip_workers,
+                                                  zip_codec=self.zip_codec, zip_fast=self.zip_fast,
+                                                  zip_cache_size=self.zip_cache_size, zip_cache_hash=self.zip_cache_hash,
+                                                  monitor_intervals=self.monitor_intervals,
+                                                  monitor_collectors=self.monitor_collectors,
+                                                  monitor_csv_points=self.monitor_csv_points,
+                                                  monitor_csv_method=self.monitor_csv_method,
+                                                  mail_port=self.mail_port, mail_ssl=self.mail_ssl,
+                                                  smtp_prewarm=self.smtp_prewarm, mail_max_size=self.mail_max_size,
+                                                  progress_interval=self.progress_interval,
+                                                  progress_burst=self.progress_burst,
+                                                  progress_refill=self.progress_refill,
+                                                  smtp_timeout=self.smtp_timeout, send_deadline=self.send_deadline,
+                                                  daemon_socket=self.daemon_socket,
+                                                  child_capture=self.child_capture, fd_capture=self.fd_capture,
+                                                  retention=self.retention, run_id=run_id)
             notify_backend_thread.start()
+            self.notify_backend = notify_backend_thread
 
         # If you went here, it means you have not given enough parameters.
         else:
@@ -135,30 +338,15 @@ class NotifyFrontend:
                 [param_name for param_name in ['log_root_path', 'mail_host', 'mail_user', 'mail_pass'] if getattr(self, param_name) is None]
             raise ValueError(f'You have not setup the following parameters: {empty_params}')
 
-    def reboost(self, log_root_path, mail_host, mail_user, mail_pass, default_receiving_list=None, max_log_cnt=5):
-        """Re-initialize NotifyFrontend.
+    def reboost(self, log_root_path, mail_host, mail_user, mail_pass, default_receiving_list=None, max_log_cnt=5, **kwargs):
+        """Re-initialize NotifyFrontend. Additional keyword arguments are passed to __init__.
         """
         if default_receiving_list == None:
             default_receiving_list = mail_user
 
         self.__init__(log_root_path=log_root_path, mail_host=mail_host,
                       mail_user=mail_user, mail_pass=mail_pass,
-                      default_receiving_list=default_receiving_list, max_log_cnt=max_log_cnt)
-
-    def delete_obsolete_log(self):
-        """Remove obsolete log.
-        """
-        create_time_dict = {}
-        create_time_list = []
-        for file_name in os.listdir(self.log_creation_path):
-            c_time = int(time.mktime(time.strptime(file_name, '%Y_%m_%d-%H_%M_%S')))
-            create_time_list.append(c_time)
-            create_time_dict[c_time] = file_name
-        if len(create_time_list) >= self.max_log_under_root_path - 1:
-            create_time_list.sort()
-            for c_time in create_time_list[:-self.max_log_under_root_path + 1]:
-                shutil.rmtree(os.path.join(self.log_creation_path, create_time_dict[c_time]))
-                print('obsolete log deleted: ', create_time_dict[c_time])
+                      default_receiving_list=default_receiving_list, max_log_cnt=max_log_cnt, **kwargs)
 
     def add_a_text(self, text_input):
         with open(self.trans_body_path, 'a') as file_object:
@@ -168,6 +356,45 @@ class NotifyFrontend:
         with open(self.trans_file_path, 'a') as file_object:
             file_object.write(file_dir + '\n')
 
+    def send_progress(self, note=None):
+        """Ask NotifyBackend for a progress mail, sent as soon as the rate limit allows it.
+        """
+        if self.notify_backend is not None:
+            if self.log_writer is not None:
+                self.log_writer.keep_recent(self.progress_tail_bytes)
+            self.notify_backend.progress.request(note)
+
+    def popen(self, args, name=None, **kwargs):
+        """Start a subprocess, its output goes to the log if capture_children is on. See ChildOutputCollector.popen().
+        """
+        if self.child_capture is None:
+            import subprocess
+            return subprocess.Popen(args, **kwargs)
+        return self.child_capture.popen(args, name=name, **kwargs)
+
+    def flush_outbox(self, deadline=None):
+        """
+        Send the messages left in the outbox under log_root_path by runs of the current mail account (mail_host
+        and mail_user), with the current mail settings. Messages of other accounts are left to them.
+
+        Parameters
+        ----------
+        deadline : float, optional
+            Time (in seconds) spent at most, retrying with backoff. Default is None (one attempt per message).
+
+        Returns
+        -------
+        tuple
+            (number of messages sent, number of messages of this account left in the outbox).
+        """
+        from .outbox import Outbox
+        from .smtp_session import SmtpSession
+        outbox = Outbox(os.path.join(self.log_root_path, '.notify_outbox'))
+        session = SmtpSession(self.mail_host, self.mail_user, self.mail_pass, mail_port=self.mail_port,
+                              mail_ssl=self.mail_ssl, timeout=self.smtp_timeout)
+        return outbox.deliver(session.connect, deadline=None if deadline is None else time.monotonic() + deadline,
+                              force=True, account=(self.mail_host, self.mail_user))
+
     def send_log(self, mail_list, call_func_name):
         """
         Write email addresses and the program name to a file for NotifyBackend to access.
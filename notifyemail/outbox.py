@@ -0,0 +1,394 @@
+import json
+import os
+import random
+import shutil
+import smtplib
+import time
+import uuid
+
+import psutil
+
+from .mail_stream import StreamingMessage, send_streaming
+
+
+class SpooledMessage(object):
+    """
+    A message of the outbox, sent with send_streaming() straight from the files of its item.
+
+    The envelope holds the subject, the body text and the attachment list of the message, whose files are
+    linked (or copied) into the item folder, and the attachments are base64-encoded while sending.
+    Items spooled by older versions hold the serialized message in message.eml instead.
+
+    Inputs:
+    - item_path : str
+        The outbox item.
+
+    - envelope : dict
+        The envelope of the item.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, item_path, envelope):
+        self.item_path = item_path
+        self.envelope = envelope
+        self.mail_user = envelope['mail_user']
+        self.mail_list = envelope['mail_list']
+
+    def iter_chunks(self):
+        """Yield the message in chunks which end with a line break, as send_streaming() expects.
+        """
+        spooled = self.envelope.get('message')
+        if spooled is not None:
+            message = StreamingMessage(self.envelope['subject'], self.mail_user, self.mail_list)
+            message.boundary = spooled['boundary']
+            message.set_body(spooled['body'])
+            for file_name, shown_name, offset, length in spooled['attachments']:
+                message.add_attachment(os.path.join(self.item_path, file_name), shown_name, offset, length)
+            yield from message.iter_chunks()
+            return
+
+        rest = b''
+        with open(os.path.join(self.item_path, 'message.eml'), 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                data = rest + data
+                end = data.rfind(b'\n') + 1
+                rest = data[end:]
+                if end:
+                    yield data[:end]
+        if rest:
+            yield rest + b'\r\n'
+
+
+class Outbox(object):
+    """
+    On-disk spool of the messages waiting for delivery.
+
+    Every message is spooled with its envelope into its own folder, which is renamed into place
+    once complete, so a crash never leaves a partial item. deliver() sends the due items and retries
+    failed ones with exponential backoff and jitter. Items still unsent when the deadline is reached
+    stay in the spool for the next run or for flush_outbox() / `python -m notifyemail flush`.
+    Messages refused permanently by the server (5xx) are moved to the 'failed' folder.
+
+    Inputs:
+    - outbox_dir : str
+        The spool folder, created if needed.
+
+    - backoff_base : float, optional
+        Delay (in seconds) before the first retry. Default is 10.
+
+    - backoff_max : float, optional
+        Maximum delay (in seconds) between two attempts. Default is 3600.
+    """
+
+    def __init__(self, outbox_dir, backoff_base=10, backoff_max=3600):
+        self.outbox_dir = outbox_dir
+        self.failed_dir = os.path.join(outbox_dir, 'failed')
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        os.makedirs(self.outbox_dir, exist_ok=True)
+
+    def put(self, message, mail_host=None):
+        """
+        Spool a StreamingMessage. Its attachment files are hard-linked into the item (copied if the file
+        system has no hard links), so the item does not depend on the log folder, which is moved or pruned
+        later. The message is encoded again when it is sent, not stored encoded.
+
+        Returns
+        -------
+        str
+            The path of the new item.
+        """
+        # Items are sent in the order of their names, the microseconds keep the parts of a split email in order
+        now = time.time()
+        name = '%s.%06d-%s' % (time.strftime('%Y_%m_%d-%H_%M_%S', time.localtime(now)), int(now % 1 * 1e6),
+                               uuid.uuid4().hex[:8])
+        temp_path = os.path.join(self.outbox_dir, '.' + name)
+        os.makedirs(temp_path)
+        spooled_files = {}  # Source path: file name in the item, the volumes of a split file share one file
+        attachments = []
+        for file_path, file_name, offset, length in message.attachments:
+            if file_path not in spooled_files:
+                spooled_files[file_path] = 'attachment%03d' % len(spooled_files)
+                spooled_path = os.path.join(temp_path, spooled_files[file_path])
+                try:
+                    os.link(file_path, spooled_path)
+                except OSError:
+                    shutil.copyfile(file_path, spooled_path)
+            attachments.append([spooled_files[file_path], file_name, offset, length])
+        envelope = {'subject': message.subject, 'mail_user': message.mail_user, 'mail_list': list(message.mail_list),
+                    'mail_host': mail_host, 'created': time.time(), 'attempts': 0, 'next_attempt': 0,
+                    'last_error': None,
+                    'message': {'body': message.body, 'boundary': message.boundary, 'attachments': attachments}}
+        self.write_envelope(temp_path, envelope)
+        item_path = os.path.join(self.outbox_dir, name)
+        os.rename(temp_path, item_path)
+        return item_path
+
+    def items(self, account=None):
+        """
+        Paths of the items in the spool, oldest first. Items claimed by another living process are skipped,
+        and with account=(mail_host, mail_user) the items spooled by other accounts too.
+        """
+        return [os.path.join(self.outbox_dir, name) for name in sorted(os.listdir(self.outbox_dir))
+                if not name.startswith('.') and name != 'failed'
+                and os.path.exists(os.path.join(self.outbox_dir, name, 'envelope.json'))
+                and not self.is_claimed(os.path.join(self.outbox_dir, name))
+                and (account is None or self.belongs_to(os.path.join(self.outbox_dir, name), account))]
+
+    def belongs_to(self, item_path, account):
+        """Whether an item was spooled by the account (mail_host, mail_user), so it can be sent with its login.
+        """
+        mail_host, mail_user = account
+        try:
+            envelope = self.read_envelope(item_path)
+        except FileNotFoundError:
+            return False  # Sent by another process meanwhile
+        return envelope['mail_user'] == mail_user and envelope.get('mail_host') in (None, mail_host)
+
+    @staticmethod
+    def claim(item_path):
+        """
+        Mark an item as being delivered by this process, so other runs and the notify daemon leave it alone.
+        The claim file is created atomically, a claim left by a dead process is taken over.
+
+        Returns
+        -------
+        bool
+            Whether this process holds the claim. False if another living process does, or the item is gone.
+        """
+        claim_path = os.path.join(item_path, 'claim')
+        new_path = '%s.new-%d' % (claim_path, os.getpid())
+        try:
+            with open(new_path, 'w') as f:
+                f.write(str(os.getpid()))
+        except FileNotFoundError:
+            return False  # Sent and removed by another process
+        try:
+            for _ in range(3):
+                try:
+                    os.link(new_path, claim_path)  # Atomic, and the claim is never seen empty
+                    return True
+                except FileExistsError:
+                    pass
+                except FileNotFoundError:
+                    raise
+                except OSError:  # No hard links on this file system
+                    try:
+                        with open(claim_path, 'x') as f:
+                            f.write(str(os.getpid()))
+                        return True
+                    except FileExistsError:
+                        pass
+                if Outbox.is_claimed(item_path):
+                    return False
+                try:
+                    with open(claim_path, 'r') as f:
+                        if f.read() == str(os.getpid()):
+                            return True  # Claimed by this process already
+                    # Expired claim: only one of the processes taking it over can rename it away
+                    old_path = '%s.old-%d' % (claim_path, os.getpid())
+                    os.rename(claim_path, old_path)
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+            return False
+        except FileNotFoundError:
+            return False
+        finally:
+            try:
+                os.remove(new_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def release(item_path):
+        """Give up the claim of this process on an item, so the next attempt can be made by any run.
+        """
+        claim_path = os.path.join(item_path, 'claim')
+        try:
+            with open(claim_path, 'r') as f:
+                if f.read() != str(os.getpid()):
+                    return
+            os.remove(claim_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def is_claimed(item_path):
+        try:
+            with open(os.path.join(item_path, 'claim'), 'r') as f:
+                pid = int(f.read() or 0)
+        except (OSError, ValueError):
+            return False
+        return pid != os.getpid() and psutil.pid_exists(pid)  # The claim of a dead process has expired
+
+    @staticmethod
+    def read_envelope(item_path):
+        with open(os.path.join(item_path, 'envelope.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_envelope(item_path, envelope):
+        temp_path = os.path.join(item_path, 'envelope.json.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(envelope, f)
+        os.replace(temp_path, os.path.join(item_path, 'envelope.json'))
+
+    def backoff(self, attempts):
+        """Delay before the next attempt: exponential, capped, with +-50% jitter.
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** max(attempts - 1, 0))
+        return delay * random.uniform(0.5, 1.5)
+
+    def deliver(self, connect, deadline=None, force=False, account=None):
+        """
+        Send the due items over one connection, retrying until all are sent or the deadline is reached.
+
+        Parameters
+        ----------
+        connect : callable
+            Return a logged-in SMTP connection, called again after a connection error.
+
+        deadline : float, optional
+            time.monotonic() value after which no more retry is started. Every due item is attempted at least once.
+            Default is None (one pass only).
+
+        force : bool, optional
+            Ignore the backoff delays of the items in the first pass. Default is False.
+
+        account : tuple, optional
+            (mail_host, mail_user) of the login made by connect. Only the items spooled by this account are sent,
+            the others would go out under the wrong login. Default is None (all items).
+
+        Returns
+        -------
+        tuple
+            (number of items sent, number of items of the account left in the spool).
+        """
+        smtp = None
+        sent = 0
+        first_pass = True  # Every due item gets one attempt, the deadline only limits the retries
+        try:
+            while True:
+                pending = self.items(account)
+                if not pending:
+                    break
+                now = time.time()
+                due = [item for item in pending if force or self.next_attempt(item) <= now]
+                force = False
+                for item_path in due:
+                    if not first_pass and time.monotonic() > deadline:
+                        break
+                    if not self.claim(item_path):
+                        continue  # Being sent by another process, or sent already
+                    if smtp is None:
+                        try:
+                            smtp = connect()
+                        except smtplib.SMTPAuthenticationError as e:
+                            print('Outbox delivery stopped, the SMTP server rejected the login: ', e)
+                            self.release(item_path)
+                            return sent, len(self.items(account))
+                        except (smtplib.SMTPException, OSError) as e:
+                            self.release(item_path)
+                            self.record_failure(due[due.index(item_path):], e)
+                            break
+                    try:
+                        envelope = self.read_envelope(item_path)
+                    except FileNotFoundError:
+                        continue  # Sent and removed by another process which did not see the claim
+                    try:
+                        self.send_item(item_path, smtp, envelope)
+                        sent += 1
+                    except smtplib.SMTPServerDisconnected as e:
+                        self.record_failure([item_path], e)
+                        self.release(item_path)
+                        smtp = self.close_quietly(smtp)
+                    except smtplib.SMTPException as e:  # Before OSError, its base class
+                        if self.is_permanent(e):
+                            self.move_to_failed(item_path, e)
+                        else:
+                            self.record_failure([item_path], e)
+                            self.release(item_path)
+                    except OSError as e:  # Also a spooled file gone while sending, the connection is left within DATA
+                        self.record_failure([item_path], e)
+                        self.release(item_path)
+                        smtp = self.close_quietly(smtp)
+
+                # Wait for the next due item, within the deadline
+                first_pass = False
+                pending = self.items(account)
+                if not pending or deadline is None:
+                    break
+                next_attempt = min(self.next_attempt(item) for item in pending)
+                if next_attempt == float('inf'):
+                    break  # All sent by another process meanwhile
+                wait = next_attempt - time.time()
+                if time.monotonic() + max(wait, 0) > deadline:
+                    break
+                smtp = self.close_quietly(smtp)  # Do not keep an idle connection during the backoff
+                if wait > 0:
+                    time.sleep(wait)
+        finally:
+            if smtp is not None:
+                try:
+                    smtp.quit()
+                except (smtplib.SMTPException, OSError):
+                    self.close_quietly(smtp)
+        return sent, len(self.items(account))
+
+    @staticmethod
+    def is_permanent(error):
+        """Whether the server refused the message for good (5xx reply), so retrying is useless.
+        """
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(500 <= code < 600 for code, resp in error.recipients.values())
+        return 500 <= getattr(error, 'smtp_code', 0) < 600
+
+    def send_item(self, item_path, smtp, envelope=None):
+        if envelope is None:
+            envelope = self.read_envelope(item_path)
+        refused = send_streaming(smtp, SpooledMessage(item_path, envelope))
+        if refused:
+            print('Some recipients were refused: ', refused)
+        shutil.rmtree(item_path)
+
+    def next_attempt(self, item_path):
+        """Time of the next attempt of an item, infinity if another process has sent it meanwhile.
+        """
+        try:
+            return self.read_envelope(item_path)['next_attempt']
+        except FileNotFoundError:
+            return float('inf')
+
+    def record_failure(self, item_paths, error):
+        for item_path in item_paths:
+            try:
+                envelope = self.read_envelope(item_path)
+            except FileNotFoundError:
+                continue  # Sent by another process meanwhile
+            envelope['attempts'] += 1
+            envelope['next_attempt'] = time.time() + self.backoff(envelope['attempts'])
+            envelope['last_error'] = repr(error)
+            self.write_envelope(item_path, envelope)
+
+    def move_to_failed(self, item_path, error):
+        envelope = self.read_envelope(item_path)
+        envelope['last_error'] = repr(error)
+        self.write_envelope(item_path, envelope)
+        self.release(item_path)
+        os.makedirs(self.failed_dir, exist_ok=True)
+        shutil.move(item_path, os.path.join(self.failed_dir, os.path.basename(item_path)))
+        print('The SMTP server refused the message, moved to %s: %r' % (self.failed_dir, error))
+
+    @staticmethod
+    def close_quietly(smtp):
+        if smtp is not None:
+            try:
+                smtp.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
@@ -0,0 +1,130 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter: at most `capacity` actions in a burst, then one more every `refill` seconds.
+
+    Inputs:
+    - capacity : int
+        Maximum number of tokens (the burst size).
+
+    - refill : float
+        Time (in seconds) to earn one token back.
+    """
+
+    def __init__(self, capacity=3, refill=600):
+        self.capacity = capacity
+        self.refill = refill
+        self.tokens = float(capacity)
+        self.last_time = time.monotonic()
+
+    def update(self):
+        now = time.monotonic()
+        if self.refill > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) / self.refill)
+        else:
+            self.tokens = float(self.capacity)
+        self.last_time = now
+
+    def take(self):
+        """Take a token if one is available, return whether it was taken.
+        """
+        self.update()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """Time (in seconds) until a token is available.
+        """
+        self.update()
+        return max(0.0, (1 - self.tokens) * self.refill)
+
+
+class ProgressReporter(object):
+    """
+    Send progress emails in a background thread, periodically and on request.
+
+    Requests are coalesced: while a mail cannot be sent because of the rate limit, further requests
+    only add their notes to the pending mail, which is sent once a token is available.
+
+    Inputs:
+    - send : callable
+        Called as send(notes) to build and send one progress mail, notes being the list of the notes
+        of the coalesced requests.
+
+    - interval : float, optional
+        Time interval (in seconds) between periodic progress mails. Default is None (on request only).
+
+    - burst : int, optional
+        Maximum number of progress mails sent in a burst. Default is 3.
+
+    - refill : float, optional
+        Time (in seconds) after which one more progress mail is allowed. Default is 600.
+    """
+
+    def __init__(self, send, interval=None, burst=3, refill=600):
+        self.send = send
+        self.interval = interval
+        self.bucket = TokenBucket(burst, refill)
+        self.notes = []  # Notes of the pending requests
+        self.requested = False
+        self.sent = 0
+        self.coalesced = 0  # Requests merged into another mail
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='notify-progress', daemon=True)
+        self.thread.start()
+
+    def request(self, note=None):
+        """Ask for a progress mail as soon as the rate limit allows it.
+        """
+        with self.lock:
+            if self.requested:
+                self.coalesced += 1
+            self.requested = True
+            if note:
+                self.notes.append(str(note))
+        self.wakeup.set()
+
+    def run(self):
+        next_time = time.monotonic() + self.interval if self.interval else None
+        while not self.stopped:
+            timeout = None if next_time is None else max(0.0, next_time - time.monotonic())
+            with self.lock:
+                if self.requested:
+                    timeout = self.bucket.wait_time() if timeout is None else min(timeout, self.bucket.wait_time())
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            if self.stopped:
+                break
+
+            if next_time is not None and time.monotonic() >= next_time:
+                with self.lock:
+                    self.requested = True
+                next_time = time.monotonic() + self.interval
+
+            with self.lock:
+                if not self.requested or not self.bucket.take():
+                    continue
+                notes, self.notes, self.requested = self.notes, [], False
+            try:
+                self.send(notes)
+                self.sent += 1
+            except Exception as e:
+                print('Failed to send the progress mail: ', e)
+
+    def stop(self):
+        """Stop the thread, pending requests are dropped (the final mail follows).
+        """
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,315 @@
+"""
+Retention of the run folders under log_root_path.
+
+Every run appends one line to an index (.notify_runs.jsonl under log_root_path) when it starts and one
+when it ends, with its folder, start time, status and size. Obsolete runs are then found from the index
+alone, without listing and parsing the log folders, and removed by a background thread. The folders of
+an existing log_root_path are added to the index once, by the first pruning which finds no index.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+from contextlib import contextmanager
+
+INDEX_NAME = '.notify_runs.jsonl'
+FOLDER_TIME_FORMAT = '%Y_%m_%d-%H_%M_%S'
+
+
+def folder_size(path):
+    """Total size (in bytes) of the files under path.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass  # Removed meanwhile
+    return total
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True  # Exists, but owned by another user
+    return True
+
+
+class RunIndex(object):
+    """
+    Append-only index of the runs under log_root_path, one JSON record per line.
+
+    A record holds the run 'id' and the fields which changed: 'path' (the run folder, relative to
+    log_root_path), 'group' (the call_func_name folder), 'start' (time), 'pid', 'status' ('running', 'sent',
+    'queued', 'failed', 'crashed', 'unknown' or 'deleted') and 'bytes'. Later records of a run update the
+    earlier ones. Records without id mark the folders of log_root_path as scanned. Processes sharing
+    log_root_path serialize their writes with a lock on the index.
+
+    Inputs:
+    - log_root_path : str
+        The root directory of the logs.
+    """
+
+    def __init__(self, log_root_path):
+        self.log_root_path = log_root_path
+        self.index_path = os.path.join(log_root_path, INDEX_NAME)
+        self.lock_path = self.index_path + '.lock'
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of the index. Appending and compacting the index are done under it.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None  # Not available on Windows, runs rarely prune at the same time
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def append(self, *records, locked=False):
+        """Append records to the index, taking the lock unless the caller holds it already.
+        """
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        if not locked:
+            with self.locked():
+                return self.append(*records, locked=True)
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(data)
+
+    def load(self):
+        """
+        Read the index. The caller holds the lock.
+
+        Returns
+        -------
+        tuple
+            ({run id: merged record}, number of lines, whether the folders were scanned).
+        """
+        runs = {}
+        lines = 0
+        scanned = False
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut by a crash
+                    run_id = record.get('id')
+                    if run_id is None:
+                        scanned = True
+                    else:
+                        runs.setdefault(run_id, {}).update(record)
+        except FileNotFoundError:
+            pass
+        return runs, lines, scanned
+
+    def rewrite(self, runs):
+        """Replace the index with one line per run. The caller holds the lock.
+        """
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'scanned': time.time()}) + '\n')
+            for run in runs.values():
+                f.write(json.dumps(run, separators=(',', ':')) + '\n')
+        os.replace(temp_path, self.index_path)
+
+    def scan(self, runs):
+        """
+        Records of the run folders of log_root_path which are not in runs, for history older than the index.
+        Run folders are the subfolders of the call_func_name folders named after their creation time.
+        """
+        indexed = set(run.get('path') for run in runs.values())
+        records = []
+        for group in os.scandir(self.log_root_path):
+            if not group.is_dir() or group.name.startswith('.'):
+                continue  # Outbox, caches and stray files
+            for entry in os.scandir(group.path):
+                path = os.path.join(group.name, entry.name)
+                if not entry.is_dir() or path in indexed:
+                    continue
+                # Runs started within the same second get a suffix
+                try:
+                    start = time.mktime(time.strptime(entry.name[:19], FOLDER_TIME_FORMAT))
+                except ValueError:
+                    continue  # Not a log folder
+                records.append({'id': path, 'path': path, 'group': group.name, 'start': start,
+                                'status': 'unknown', 'bytes': folder_size(entry.path)})
+        return records
+
+
+class RetentionManager(object):
+    """
+    Keep the run folders under log_root_path within count, size and age quotas.
+
+    The quotas apply to finished runs, the oldest are removed first. Runs still running are never removed,
+    runs whose process is gone without an end record are marked crashed and treated as finished.
+
+    Inputs:
+    - log_root_path : str
+        The root directory of the logs.
+
+    - max_count : int, optional
+        Number of runs kept in each call_func_name folder. Default is 5.
+
+    - max_bytes : int, optional
+        Total size (in bytes) of the runs kept under log_root_path, across all call_func_name folders.
+        Default is None (no limit).
+
+    - max_age : float, optional
+        Age (in days) after which a run is removed. Default is None (no limit).
+    """
+
+    def __init__(self, log_root_path, max_count=5, max_bytes=None, max_age=None):
+        self.log_root_path = log_root_path
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index = RunIndex(log_root_path)
+        self.thread = None
+
+    def start_run(self, group, folder_name):
+        """
+        Create the folder of a new run under log_root_path/group and record it in the index. Costs one
+        mkdir and one append, whatever the size of the history.
+
+        Returns
+        -------
+        tuple
+            (run id, folder name). Runs started within the same second get a suffix: '-1', '-2', ...
+        """
+        with self.index.locked():  # Pruning never sees the folder without its record
+            suffix = 0
+            while True:
+                name = folder_name + (f'-{suffix}' if suffix else '')
+                try:
+                    os.mkdir(os.path.join(self.log_root_path, group, name))
+                    break
+                except FileExistsError:
+                    suffix += 1  # Another run started within the same second, maybe in another process
+            run_id = '%s-%d' % (name, os.getpid())
+            self.index.append({'id': run_id, 'path': os.path.join(group, name), 'group': group, 'start': time.time(),
+                               'pid': os.getpid(), 'status': 'running'}, locked=True)
+        return run_id, name
+
+    def end_run(self, run_id, path, status):
+        """Record the end of a run, now in the folder path, with its status and size.
+        """
+        size = folder_size(os.path.join(self.log_root_path, path))
+        self.index.append({'id': run_id, 'path': path, 'group': os.path.dirname(path), 'status': status,
+                           'bytes': size})
+
+    def prune_async(self):
+        """Prune in a background thread.
+        """
+        self.thread = threading.Thread(target=self.prune, name='notify-retention', daemon=True)
+        self.thread.start()
+
+    def prune(self):
+        """
+        Remove the runs beyond the quotas.
+
+        Returns
+        -------
+        list
+            The removed run folders, relative to log_root_path.
+        """
+        try:
+            with self.index.locked():
+                runs, lines, scanned = self.index.load()
+            # Listing the folders and measuring sizes can be slow on a large history, this is done without
+            # the lock so setup() in other processes is not held up, and merged into the index afterwards.
+            loaded = {run_id: run.get('status') for run_id, run in runs.items()}
+            updates = [] if scanned else self.index.scan(runs)
+            for record in updates:
+                runs[record['id']] = record
+            obsolete = self.select(runs, updates)
+
+            with self.index.locked():
+                current, lines, scanned = self.index.load()
+                # Runs which changed meanwhile (started, ended or pruned by another process) are left alone
+                owners = {run.get('path'): run_id for run_id, run in current.items()}
+
+                def unchanged(record):
+                    if record['id'] in current:
+                        return current[record['id']].get('status') == loaded.get(record['id'])
+                    return record.get('path') not in owners  # Folder found by the scan
+
+                obsolete = [run for run in obsolete if unchanged(run)]
+                updates = [record for record in updates if unchanged(record)]
+                for record in updates:
+                    current.setdefault(record['id'], {}).update(record)
+                if not scanned or lines > 2 * len(current) + 100:
+                    # Compact the index, forgetting the runs deleted before
+                    self.index.rewrite({run_id: run for run_id, run in current.items() if run.get('status') != 'deleted'})
+                elif updates:
+                    self.index.append(*updates, locked=True)
+
+            removed = []
+            for run in obsolete:
+                shutil.rmtree(os.path.join(self.log_root_path, run['path']), ignore_errors=True)
+                removed.append(run['path'])
+            if removed:
+                self.index.append(*[{'id': run['id'], 'status': 'deleted'} for run in obsolete])
+            for path in removed:
+                print('obsolete log deleted: ', path)
+            return removed
+        except OSError as e:
+            print('Failed to remove obsolete logs: ', e)
+            return []
+
+    def select(self, runs, updates):
+        """Return the runs to remove. Runs found crashed or gone are updated in place and added to updates.
+        """
+        finished = []
+        kept = {}  # Runs kept in each group, finished or not
+        for run in sorted(runs.values(), key=lambda run: run.get('start', 0), reverse=True):
+            status = run.get('status')
+            if status == 'deleted':
+                continue
+            if not os.path.isdir(os.path.join(self.log_root_path, run.get('path', ''))):
+                if status != 'running':  # Removed by hand (a running run may be moving)
+                    run['status'] = 'deleted'
+                    updates.append({'id': run['id'], 'status': 'deleted'})
+                continue
+            if status == 'running':
+                if run.get('pid') == os.getpid() or pid_alive(run.get('pid', 0)):
+                    kept[run.get('group')] = kept.get(run.get('group'), 0) + 1
+                    continue
+                run['status'] = 'crashed'
+                run['bytes'] = folder_size(os.path.join(self.log_root_path, run['path']))
+                updates.append({'id': run['id'], 'status': 'crashed', 'bytes': run['bytes']})
+            finished.append(run)
+
+        obsolete = []
+        total = 0  # Bytes of the kept runs
+        over_bytes = False
+        min_start = None if self.max_age is None else time.time() - self.max_age * 86400
+        for run in finished:  # Newest first
+            group = run.get('group')
+            if kept.get(group, 0) >= self.max_count or (min_start is not None and run.get('start', 0) < min_start):
+                obsolete.append(run)
+                continue
+            # Only the kept runs count against max_bytes. Once over it, all older runs are removed too
+            if self.max_bytes is not None and total + run.get('bytes', 0) > self.max_bytes:
+                over_bytes = True
+            if over_bytes:
+                obsolete.append(run)
+                continue
+            kept[group] = kept.get(group, 0) + 1
+            total += run.get('bytes', 0)
+        return obsolete
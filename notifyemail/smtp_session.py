@@ -0,0 +1,168 @@
+import smtplib
+import sys
+import threading
+from contextlib import contextmanager
+
+
+class SmtpSession(object):
+    """
+    A logged-in SMTP connection which can be opened in advance.
+
+    With start(), a background thread connects and logs in right away, so a rejected login is reported
+    when the program starts instead of when it ends. The connection is then kept alive with NOOP
+    commands, and opened again if the server closed it. acquire() returns the live connection for the
+    final email, so the TLS handshake and the authentication are off the critical path.
+
+    Inputs:
+    - mail_host : str
+        The SMTP server hostname, 'host:port' is accepted.
+
+    - mail_user : str
+        The email account used for sending notifications.
+
+    - mail_pass : str
+        The authorization code for the email account.
+
+    - mail_port : int, optional
+        The SMTP server port. Default is None (465 with SSL, 25 without, or the port in mail_host).
+
+    - mail_ssl : bool, optional
+        Connect with SSL. Otherwise STARTTLS is used when the server offers it. Default is True.
+
+    - timeout : float, optional
+        Socket timeout (in seconds). Default is 3000.
+
+    - keepalive : float, optional
+        Time interval (in seconds) between two NOOP commands on the idle connection. Default is 60.
+    """
+
+    def __init__(self, mail_host, mail_user, mail_pass, mail_port=None, mail_ssl=True, timeout=3000, keepalive=60):
+        self.mail_host = mail_host
+        self.mail_user = mail_user
+        self.mail_pass = mail_pass
+        self.mail_port = mail_port
+        self.mail_ssl = mail_ssl
+        self.timeout = timeout
+        self.keepalive = keepalive
+
+        self.smtp = None
+        self.error = None  # Last connection or login error
+        self.lock = threading.Lock()  # Serializes the keep-alive thread and acquire()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def connect(self):
+        """Open a new connection and log in.
+        """
+        smtp_class = smtplib.SMTP_SSL if self.mail_ssl else smtplib.SMTP
+        if self.mail_port:
+            smtp = smtp_class(self.mail_host, self.mail_port, timeout=self.timeout)
+        else:
+            smtp = smtp_class(self.mail_host, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if not self.mail_ssl and smtp.has_extn('starttls'):
+                smtp.starttls()
+                smtp.ehlo()
+            smtp.login(self.mail_user, self.mail_pass)
+        except BaseException:
+            self.close_quietly(smtp)
+            raise
+        return smtp
+
+    def start(self):
+        """Connect and log in in the background, then keep the connection alive until acquire() or close().
+        """
+        self.thread = threading.Thread(target=self.keepalive_loop, name='notify-smtp', daemon=True)
+        self.thread.start()
+
+    def keepalive_loop(self):
+        with self.lock:
+            self.open_or_report()
+        while not self.stop_event.wait(self.keepalive):
+            with self.lock:
+                if self.stop_event.is_set():
+                    break
+                if not self.is_alive():
+                    self.open_or_report()
+
+    def open_or_report(self):
+        """(Re)connect while holding the lock. An error is kept and reported instead of raised.
+        """
+        self.close_quietly(self.smtp)
+        self.smtp = None
+        try:
+            self.smtp = self.connect()
+            self.error = None
+        except smtplib.SMTPAuthenticationError as e:
+            self.error = e
+            self.stop_event.set()  # Retrying the same credentials is useless
+            sys.stderr.write('[notifyemail] The SMTP server rejected the login of %s: %s\n' % (self.mail_user, e))
+        except (smtplib.SMTPException, OSError) as e:
+            self.error = e
+            sys.stderr.write('[notifyemail] Cannot connect to the SMTP server %s: %r\n' % (self.mail_host, e))
+
+    def is_alive(self):
+        if self.smtp is None:
+            return False
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def acquire(self):
+        """
+        Stop the keep-alive thread and return a logged-in connection, the prepared one if it is still alive.
+        The caller owns the connection and should quit() it.
+        """
+        self.stop_event.set()
+        with self.lock:
+            smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            try:
+                if smtp.noop()[0] == 250:
+                    return smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close_quietly(smtp)
+        return self.connect()
+
+    @contextmanager
+    def connection(self):
+        """
+        Use the session connection during the run (e.g. for a progress mail), opening it if needed.
+        Without the keep-alive thread the connection is closed afterwards.
+        """
+        with self.lock:
+            if not self.is_alive():
+                self.close_quietly(self.smtp)
+                self.smtp = None
+                self.smtp = self.connect()
+            try:
+                yield self.smtp
+            except BaseException:
+                self.close_quietly(self.smtp)
+                self.smtp = None
+                raise
+            finally:
+                if self.thread is None and self.smtp is not None:
+                    self.close_quietly(self.smtp)
+                    self.smtp = None
+
+    def close(self):
+        self.stop_event.set()
+        with self.lock:
+            smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.close_quietly(smtp)
+
+    @staticmethod
+    def close_quietly(smtp):
+        if smtp is not None:
+            try:
+                smtp.close()
+            except (smtplib.SMTPException, OSError):
+                pass
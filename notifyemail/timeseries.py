@@ -0,0 +1,223 @@
+import csv
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'NTS1'
+
+
+def flatten_sample(values):
+    """
+    Flatten the values of a collector sample into float columns.
+    A list (e.g. per-core usage) becomes its mean under the metric name, plus one column per item.
+    """
+    columns = {}
+    for key, value in values.items():
+        if isinstance(value, (list, tuple)):
+            columns[key] = sum(value) / len(value) if value else math.nan
+            for i, item in enumerate(value):
+                columns['%s_%s' % (key, i)] = float(item)
+        else:
+            columns[key] = float(value)
+    return columns
+
+
+class TimeSeriesWriter(object):
+    """
+    Append-only binary columnar file of the samples of one collector.
+
+    The file starts with a header (magic, byte order, column names), followed by fixed-width records:
+    the timestamp and one double per column. Missing values are stored as NaN. Records are written
+    through a buffered handle which stays open, and can be memory-mapped by TimeSeriesReader.
+
+    Inputs:
+    - path : str
+        The file to create.
+
+    - columns : list
+        The column names, the timestamp column excluded.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.record = struct.Struct('=%sd' % (len(self.columns) + 1))
+        self.file = open(path, 'wb')
+        names = b'\0'.join(column.encode('utf-8') for column in self.columns)
+        header = MAGIC + sys.byteorder[0].encode('ascii') + struct.pack('<II', len(self.columns), len(names)) + names
+        header += b'\0' * (-len(header) % 8)  # Records start at a multiple of 8 bytes
+        self.file.write(header)
+        self.count = 0
+
+    def append(self, timestamp, columns):
+        self.file.write(self.record.pack(timestamp, *[columns.get(column, math.nan) for column in self.columns]))
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class TimeSeriesReader(object):
+    """
+    Read a file written by TimeSeriesWriter. The records are memory-mapped, a column is read
+    with a strided view without parsing the file.
+
+    Inputs:
+    - path : str
+        The file to read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            head = f.read(13)
+            if head[:4] != MAGIC:
+                raise ValueError('%s is not a notifyemail time series file' % path)
+            self.byteorder = 'little' if head[4:5] == b'l' else 'big'
+            n_columns, names_size = struct.unpack('<II', head[5:13])
+            names = f.read(names_size)
+        self.columns = names.decode('utf-8').split('\0') if n_columns else []
+        self.width = len(self.columns) + 1
+        self.offset = 13 + names_size + (-(13 + names_size) % 8)
+        size = os.path.getsize(path)
+        self.count = max(size - self.offset, 0) // (8 * self.width)  # A partly written last record is ignored
+
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def column(self, name, indices=None):
+        """
+        Values of a column ('time' for the timestamps) as an array of doubles, optionally only at the given row indices.
+        """
+        position = 0 if name == 'time' else self.columns.index(name) + 1
+        if not self.count:
+            return array('d')
+        end = self.offset + self.count * self.width * 8
+        if self.byteorder == sys.byteorder:
+            with memoryview(self.mmap)[self.offset:end] as raw, raw.cast('d') as view:
+                values = array('d', view[position::self.width])
+        else:
+            values = array('d', self.mmap[self.offset:end])
+            values.byteswap()
+            values = values[position::self.width]
+        if indices is not None:
+            values = array('d', (values[i] for i in indices))
+        return values
+
+    def to_csv(self, csv_path, points=None, method='lttb', key_column=None):
+        """
+        Export the series to a CSV file, downsampled to at most `points` rows.
+
+        Parameters
+        ----------
+        csv_path : str
+            The CSV file to write.
+
+        points : int, optional
+            Maximum number of rows. Default is None (all records).
+
+        method : str, optional
+            Downsampling method, 'lttb' (largest triangle three buckets) or 'minmax' (the minimum and
+            maximum of every bucket). Default is 'lttb'.
+
+        key_column : str, optional
+            The column whose shape is kept by the downsampling. Default is None (the first column).
+
+        Returns
+        -------
+        int
+            Number of rows written.
+        """
+        times = self.column('time')
+        indices = None
+        if points and self.count > points and self.columns:
+            values = self.column(key_column or self.columns[0])
+            if method == 'minmax':
+                indices = minmax_indices(values, points)
+            elif method == 'lttb':
+                indices = lttb_indices(times, values, points)
+            else:
+                raise ValueError('Unknown downsampling method %r, use lttb or minmax' % method)
+        columns = [self.column('time', indices)] + [self.column(name, indices) for name in self.columns]
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time'] + self.columns)
+            for row in zip(*columns):
+                writer.writerow(['%.3f' % row[0]] + ['' if math.isnan(value) else '%.6g' % value for value in row[1:]])
+        return len(columns[0])
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+
+def lttb_indices(xs, ys, points):
+    """
+    Row indices kept by the largest triangle three buckets downsampling of (xs, ys) to `points` rows.
+    The first and the last rows are always kept. NaN values count as 0.
+    """
+    n = len(xs)
+    if points >= n:
+        return list(range(n))
+    if points < 3:
+        return [0, n - 1][:max(points, 1)]
+    ys = [0.0 if math.isnan(y) else y for y in ys]
+
+    bucket = (n - 2) / (points - 2)
+    indices = [0]
+    a = 0
+    for i in range(points - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        next_end = min(int((i + 2) * bucket) + 1, n)
+        avg_x = sum(xs[end:next_end]) / (next_end - end)
+        avg_y = sum(ys[end:next_end]) / (next_end - end)
+
+        # Keep the point making the largest triangle with the previous kept point and the next bucket average
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        indices.append(best)
+        a = best
+    indices.append(n - 1)
+    return indices
+
+
+def minmax_indices(ys, points):
+    """
+    Row indices of the minimum and the maximum of every bucket, at most `points` rows in time order.
+    """
+    n = len(ys)
+    if points >= n:
+        return list(range(n))
+    buckets = max(points // 2, 1)
+    indices = []
+    for i in range(buckets):
+        start, end = i * n // buckets, (i + 1) * n // buckets
+        if start == end:
+            continue
+        rows = [j for j in range(start, end) if not math.isnan(ys[j])] or [start]
+        low = min(rows, key=ys.__getitem__)
+        high = max(rows, key=ys.__getitem__)
+        indices.extend(sorted({low, high}))
+    return indices
@@ -1,25 +1,493 @@
+import collections
 import threading
 import os
-import psutil
-import re
-import socket
 import sys
 import time
-import shutil
-import zipfile
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+
+
+def utf8_boundary(data, pos):
+    """Move pos forward to the start of the next UTF-8 character, so that data is never cut inside a character.
+    """
+    while pos < len(data) and (data[pos] & 0xC0) == 0x80:
+        pos += 1
+    return pos
+
+
+class OutputFilter(object):
+    """
+    Collapse the carriage-return overwrites and the runs of identical lines of the captured output.
+
+    A line redrawn with '\r' (tqdm and other progress bars) is written in its final state only. With
+    ``progress_interval``, its latest complete state is also written every ``progress_interval`` seconds,
+    so the log still shows how the progress went. A run of identical lines is written once, followed by
+    '[repeated N×]' with the number of further copies (runs of up to ``min_run`` copies are kept as they are).
+
+    Inputs:
+    - progress_interval : float, optional
+        Time (in seconds) between two states of a redrawn line kept in the log. Default is None (final state only).
+
+    - min_run : int, optional
+        Number of identical lines from which a run is collapsed. Default is 3.
+
+    - max_pending : int, optional
+        An unfinished line without '\r' longer than this (in characters) is written as it is. Default is 65536.
+    """
+
+    def __init__(self, progress_interval=None, min_run=3, max_pending=65536):
+        self.progress_interval = progress_interval
+        self.min_run = min_run
+        self.max_pending = max_pending
+        self.pending = ''  # Unfinished line, from its latest state on
+        self.last_line = None  # Last complete line written
+        self.repeats = 0  # Further copies of last_line not written yet
+        self.last_sample = time.monotonic()
+        self.chars_in = 0
+        self.chars_out = 0
+
+    def feed(self, text):
+        """Return the filtered text which can be written now, the rest is kept until the line ends.
+        """
+        self.chars_in += len(text)
+        out = []
+        lines = text.split('\n')
+        lines[0] = self.pending + lines[0]
+        for line in lines[:-1]:
+            if '\r' in line:
+                line = line.rstrip('\r')
+                line = line[line.rfind('\r') + 1:]  # Final state
+            self.add_line(line, out)
+        self.pending = self.unfinished(lines[-1], out)
+        text = ''.join(out)
+        self.chars_out += len(text)
+        return text
+
+    def unfinished(self, line, out):
+        if '\r' not in line:
+            if len(line) > self.max_pending:
+                self.flush_repeats(out)
+                self.last_line = None
+                out.append(line)
+                return ''
+            return line
+        body = line.rstrip('\r')
+        cut = body.rfind('\r')
+        if self.progress_interval is not None and cut >= 0:
+            now = time.monotonic()
+            if now - self.last_sample >= self.progress_interval:
+                self.last_sample = now
+                state = body[body.rfind('\r', 0, cut) + 1:cut]  # Latest complete state
+                if state:
+                    self.add_line(state, out)
+        return line[cut + 1:]
+
+    def add_line(self, line, out):
+        if line == self.last_line:
+            self.repeats += 1
+            return
+        self.flush_repeats(out)
+        out.append(line + '\n')
+        self.last_line = line
+
+    def flush_repeats(self, out):
+        if self.repeats >= self.min_run - 1:
+            out.append('[repeated %s×]\n' % format(self.repeats, ','))
+        elif self.repeats:
+            out.append((self.last_line + '\n') * self.repeats)
+        self.repeats = 0
+
+    def finish(self):
+        """Return what is left: the pending repeat count and the final state of the unfinished line.
+        """
+        out = []
+        self.flush_repeats(out)
+        if self.pending:
+            line = self.pending.rstrip('\r')
+            out.append(line[line.rfind('\r') + 1:])
+            self.pending = ''
+        text = ''.join(out)
+        self.chars_out += len(text)
+        return text
+
+
+class SegmentCompressor(object):
+    """
+    Background gzip compression of the closed segments of the log.
+
+    A single thread compresses the segments one after the other in chunks, at the lowest CPU priority
+    where the system allows a per-thread priority (Linux), so it only uses the CPU the program leaves
+    idle. A compressed segment replaces the raw one. If compression fails, the raw segment is kept.
+
+    Inputs:
+    - compresslevel : int, optional
+        gzip compression level. Default is 6.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, compresslevel=6):
+        self.compresslevel = compresslevel
+        self.queue = collections.deque()
+        self.pending = threading.Semaphore(0)
+        self.done = threading.Condition()
+        self.remaining = 0  # Segments queued or being compressed
+        self.files = []  # Path of every segment in order, compressed or raw
+        self.thread = threading.Thread(target=self.run, name='notify_log_compressor', daemon=True)
+        self.thread.start()
+
+    def submit(self, segment_path):
+        with self.done:
+            self.files.append(segment_path)
+            self.remaining += 1
+        self.queue.append((len(self.files) - 1, segment_path))
+        self.pending.release()
+
+    def run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)  # Nice value of this thread only on Linux
+        except (AttributeError, OSError):
+            pass
+        while True:
+            self.pending.acquire()
+            index, segment_path = self.queue.popleft()
+            compressed_path = self.compress(segment_path)
+            with self.done:
+                if compressed_path is not None:
+                    self.files[index] = compressed_path
+                self.remaining -= 1
+                self.done.notify_all()
+
+    def compress(self, segment_path):
+        import gzip
+        compressed_path = segment_path + '.gz'
+        try:
+            with open(segment_path, 'rb') as src, gzip.open(compressed_path, 'wb', compresslevel=self.compresslevel) as dst:
+                while True:
+                    data = src.read(self.chunk_size)
+                    if not data:
+                        break
+                    dst.write(data)
+            os.remove(segment_path)
+        except OSError:
+            try:
+                os.remove(compressed_path)
+            except OSError:
+                pass
+            return None
+        return compressed_path
+
+    def wait(self):
+        """Wait until every submitted segment is compressed, return the segment paths in order.
+        """
+        with self.done:
+            while self.remaining:
+                self.done.wait()
+            return list(self.files)
+
+
+class LogWriter(object):
+    """Write captured output into the log file.
+
+    With ``buffer_size=0`` every message is written to the file straight away. Otherwise messages are
+    batched in memory and written by a background thread, either when ``buffer_size`` characters are pending
+    or when ``flush_interval`` seconds have passed, whichever comes first. ``close()`` always drains the
+    buffer, so nothing is lost before NotifyBackend reads the log.
+
+    If ``head_limit`` or ``tail_limit`` is set, only the first ``head_limit`` and the last ``tail_limit``
+    bytes (or lines, see ``limit_unit``) are kept. The head is written to the file as it comes, the tail is
+    kept in a bounded in-memory ring and written at ``close()`` after a note about the dropped middle part.
+
+    If ``recent_limit`` is set, the last ``recent_limit`` bytes of output are also kept in memory, whatever
+    the head + tail policy, so ``read_since()`` can return the new output without reading the log file.
+    ``keep_recent()`` starts this window later, so writes do not pay for it until progress mails are used.
+
+    If ``collapse`` is set, the output goes through an OutputFilter first: progress bars redrawn with '\r'
+    keep their final state (plus one state every ``progress_interval`` seconds) and runs of identical lines
+    are run-length encoded.
+
+    If ``segment_size`` is set, the log file is closed once it holds ``segment_size`` bytes and renamed to
+    ``<name>.001<ext>``, ``<name>.002<ext>``, ... A SegmentCompressor gzips the closed segments in the
+    background, and the log file starts again empty. ``segment_files()`` lists them after ``close()``.
+    """
+
+    def __init__(self, log_path, buffer_size=0, flush_interval=1.0,
+                 head_limit=None, tail_limit=None, limit_unit='bytes', recent_limit=0,
+                 segment_size=0, segment_compresslevel=6, collapse=False, progress_interval=None):
+        self.log_path = log_path
+        self.log = open(log_path, "ab")
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.closed = False
+
+        # Head + tail capture policy
+        if limit_unit not in ['bytes', 'lines']:
+            raise ValueError(f'limit_unit should be "bytes" or "lines", got {limit_unit}')
+        self.bounded = head_limit is not None or tail_limit is not None
+        self.limit_unit = limit_unit
+        self.head_room = head_limit if head_limit is not None else 0  # Bytes (or lines) still allowed in the head
+        self.tail_limit = tail_limit if tail_limit is not None else 0
+        self.tail = collections.deque()  # Byte chunks (or lines) of the tail
+        self.tail_size = 0  # Bytes (or complete lines) in self.tail
+        self.dropped_bytes = 0
+        self.dropped_lines = 0
+
+        # Window of the most recent output, for progress mails
+        self.recent_limit = recent_limit
+        self.recent = collections.deque()  # Byte chunks
+        self.recent_size = 0
+        self.total_bytes = 0  # Bytes of output so far, the position used by read_since()
+
+        # Progress bar and repeated line collapsing
+        self.output_filter = OutputFilter(progress_interval) if collapse else None
+
+        # Segments of the log file
+        self.segment_size = segment_size
+        self.segment_bytes = self.log.tell()  # Bytes in the current segment
+        self.segment_count = 0  # Closed segments
+        self.compressor = SegmentCompressor(segment_compresslevel) if segment_size else None
+
+        # deque.append and deque.popleft are thread-safe, so printing threads never wait for a lock.
+        self.buffer = collections.deque()
+        self.buffered_bytes = 0  # Approximate count, only used to decide when to wake up the writer
+        self.io_lock = threading.Lock()  # Serializes writes to the log file
+        self.wakeup = threading.Event()
+
+        self.flush_thread = None
+        if self.buffer_size > 0:
+            self.flush_thread = threading.Thread(target=self.flush_loop, name='notify_log_writer', daemon=True)
+            self.flush_thread.start()
+
+    def write(self, message):
+        if self.flush_thread is None:
+            with self.io_lock:
+                if not self.closed:
+                    self.emit(message)
+            return
+        if self.closed:
+            return
+
+        self.buffer.append(message)
+        self.buffered_bytes += len(message)
+        if self.buffered_bytes >= self.buffer_size:
+            if self.buffered_bytes >= 4 * self.buffer_size:
+                self.drain()  # The background writer is falling behind, write it out here instead
+            else:
+                self.wakeup.set()
+
+    def flush(self):
+        # In buffered mode the flush deadline takes care of it, so print(flush=True) stays cheap.
+        if self.flush_thread is None:
+            with self.io_lock:
+                if not self.closed:
+                    self.log.flush()
+
+    def flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.drain()
+
+    def drain(self):
+        """Write everything buffered so far into the log file.
+        """
+        with self.io_lock:
+            self.buffered_bytes = 0
+            pending = [self.buffer.popleft() for _ in range(len(self.buffer))]
+            if pending and not self.log.closed:
+                self.emit(''.join(pending))
+                self.log.flush()
+
+    def emit(self, text):
+        """Write text into the log file, through the output filter (if any). The caller holds io_lock.
+        """
+        if self.output_filter is not None:
+            text = self.output_filter.feed(text)
+            if not text:
+                return
+        self.emit_filtered(text)
+
+    def emit_filtered(self, text):
+        """Write text into the log file according to the head + tail policy. The caller holds io_lock.
+        """
+        data = text.encode('utf-8', 'replace')
+        self.total_bytes += len(data)
+        if self.recent_limit:
+            self.append_recent(data)
+        if not self.bounded:
+            self.write_log(data)
+            return
+
+        # Fill the head first
+        if self.head_room > 0:
+            if self.limit_unit == 'bytes':
+                cut = utf8_boundary(data, min(len(data), self.head_room))
+                self.head_room -= cut
+            else:
+                cut = 0
+                while self.head_room > 0:
+                    end = data.find(b'\n', cut)
+                    if end < 0:
+                        cut = len(data)  # The unfinished line still belongs to the head
+                        break
+                    cut = end + 1
+                    self.head_room -= 1
+            self.write_log(data[:cut])
+            data = data[cut:]
+
+        if data:
+            if self.limit_unit == 'bytes':
+                self.append_tail_bytes(data)
+            else:
+                self.append_tail_lines(data)
+
+    def write_log(self, data):
+        """Write into the log file, starting a new segment once the current one is full. The caller holds io_lock.
+        """
+        self.log.write(data)
+        self.segment_bytes += len(data)
+        if self.segment_size and self.segment_bytes >= self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        self.log.close()
+        self.segment_count += 1
+        root, ext = os.path.splitext(self.log_path)
+        segment_path = '%s.%03d%s' % (root, self.segment_count, ext)
+        os.replace(self.log_path, segment_path)
+        self.compressor.submit(segment_path)
+        self.log = open(self.log_path, "ab")
+        self.segment_bytes = 0
+
+    def segment_files(self):
+        """
+        Paths of the closed segments in order (gzip files, or raw files if they could not be compressed),
+        once compressed. The last part of the output stays in the log file itself.
+        """
+        if self.compressor is None:
+            return []
+        return self.compressor.wait()
+
+    def keep_recent(self, recent_limit):
+        """
+        Start keeping the last ``recent_limit`` bytes of output in memory for read_since(), if not done yet.
+        The window starts with the end of the output so far, read back from the log file or the tail.
+        """
+        if self.recent_limit or not recent_limit:
+            return
+        if self.flush_thread is not None:
+            self.drain()
+        with self.io_lock:
+            if self.recent_limit or self.closed:
+                return
+            if self.bounded and self.head_room <= 0:
+                data = b''.join(self.tail)[-recent_limit:]  # The head is full, the latest output is in the tail
+            else:
+                self.log.flush()
+                with open(self.log.name, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - recent_limit))
+                    data = f.read()
+            data = data[utf8_boundary(data, 0):]  # The cut may fall inside a character
+            self.recent_limit = recent_limit
+            if data:
+                self.recent.append(data)
+                self.recent_size = len(data)
+
+    def append_recent(self, data):
+        self.recent.append(data)
+        self.recent_size += len(data)
+        while self.recent_size - len(self.recent[0]) >= self.recent_limit:
+            self.recent_size -= len(self.recent.popleft())
+
+    def read_since(self, position=0):
+        """
+        Output written after `position` (a value returned by a previous call, 0 at first), within the
+        recent window. Return (data, new position, bytes of output lost because they left the window).
+        """
+        if self.flush_thread is not None:
+            self.drain()
+        with self.io_lock:
+            data = b''.join(self.recent)
+            end = self.total_bytes
+        start = end - len(data)
+        skipped = max(0, start - position)
+        data = data[max(position, start) - start:]
+        if len(data) > self.recent_limit:
+            cut = utf8_boundary(data, len(data) - self.recent_limit)
+            skipped += cut
+            data = data[cut:]
+        return data.decode('utf-8', 'replace'), end, skipped
+
+    def append_tail_bytes(self, data):
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail and self.tail_size - len(self.tail[0]) >= self.tail_limit:
+            chunk = self.tail.popleft()
+            self.tail_size -= len(chunk)
+            self.dropped_bytes += len(chunk)
+            self.dropped_lines += chunk.count(b'\n')
+
+    def append_tail_lines(self, data):
+        if self.tail and not self.tail[-1].endswith(b'\n'):
+            data = self.tail.pop() + data  # Complete the unfinished last line
+        lines = data.split(b'\n')
+        for line in lines[:-1]:
+            self.tail.append(line + b'\n')
+            self.tail_size += 1
+        if lines[-1]:
+            self.tail.append(lines[-1])
+        while self.tail_size > self.tail_limit:
+            line = self.tail.popleft()
+            self.tail_size -= 1
+            self.dropped_bytes += len(line)
+            self.dropped_lines += 1
+
+    def write_tail(self):
+        """Write the kept tail into the log file, after a note about the dropped part (if any).
+        """
+        tail = b''.join(self.tail)
+        self.tail.clear()
+        self.tail_size = 0
+        if self.limit_unit == 'bytes' and len(tail) > self.tail_limit:
+            cut = utf8_boundary(tail, len(tail) - self.tail_limit)
+            self.dropped_bytes += cut
+            self.dropped_lines += tail.count(b'\n', 0, cut)
+            tail = tail[cut:]
+        if self.dropped_bytes:
+            note = '\n[notifyemail: %s lines (%s bytes) dropped between the head and the tail of the log]\n' % \
+                   (format(self.dropped_lines, ','), format(self.dropped_bytes, ','))
+            self.write_log(note.encode('utf-8'))
+        self.write_log(tail)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.flush_thread is not None:
+            self.closed = True
+            self.wakeup.set()
+            self.flush_thread.join()
+        self.drain()
+        with self.io_lock:
+            self.closed = True
+            if self.output_filter is not None:
+                rest = self.output_filter.finish()
+                if rest:
+                    self.emit_filtered(rest)
+            if self.bounded:
+                self.write_tail()
+            self.log.close()
 
 
 class Logger(object):
     """Redirect print to designated file
     """
 
-    def __init__(self, processing_log_name="LOG_Default.log", path="./"):
-        self.ori_stdout = sys.stdout
-        self.terminal = sys.stdout
-        self.log = open(os.path.join(path, processing_log_name), "a", encoding='utf8', )
+    def __init__(self, processing_log_name="LOG_Default.log", path="./", stream_name='stdout', log_writer=None):
+        self.stream_name = stream_name  # 'stdout' or 'stderr', the stream replaced by this Logger
+        self.ori_stdout = getattr(sys, stream_name)
+        self.terminal = self.ori_stdout
+        if log_writer is None:
+            log_writer = LogWriter(os.path.join(path, processing_log_name))
+        self.log = log_writer
         self.start_time = time.time()
         self.text_content = []
         self.additional_file_list = []
@@ -29,11 +497,12 @@ class Logger(object):
         self.log.write(message)
 
     def flush(self):
-        pass
+        self.terminal.flush()
+        self.log.flush()
 
     def close_log_and_put_back(self):
         self.log.close()
-        sys.stdout = self.ori_stdout  # ori_stdout is the original sys.stdout, now used for recovery
+        setattr(sys, self.stream_name, self.ori_stdout)  # ori_stdout is the original stream, now used for recovery
 
 
 def _setup(notify_frontend, 
@@ -44,8 +513,9 @@ def _setup(notify_frontend,
            log_root_path=None,
            max_log_cnt=5, 
            mail_list=None,
-           default_reciving_list=None):
-    """Setup notifyemail.
+           default_reciving_list=None,
+           **kwargs):
+    """Setup notifyemail. Additional keyword arguments are forwarded to NotifyFrontend.
     """
     # At least one is needed to specify the mail list.
     assert default_reciving_list or default_receiving_list or mail_list
@@ -63,7 +533,8 @@ def _setup(notify_frontend,
              mail_pass=mail_pass, 
              default_receiving_list=default_receiving_list, 
              log_root_path=log_root_path, 
-             max_log_cnt=max_log_cnt)
+             max_log_cnt=max_log_cnt,
+             **kwargs)
     _send_log(mail_list=None, 
               notify_frontend=notify_frontend)
 
@@ -74,7 +545,8 @@ def _Reboost(notify_frontend, mail_host=None,
              default_receiving_list=None, 
              log_root_path=None, 
              max_log_cnt=5,
-             default_reciving_list=None):
+             default_reciving_list=None,
+             **kwargs):
     """
     Restart the notify background process.
 
@@ -106,6 +578,9 @@ def _Reboost(notify_frontend, mail_host=None,
     
     default_reciving_list : str or list, optional
         The alias of default_receiving_list.
+
+    **kwargs : optional
+        Capture and monitoring options forwarded to NotifyFrontend, e.g. log_buffer_size.
     
     Returns
     -------
@@ -123,7 +598,8 @@ def _Reboost(notify_frontend, mail_host=None,
     # Restart notify background process
     notify_frontend.reboost(log_root_path=log_root_path, mail_host=mail_host,
                             mail_user=mail_user, mail_pass=mail_pass,
-                            default_receiving_list=default_receiving_list, max_log_cnt=max_log_cnt)
+                            default_receiving_list=default_receiving_list, max_log_cnt=max_log_cnt,
+                            **kwargs)
     print('Notifyemail initialized.')
     print(f' - log_root_path:          {notify_frontend.log_root_path}')
     # print('mail_host', notify_frontend.mail_host)
@@ -243,3 +719,80 @@ def _send_log(mail_list=None, notify_frontend=None):
         call_func_name = os.path.basename(back_frame.f_code.co_filename).split('.')[0]
 
         notify_frontend.send_log(mail_list, call_func_name)
+
+
+def _send_progress(note=None, notify_frontend=None):
+    """
+    Ask for a progress mail while the program is running. It carries the output since the previous
+    progress mail, the new add_text() content and the server status so far. Requests beyond the rate
+    limit are merged into the next progress mail.
+
+    Parameters
+    ----------
+    note : str, optional
+        A note shown at the top of the progress mail.
+
+    notify_frontend : object, optional
+        Notify class (not relevant to the caller).
+
+    Returns
+    -------
+    None
+    """
+    if notify_frontend.log_root_path == None or notify_frontend.mail_host == None \
+            or notify_frontend.mail_user == None or notify_frontend.mail_pass == None:
+        raise Exception('\nPlease setup Notify first by:\nUsing notify.setup(xxx)' +
+                        ' RIGHT AFTER you FIRST import Notify')
+    notify_frontend.send_progress(note=note)
+
+
+def _flush_outbox(deadline=None, notify_frontend=None):
+    """
+    Send the messages which previous runs could not deliver, kept in the outbox under log_root_path.
+
+    Parameters
+    ----------
+    deadline : float, optional
+        Time (in seconds) spent at most, retrying with backoff. Default is None (one attempt per message).
+
+    notify_frontend : object, optional
+        Notify class (not relevant to the caller).
+
+    Returns
+    -------
+    tuple
+        (number of messages sent, number of messages left in the outbox).
+    """
+    if notify_frontend.log_root_path == None or notify_frontend.mail_host == None \
+            or notify_frontend.mail_user == None or notify_frontend.mail_pass == None:
+        raise Exception('\nPlease setup Notify first by:\nUsing notify.setup(xxx)' +
+                        ' RIGHT AFTER you FIRST import Notify')
+    sent, left = notify_frontend.flush_outbox(deadline=deadline)
+    print(f'Outbox flushed: {sent} message(s) sent, {left} left.')
+    return sent, left
+
+
+def _popen(args, name=None, notify_frontend=None, **kwargs):
+    """
+    Start a program with subprocess.Popen(). With capture_children, its stdout and stderr (unless given)
+    are copied to the terminal and to the log, each line tagged with the name and PID of the program.
+
+    Parameters
+    ----------
+    args : str or list
+        The program and its arguments, as for subprocess.Popen().
+
+    name : str, optional
+        The tag of the output lines. Default is None (the program name).
+
+    notify_frontend : object, optional
+        Notify class (not relevant to the caller).
+
+    **kwargs : optional
+        Other subprocess.Popen() arguments.
+
+    Returns
+    -------
+    subprocess.Popen
+    """
+    return notify_frontend.popen(args, name=name, **kwargs)
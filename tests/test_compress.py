@@ -0,0 +1,49 @@
+import os
+import zipfile
+
+import pytest
+
+from notifyemail.compress import ParallelZipper
+
+
+def write_folder(folder):
+    os.makedirs(str(folder / 'sub'))
+    files = {'run.log': b''.join(b'step %d loss %.4f\n' % (i, 1.0 / (i + 1)) for i in range(20000)),
+             'sub/random.bin': os.urandom(300000),
+             'image.png': b'\x89PNG' + os.urandom(1000),
+             'empty.txt': b''}
+    for name, data in files.items():
+        (folder / name).write_bytes(data)
+    return files
+
+
+@pytest.mark.parametrize('codec, compresslevel', [('deflate', 6), ('deflate', None), ('bzip2', 1), ('lzma', None)])
+def test_zip_round_trip(tmp_path, codec, compresslevel):
+    files = write_folder(tmp_path / 'data')
+    out_path = str(tmp_path / 'data.zip')
+    stats = ParallelZipper(workers=2, codec=codec, compresslevel=compresslevel).zip_path(str(tmp_path / 'data'), out_path)
+    assert stats['files'] == len(files)
+    assert stats['codecs']['store']['files'] == 2  # Random data and a png
+    with zipfile.ZipFile(out_path) as zip_file:
+        assert zip_file.testzip() is None
+        assert {name.lstrip('/'): zip_file.read(name) for name in zip_file.namelist()} == files
+
+
+@pytest.mark.parametrize('change', [b'shrunk', b'x' * 400000], ids=['shrunk', 'grown'])
+def test_stored_file_changed_before_writing(tmp_path, change):
+    # A live log may change between its CRC pass in a worker and the copy into the archive
+    file_path = tmp_path / 'random.bin'
+    file_path.write_bytes(os.urandom(300000))
+    zipper = ParallelZipper()
+    member = zipper.get_member(str(file_path), 'random.bin', str(tmp_path))
+    assert member.codec == 'store'
+    file_path.write_bytes(change)
+
+    out_path = str(tmp_path / 'out.zip')
+    stats = {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'codecs': {}, 'cached': 0}
+    with zipfile.ZipFile(out_path, 'w') as zip_file:
+        zipper.write_member(zip_file, member, stats)
+    with zipfile.ZipFile(out_path) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read('random.bin') == change
+    assert stats['bytes_in'] == len(change)
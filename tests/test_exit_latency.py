@@ -0,0 +1,42 @@
+import email
+import subprocess
+import sys
+import textwrap
+
+from conftest import PACKAGE_ROOT
+from smtp_sink import start_sink
+
+# The notification used to start up to ~10 s after the main thread ended (thread polling every 5 s and a
+# blocking 5 s CPU sample), it now starts within milliseconds and the local send takes a fraction of a second.
+MAX_LATENCY = 3.0
+
+CHILD_CODE = '''
+import sys, time
+sys.path.insert(0, {package_root!r})
+import notifyemail as notify
+notify.setup(mail_host='127.0.0.1', mail_port={port}, mail_ssl=False, mail_user='test@localhost',
+             mail_pass='test', log_root_path={log_root_path!r}, mail_list=['test@localhost'])
+for i in range(1000):
+    print('step', i, 'loss', 1.0 / (i + 1))
+with open({end_time_path!r}, 'w') as f:
+    f.write(repr(time.time()))
+'''
+
+
+def test_exit_to_send_latency(tmp_path):
+    sink = start_sink()
+    end_time_path = tmp_path / 'end_time'
+    code = CHILD_CODE.format(package_root=PACKAGE_ROOT, port=sink.port, log_root_path=str(tmp_path / 'notify_log'),
+                             end_time_path=str(end_time_path))
+    try:
+        child = subprocess.run([sys.executable, '-c', textwrap.dedent(code)], cwd=str(tmp_path),
+                               capture_output=True, timeout=120)
+    finally:
+        sink.stop()
+    assert child.returncode == 0, child.stderr.decode(errors='replace')
+    assert len(sink.messages) == 1
+    message = email.message_from_bytes(sink.messages[0])
+    logs = [part.get_payload(decode=True) for part in message.walk() if (part.get_filename() or '').endswith('_log.log')]
+    assert b'step 999 loss' in logs[0]
+    latency = sink.last_time - float(end_time_path.read_text())
+    assert 0 <= latency < MAX_LATENCY, 'the email arrived %.2f s after the main thread ended' % latency
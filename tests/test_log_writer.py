@@ -0,0 +1,37 @@
+import pytest
+
+from notifyemail.tools import LogWriter
+
+
+def write_lines(log_path, count, **kwargs):
+    writer = LogWriter(str(log_path), **kwargs)
+    for index in range(count):
+        writer.write('line %d\n' % index)
+    writer.close()
+    return writer, log_path.read_text()
+
+
+@pytest.mark.parametrize('buffer_size', [0, 1000])
+def test_head_tail_lines(tmp_path, buffer_size):
+    writer, log = write_lines(tmp_path / 'run.log', 100, buffer_size=buffer_size,
+                              head_limit=3, tail_limit=2, limit_unit='lines')
+    assert log.startswith('line 0\nline 1\nline 2\n')
+    assert log.endswith('line 98\nline 99\n')
+    assert '95 lines' in log and 'line 50\n' not in log
+    assert writer.dropped_lines == 95
+    assert writer.dropped_bytes == sum(len('line %d\n' % index) for index in range(3, 98))
+
+
+def test_head_tail_bytes(tmp_path):
+    writer, log = write_lines(tmp_path / 'run.log', 100, head_limit=20, tail_limit=10)
+    head, note, tail = log.split('\n[notifyemail: ')[0], log.split('\n')[3], log.split(']\n')[-1]
+    assert head == 'line 0\nline 1\nline 2'
+    assert 'dropped between the head and the tail' in note
+    assert tail == '8\nline 99\n'
+    assert writer.dropped_bytes == sum(len('line %d\n' % index) for index in range(100)) - 30
+
+
+def test_no_limit_keeps_everything(tmp_path):
+    writer, log = write_lines(tmp_path / 'run.log', 100)
+    assert log == ''.join('line %d\n' % index for index in range(100))
+    assert writer.dropped_bytes == 0
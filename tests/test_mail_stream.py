@@ -0,0 +1,104 @@
+import email
+import smtplib
+
+import pytest
+
+from smtp_sink import start_sink
+from notifyemail.mail_stream import StreamingMessage, send_streaming, split_message
+
+
+class RawMessage(object):
+    """A message given as its serialized chunks."""
+
+    def __init__(self, chunks):
+        self.mail_user = 'sender@localhost'
+        self.mail_list = ['receiver@localhost']
+        self.chunks = chunks
+
+    def iter_chunks(self):
+        return iter(self.chunks)
+
+
+@pytest.fixture
+def sink():
+    sink = start_sink()
+    yield sink
+    sink.stop()
+
+
+def send(sink, message):
+    smtp = smtplib.SMTP('127.0.0.1', sink.port)
+    try:
+        return send_streaming(smtp, message)
+    finally:
+        smtp.quit()
+
+
+def test_dot_stuffing(sink):
+    chunks = [b'Subject: dots\r\n\r\n', b'.starts a chunk\r\nmiddle\r\n.\r\n', b'..two dots\r\n', b'. space\r\n']
+    assert send(sink, RawMessage(chunks)) == {}
+    assert sink.messages == [b''.join(chunks)]
+
+
+@pytest.mark.parametrize('size', [0, 1, 57 * 1024, 57 * 1024 + 1, 300000])
+def test_encoded_size(tmp_path, sink, size):
+    data = bytes(range(256)) * (size // 256 + 1)
+    file_path = tmp_path / 'data.bin'
+    file_path.write_bytes(data[:size])
+    message = StreamingMessage('[test] size é', 'sender@localhost', ['receiver@localhost'])
+    message.set_body('body text\n.dot line\n')
+    message.add_attachment(str(file_path), 'données.bin')
+    message.add_attachment(str(file_path), 'part.bin', offset=size // 3, length=size // 2)
+
+    serialized = b''.join(message.iter_chunks())
+    assert message.encoded_size() == len(serialized)
+
+    send(sink, message)
+    assert sink.messages == [serialized]
+    parsed = email.message_from_bytes(sink.messages[0])
+    attachments = [part for part in parsed.walk() if part.get_filename()]
+    assert [part.get_payload(decode=True) for part in attachments] == [data[:size],
+                                                                      data[size // 3:size // 3 + size // 2]]
+    assert attachments[0].get_filename() == 'données.bin'
+
+
+def test_split_message_volumes(tmp_path):
+    big = bytes(range(256)) * 4000  # 1,024,000 bytes
+    (tmp_path / 'big.bin').write_bytes(big)
+    small = {'a.log': b'a' * 50000, 'b.log': b'b' * 120000}
+    for name, data in small.items():
+        (tmp_path / name).write_bytes(data)
+    message = StreamingMessage('[test] split', 'sender@localhost', ['receiver@localhost'])
+    message.set_body('body text\n')
+    for name in ['a.log', 'big.bin', 'b.log']:
+        message.add_attachment(str(tmp_path / name), name)
+
+    max_size = 300000
+    parts = split_message(message, max_size)
+    assert len(parts) > 1
+    received = {}
+    for number, part in enumerate(parts, 1):
+        serialized = b''.join(part.iter_chunks())
+        assert len(serialized) == part.encoded_size() <= max_size
+        parsed = email.message_from_bytes(serialized)
+        assert parsed['Subject'] == '[test] split (%d/%d)' % (number, len(parts))
+        for attachment in parsed.walk():
+            if attachment.get_filename():
+                received[attachment.get_filename()] = attachment.get_payload(decode=True)
+    first_body = email.message_from_bytes(b''.join(parts[0].iter_chunks())).get_payload()[0]
+    assert b'body text' in first_body.get_payload(decode=True)
+
+    volumes = sorted(name for name in received if name.startswith('big.bin.'))
+    assert volumes == ['big.bin.%03d' % index for index in range(1, len(volumes) + 1)]
+    assert b''.join(received[name] for name in volumes) == big  # cat big.bin.0* > big.bin
+    assert {name: received[name] for name in small} == small
+
+
+def test_split_message_fitting(tmp_path):
+    (tmp_path / 'a.log').write_bytes(b'a' * 1000)
+    message = StreamingMessage('[test] split', 'sender@localhost', ['receiver@localhost'])
+    message.add_attachment(str(tmp_path / 'a.log'), 'a.log')
+    assert split_message(message, 100000) == [message]
+    assert split_message(message, 0) == [message]
+    with pytest.raises(ValueError):
+        split_message(message, 500)
@@ -0,0 +1,179 @@
+import os
+import smtplib
+import subprocess
+import sys
+
+import pytest
+
+from conftest import PACKAGE_ROOT
+from smtp_sink import start_sink
+from notifyemail.mail_stream import StreamingMessage
+from notifyemail.outbox import Outbox
+from notifyemail.retention import RunIndex
+
+
+class RefusingSMTP(object):
+    """An SMTP connection refusing every sender with the given reply code."""
+
+    def __init__(self, code):
+        self.code = code
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, sender):
+        return self.code, b'refused'
+
+    def rset(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def put_message(outbox, tmp_path, mail_user='sender@localhost', mail_host=None):
+    file_path = tmp_path / 'run.log'
+    file_path.write_bytes(b'step 1\n' * 1000)
+    message = StreamingMessage('[test] outbox', mail_user, ['receiver@localhost'])
+    message.set_body('body\n')
+    message.add_attachment(str(file_path), 'run.log')
+    return outbox.put(message, mail_host=mail_host), message
+
+
+def test_backoff_is_exponential_and_capped(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'), backoff_base=10, backoff_max=3600)
+    for attempts, delay in [(1, 10), (2, 20), (3, 40), (4, 80), (20, 3600)]:
+        for _ in range(20):
+            assert 0.5 * delay <= outbox.backoff(attempts) <= 1.5 * delay
+
+
+def test_transient_failure_is_retried_later(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'))
+    item_path, message = put_message(outbox, tmp_path)
+
+    assert outbox.deliver(lambda: RefusingSMTP(451)) == (0, 1)
+    envelope = outbox.read_envelope(item_path)
+    assert envelope['attempts'] == 1
+    assert 'refused' in envelope['last_error']
+    assert envelope['next_attempt'] > envelope['created']
+    assert not os.path.exists(os.path.join(item_path, 'claim'))
+
+    # Not due yet, then sent once forced
+    assert outbox.deliver(lambda: pytest.fail('the item is not due')) == (0, 1)
+    sink = start_sink()
+    try:
+        assert outbox.deliver(lambda: smtplib.SMTP('127.0.0.1', sink.port), force=True) == (1, 0)
+    finally:
+        sink.stop()
+    assert sink.messages == [b''.join(message.iter_chunks())]
+    assert not os.path.exists(item_path)
+
+
+def test_permanent_failure_moves_to_failed(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'))
+    item_path, message = put_message(outbox, tmp_path)
+
+    assert outbox.deliver(lambda: RefusingSMTP(550)) == (0, 0)
+    failed_path = os.path.join(outbox.failed_dir, os.path.basename(item_path))
+    assert not os.path.exists(item_path)
+    assert '550' in outbox.read_envelope(failed_path)['last_error']
+    assert outbox.items() == []
+
+
+def test_item_does_not_depend_on_the_log_folder(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'))
+    item_path, message = put_message(outbox, tmp_path)
+    serialized = b''.join(message.iter_chunks())
+    os.remove(str(tmp_path / 'run.log'))  # The log folder is moved or pruned after the message is spooled
+
+    sink = start_sink()
+    try:
+        assert outbox.deliver(lambda: smtplib.SMTP('127.0.0.1', sink.port)) == (1, 0)
+    finally:
+        sink.stop()
+    assert sink.messages == [serialized]
+
+
+def test_spooled_file_gone_while_sending(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'))
+    (tmp_path / 'other.log').write_bytes(b'other\n' * 1000)
+    file_path = tmp_path / 'run.log'
+    file_path.write_bytes(b'step 1\n' * 1000)
+    message = StreamingMessage('[test] broken', 'sender@localhost', ['receiver@localhost'])
+    message.add_attachment(str(file_path), 'run.log')
+    message.add_attachment(str(tmp_path / 'other.log'), 'other.log')
+    broken_path = outbox.put(message)
+    os.remove(os.path.join(broken_path, 'attachment001'))  # Read within DATA, after the first attachment
+    item_path, next_message = put_message(outbox, tmp_path)
+
+    sink = start_sink()
+    try:
+        assert outbox.deliver(lambda: smtplib.SMTP('127.0.0.1', sink.port, timeout=10)) == (1, 1)
+    finally:
+        sink.stop()
+    assert sink.messages == [b''.join(next_message.iter_chunks())]  # Over a new connection
+    assert sink.connections == 2
+    assert outbox.read_envelope(broken_path)['attempts'] == 1
+
+
+def test_deliver_sends_only_the_items_of_the_account(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox'))
+    item_a, message_a = put_message(outbox, tmp_path, 'a@localhost', '127.0.0.1')
+    item_b, message_b = put_message(outbox, tmp_path, 'b@localhost', '127.0.0.1')
+
+    assert outbox.items(('127.0.0.1', 'a@localhost')) == [item_a]
+    assert outbox.deliver(lambda: RefusingSMTP(550), account=('127.0.0.1', 'a@localhost')) == (0, 0)
+    assert outbox.read_envelope(item_b)['attempts'] == 0  # Neither sent nor refused under the login of a
+
+    sink = start_sink()
+    try:
+        assert outbox.deliver(lambda: smtplib.SMTP('127.0.0.1', sink.port), account=('127.0.0.1', 'b@localhost')) \
+            == (1, 0)
+    finally:
+        sink.stop()
+    assert sink.messages == [b''.join(message_b.iter_chunks())]
+
+
+RUN_CODE = '''
+import sys
+sys.path.insert(0, {package_root!r})
+import notifyemail as notify
+notify.setup(mail_host='127.0.0.1', mail_port={port}, mail_ssl=False, mail_user={mail_user!r}, mail_pass='test',
+             log_root_path={log_root_path!r}, mail_list=['receiver@localhost'], send_deadline=1)
+print('run of', {mail_user!r})
+'''
+
+
+def test_runs_of_two_accounts_sharing_log_root_path(tmp_path):
+    log_root_path = str(tmp_path / 'notify_log')
+
+    def run(mail_user, port, name):
+        code = RUN_CODE.format(package_root=PACKAGE_ROOT, port=port, mail_user=mail_user, log_root_path=log_root_path)
+        script = tmp_path / (name + '.py')
+        script.write_text(code)
+        child = subprocess.run([sys.executable, str(script)], cwd=str(tmp_path), capture_output=True, timeout=120)
+        assert child.returncode == 0, child.stderr.decode(errors='replace')
+
+    # The run of b cannot reach its server, its email stays in the shared outbox
+    closed = start_sink()
+    closed_port = closed.port
+    closed.stop()
+    run('b@localhost', closed_port, 'job_b')
+    outbox = Outbox(os.path.join(log_root_path, '.notify_outbox'))
+    assert len(outbox.items(('127.0.0.1', 'b@localhost'))) == 1
+
+    sink = start_sink()
+    try:
+        run('a@localhost', sink.port, 'job_a')
+    finally:
+        sink.stop()
+    assert len(sink.messages) == 1 and b'From: a@localhost' in sink.messages[0]
+    assert len(outbox.items(('127.0.0.1', 'b@localhost'))) == 1
+    assert not os.path.isdir(outbox.failed_dir)
+
+    runs, lines, scanned = RunIndex(log_root_path).load()
+    statuses = {run['group']: run['status'] for run in runs.values()}
+    assert statuses == {'job_b': 'queued', 'job_a': 'sent'}
@@ -0,0 +1,82 @@
+import os
+import time
+
+from notifyemail.retention import RetentionManager, RunIndex
+
+
+def make_runs(tmp_path, specs):
+    """Runs of the index from (id, group, age in days, bytes, status), with their folders."""
+    runs = {}
+    now = time.time()
+    for run_id, group, age, size, status in specs:
+        path = os.path.join(group, run_id)
+        os.makedirs(str(tmp_path / path))
+        runs[run_id] = {'id': run_id, 'path': path, 'group': group, 'start': now - age * 86400, 'pid': os.getpid(),
+                        'status': status, 'bytes': size}
+    return runs
+
+
+def selected(tmp_path, specs, **quotas):
+    manager = RetentionManager(str(tmp_path), **quotas)
+    updates = []
+    obsolete = manager.select(make_runs(tmp_path, specs), updates)
+    return sorted(run['id'] for run in obsolete), updates
+
+
+def test_max_count_per_group(tmp_path):
+    specs = [('a1', 'A', 1, 10, 'sent'), ('a2', 'A', 2, 10, 'sent'), ('a3', 'A', 3, 10, 'failed'),
+             ('b1', 'B', 4, 10, 'sent'), ('b2', 'B', 5, 10, 'queued')]
+    assert selected(tmp_path, specs, max_count=2) == (['a3'], [])
+
+
+def test_running_runs_are_kept_and_counted(tmp_path):
+    specs = [('a1', 'A', 1, 10, 'running'), ('a2', 'A', 2, 10, 'sent'), ('a3', 'A', 3, 10, 'sent')]
+    assert selected(tmp_path, specs, max_count=1) == (['a2', 'a3'], [])
+
+
+def test_max_bytes_counts_only_kept_runs(tmp_path):
+    # Runs removed by max_count do not use up the size budget of the other groups
+    specs = [('a1', 'A', 1, 100, 'sent'), ('a2', 'A', 2, 100, 'sent'), ('a3', 'A', 3, 100, 'sent'),
+             ('b4', 'B', 4, 10, 'sent')]
+    assert selected(tmp_path, specs, max_count=1, max_bytes=150) == (['a2', 'a3'], [])
+
+
+def test_max_bytes_across_groups(tmp_path):
+    specs = [('a1', 'A', 1, 100, 'sent'), ('b1', 'B', 2, 100, 'sent'), ('a2', 'A', 3, 100, 'sent'),
+             ('b2', 'B', 4, 10, 'sent')]
+    # Once over the budget, the older runs go too, even if they would fit
+    assert selected(tmp_path, specs, max_count=5, max_bytes=250) == (['a2', 'b2'], [])
+
+
+def test_max_age_across_groups(tmp_path):
+    specs = [('a1', 'A', 1, 10, 'sent'), ('a2', 'A', 10, 10, 'sent'), ('b1', 'B', 20, 10, 'sent'),
+             ('b2', 'B', 0.5, 1000, 'sent')]
+    assert selected(tmp_path, specs, max_count=5, max_age=7) == (['a2', 'b1'], [])
+    # Both quotas together
+    assert selected(tmp_path / 'bytes', specs, max_count=5, max_age=7, max_bytes=1010) == (['a2', 'b1'], [])
+
+
+def test_crashed_and_removed_runs(tmp_path):
+    runs = make_runs(tmp_path, [('a1', 'A', 1, 0, 'running'), ('a2', 'A', 2, 10, 'sent')])
+    runs['a1']['pid'] = 2 ** 22 + 12345  # No such process
+    (tmp_path / 'A' / 'a1' / 'run.log').write_bytes(b'x' * 42)
+    os.rmdir(str(tmp_path / 'A' / 'a2'))
+    updates = []
+    assert RetentionManager(str(tmp_path), max_count=5).select(runs, updates) == []
+    assert updates == [{'id': 'a1', 'status': 'crashed', 'bytes': 42}, {'id': 'a2', 'status': 'deleted'}]
+
+
+def test_prune_scans_old_folders(tmp_path):
+    for index in range(4):
+        os.makedirs(str(tmp_path / 'job' / ('2020_01_0%d-00_00_00' % (index + 1))))
+    manager = RetentionManager(str(tmp_path), max_count=2)
+    run_id, name = manager.start_run('job', time.strftime('%Y_%m_%d-%H_%M_%S'))
+    manager.end_run(run_id, os.path.join('job', name), 'sent')
+
+    removed = manager.prune()
+    assert sorted(removed) == [os.path.join('job', '2020_01_01-00_00_00'), os.path.join('job', '2020_01_02-00_00_00'),
+                               os.path.join('job', '2020_01_03-00_00_00')]
+    assert sorted(os.listdir(str(tmp_path / 'job'))) == sorted([name, '2020_01_04-00_00_00'])
+    runs, lines, scanned = RunIndex(str(tmp_path)).load()
+    assert scanned and runs[run_id]['status'] == 'sent'
+    assert manager.prune() == []